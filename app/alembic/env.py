@@ -8,6 +8,12 @@ from sqlalchemy import engine_from_config, pool
 # access to the values within the .ini file in use.
 config = context.config
 
+# Every shard database is migrated on its own:
+# alembic -x url=postgresql://... upgrade head
+x_url = context.get_x_argument(as_dictionary=True).get("url")
+if x_url:
+    config.set_main_option("sqlalchemy.url", x_url)
+
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
 if config.config_file_name is not None:
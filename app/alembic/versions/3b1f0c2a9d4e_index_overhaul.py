@@ -0,0 +1,58 @@
+"""Index overhaul
+
+Revision ID: 3b1f0c2a9d4e
+Revises: a73be91d7bc5
+Create Date: 2026-10-19 10:12:41.203118
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "3b1f0c2a9d4e"
+down_revision = "a73be91d7bc5"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Indexes on primary key columns only duplicate the PK index.
+    op.drop_index(op.f("ix_users_id"), table_name="users")
+    op.drop_index(op.f("ix_tweets_id"), table_name="tweets")
+    op.drop_index(op.f("ix_likes_id"), table_name="likes")
+    op.drop_index(op.f("ix_medias_id"), table_name="medias")
+    # Covered by the leading column of _unique_who_tweet_likes.
+    op.drop_index(op.f("ix_likes_user_id"), table_name="likes")
+    # No query filters on content, and a btree over free text breaks
+    # on values larger than a third of a page.
+    op.drop_index(op.f("ix_tweets_content"), table_name="tweets")
+
+    op.create_index(
+        "ix_tweets_user_id_id", "tweets", ["user_id", "id"], unique=False
+    )
+    op.create_index(
+        op.f("ix_medias_tweet_id"), "medias", ["tweet_id"], unique=False
+    )
+    op.create_index(
+        "ix_followers_followed_user_id",
+        "followers",
+        ["followed_user_id", "following_user_id"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_followers_followed_user_id", table_name="followers")
+    op.drop_index(op.f("ix_medias_tweet_id"), table_name="medias")
+    op.drop_index("ix_tweets_user_id_id", table_name="tweets")
+
+    op.create_index(
+        op.f("ix_tweets_content"), "tweets", ["content"], unique=False
+    )
+    op.create_index(
+        op.f("ix_likes_user_id"), "likes", ["user_id"], unique=False
+    )
+    op.create_index(op.f("ix_medias_id"), "medias", ["id"], unique=False)
+    op.create_index(op.f("ix_likes_id"), "likes", ["id"], unique=False)
+    op.create_index(op.f("ix_tweets_id"), "tweets", ["id"], unique=False)
+    op.create_index(op.f("ix_users_id"), "users", ["id"], unique=True)
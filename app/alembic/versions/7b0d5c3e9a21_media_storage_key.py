@@ -0,0 +1,29 @@
+"""Storage key and size of media
+
+Revision ID: 7b0d5c3e9a21
+Revises: e5a93d2c7f18
+Create Date: 2026-10-19 14:02:37.581960
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "7b0d5c3e9a21"
+down_revision = "e5a93d2c7f18"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("medias", sa.Column("key", sa.String(), nullable=True))
+    op.add_column("medias", sa.Column("size", sa.BigInteger(), nullable=True))
+    # Files uploaded so far are stored under their name in OUT_PATH.
+    op.execute("UPDATE medias SET key = regexp_replace(name, '^.*/', '')")
+    op.alter_column("medias", "key", nullable=False)
+
+
+def downgrade() -> None:
+    op.drop_column("medias", "size")
+    op.drop_column("medias", "key")
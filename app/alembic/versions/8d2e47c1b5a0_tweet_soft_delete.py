@@ -0,0 +1,35 @@
+"""Tweet soft delete
+
+Revision ID: 8d2e47c1b5a0
+Revises: 3b1f0c2a9d4e
+Create Date: 2026-10-19 11:02:17.552930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "8d2e47c1b5a0"
+down_revision = "3b1f0c2a9d4e"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tweets",
+        sa.Column("deleted_at", sa.DateTime(timezone=True), nullable=True),
+    )
+    op.create_index(
+        "ix_tweets_deleted_at",
+        "tweets",
+        ["deleted_at"],
+        unique=False,
+        postgresql_where=sa.text("deleted_at IS NOT NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_tweets_deleted_at", table_name="tweets")
+    op.drop_column("tweets", "deleted_at")
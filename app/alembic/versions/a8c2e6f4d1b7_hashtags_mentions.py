@@ -0,0 +1,64 @@
+"""Hashtags and mentions of tweets
+
+Revision ID: a8c2e6f4d1b7
+Revises: f1b5d7e3a9c2
+Create Date: 2026-10-19 22:31:08.114502
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a8c2e6f4d1b7"
+down_revision = "f1b5d7e3a9c2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "tweet_hashtags",
+        sa.Column("tag", sa.String(), nullable=False),
+        sa.Column("tweet_id", sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["tweet_id"], ["tweets.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("tag", "tweet_id"),
+    )
+    op.create_index(
+        "ix_tweet_hashtags_tweet_id",
+        "tweet_hashtags",
+        ["tweet_id"],
+        unique=False,
+    )
+    op.create_table(
+        "tweet_mentions",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("tweet_id", sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["tweet_id"], ["tweets.id"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("user_id", "tweet_id"),
+    )
+    op.create_index(
+        "ix_tweet_mentions_tweet_id",
+        "tweet_mentions",
+        ["tweet_id"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_users_lower_name",
+        "users",
+        [sa.text("lower(name)")],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_users_lower_name", table_name="users")
+    op.drop_index("ix_tweet_mentions_tweet_id", table_name="tweet_mentions")
+    op.drop_table("tweet_mentions")
+    op.drop_index("ix_tweet_hashtags_tweet_id", table_name="tweet_hashtags")
+    op.drop_table("tweet_hashtags")
@@ -0,0 +1,51 @@
+"""Denormalized follower, following and tweet counts of users
+
+Revision ID: a9e4c7b2d615
+Revises: f3c8a1d6e2b4
+Create Date: 2026-10-19 16:02:41.518304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a9e4c7b2d615"
+down_revision = "f3c8a1d6e2b4"
+branch_labels = None
+depends_on = None
+
+COUNTERS = ("followers_count", "following_count", "tweets_count")
+
+
+def upgrade() -> None:
+    for name in COUNTERS:
+        op.add_column(
+            "users",
+            sa.Column(name, sa.Integer(), server_default="0", nullable=False),
+        )
+    # Tweets of the other shards are counted by the first run of
+    # services.counter_service.repair_counters.
+    op.execute(
+        """
+        UPDATE users SET
+            followers_count = (
+                SELECT count(*) FROM followers
+                WHERE followers.followed_user_id = users.id
+            ),
+            following_count = (
+                SELECT count(*) FROM followers
+                WHERE followers.following_user_id = users.id
+            ),
+            tweets_count = (
+                SELECT count(*) FROM tweets
+                WHERE tweets.user_id = users.id
+                AND tweets.deleted_at IS NULL
+            )
+        """
+    )
+
+
+def downgrade() -> None:
+    for name in reversed(COUNTERS):
+        op.drop_column("users", name)
@@ -0,0 +1,44 @@
+"""Account deletion queue
+
+Revision ID: b3d9f5a7c1e2
+Revises: a8c2e6f4d1b7
+Create Date: 2026-10-20 10:42:51.603218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b3d9f5a7c1e2"
+down_revision = "a8c2e6f4d1b7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "users",
+        sa.Column("deleted_at", sa.DateTime(timezone=True), nullable=True),
+    )
+    op.create_index(
+        "ix_users_deleted_at",
+        "users",
+        ["deleted_at"],
+        unique=False,
+        postgresql_where=sa.text("deleted_at IS NOT NULL"),
+    )
+    op.create_index(
+        "ix_notifications_actor_id",
+        "notifications",
+        ["actor_id"],
+        unique=False,
+    )
+    op.create_index("ix_medias_user_id", "medias", ["user_id"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_medias_user_id", table_name="medias")
+    op.drop_index("ix_notifications_actor_id", table_name="notifications")
+    op.drop_index("ix_users_deleted_at", table_name="users")
+    op.drop_column("users", "deleted_at")
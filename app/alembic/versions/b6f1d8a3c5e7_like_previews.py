@@ -0,0 +1,30 @@
+"""Index for the newest likes of a tweet
+
+Revision ID: b6f1d8a3c5e7
+Revises: d2b7e9f4a6c3
+Create Date: 2026-10-19 18:02:47.315820
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "b6f1d8a3c5e7"
+down_revision = "d2b7e9f4a6c3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Covers every lookup of the single column index it replaces.
+    op.create_index(
+        "ix_likes_tweet_id_id", "likes", ["tweet_id", "id"], unique=False
+    )
+    op.drop_index(op.f("ix_likes_tweet_id"), table_name="likes")
+
+
+def downgrade() -> None:
+    op.create_index(
+        op.f("ix_likes_tweet_id"), "likes", ["tweet_id"], unique=False
+    )
+    op.drop_index("ix_likes_tweet_id_id", table_name="likes")
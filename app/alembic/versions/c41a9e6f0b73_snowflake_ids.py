@@ -0,0 +1,71 @@
+"""Snowflake ids for tweets and likes
+
+Revision ID: c41a9e6f0b73
+Revises: 8d2e47c1b5a0
+Create Date: 2026-10-19 12:20:45.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c41a9e6f0b73"
+down_revision = "8d2e47c1b5a0"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Ids now come from core.snowflake. Existing serial ids stay as they are:
+    # they are smaller than any generated id, so the time order holds.
+    for table in ("tweets", "likes"):
+        op.alter_column(
+            table,
+            "id",
+            type_=sa.BigInteger(),
+            existing_type=sa.Integer(),
+            server_default=None,
+            existing_nullable=False,
+        )
+        op.execute(f"DROP SEQUENCE IF EXISTS {table}_id_seq")
+    for table in ("likes", "medias"):
+        op.alter_column(
+            table,
+            "tweet_id",
+            type_=sa.BigInteger(),
+            existing_type=sa.Integer(),
+            existing_nullable=True,
+        )
+
+
+def downgrade() -> None:
+    # Only possible while no generated id exceeds the integer range.
+    for table in ("likes", "medias"):
+        op.alter_column(
+            table,
+            "tweet_id",
+            type_=sa.Integer(),
+            existing_type=sa.BigInteger(),
+            existing_nullable=True,
+        )
+    for table in ("tweets", "likes"):
+        op.alter_column(
+            table,
+            "id",
+            type_=sa.Integer(),
+            existing_type=sa.BigInteger(),
+            existing_nullable=False,
+        )
+        op.execute(f"CREATE SEQUENCE {table}_id_seq OWNED BY {table}.id")
+        op.execute(
+            f"SELECT setval('{table}_id_seq', "
+            f"(SELECT coalesce(max(id), 0) + 1 FROM {table}), false)"
+        )
+        op.alter_column(
+            table,
+            "id",
+            server_default=sa.text(f"nextval('{table}_id_seq')"),
+            existing_type=sa.Integer(),
+            existing_nullable=False,
+        )
@@ -0,0 +1,50 @@
+"""Monthly partitions of tweets and likes
+
+Revision ID: c4e7a9b2d6f1
+Revises: b3d9f5a7c1e2
+Create Date: 2026-10-20 15:07:26.418390
+
+"""
+from datetime import datetime, timezone
+
+from alembic import op
+
+from core.config import PARTITION_MONTHS_AHEAD
+from core.partitions import (
+    PARTITION_KEYS,
+    create_partitions,
+    month_start,
+    partition_table,
+    unpartition_table,
+)
+from core.snowflake import min_id_at
+
+# revision identifiers, used by Alembic.
+revision = "c4e7a9b2d6f1"
+down_revision = "b3d9f5a7c1e2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # The primary key of a partitioned table holds its partition key.
+    op.drop_constraint("likes_pkey", "likes", type_="primary")
+    op.create_primary_key("likes_pkey", "likes", ["id", "tweet_id"])
+
+    # Existing rows stay in place, as the partition of the ids minted up
+    # to the end of this month; the following months get their own.
+    conn = op.get_bind()
+    now = datetime.now(timezone.utc)
+    for table in PARTITION_KEYS:
+        partition_table(conn, table, min_id_at(month_start(now, 1)))
+        create_partitions(conn, table, now, PARTITION_MONTHS_AHEAD)
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+    for table in reversed(list(PARTITION_KEYS)):
+        unpartition_table(conn, table)
+
+    op.drop_constraint("likes_pkey", "likes", type_="primary")
+    op.create_primary_key("likes_pkey", "likes", ["id"])
+    op.alter_column("likes", "tweet_id", nullable=True)
@@ -0,0 +1,76 @@
+"""Aggregated notifications and unread counters
+
+Revision ID: c4e8a2f6b1d9
+Revises: b6f1d8a3c5e7
+Create Date: 2026-10-19 19:14:36.920457
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c4e8a2f6b1d9"
+down_revision = "b6f1d8a3c5e7"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "notifications",
+        sa.Column("id", sa.BigInteger(), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("kind", sa.String(), nullable=False),
+        sa.Column(
+            "tweet_id", sa.BigInteger(), server_default="0", nullable=False
+        ),
+        sa.Column("actor_id", sa.Integer(), nullable=False),
+        sa.Column(
+            "actors_count", sa.Integer(), server_default="1", nullable=False
+        ),
+        sa.Column("seq", sa.BigInteger(), nullable=False),
+        sa.Column(
+            "unread",
+            sa.Boolean(),
+            server_default=sa.text("true"),
+            nullable=False,
+        ),
+        sa.ForeignKeyConstraint(
+            ["actor_id"], ["users.id"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint(
+            "user_id", "kind", "tweet_id", name="_unique_notification_group"
+        ),
+    )
+    op.create_index(
+        "ix_notifications_user_id_seq",
+        "notifications",
+        ["user_id", "seq"],
+        unique=False,
+    )
+    op.create_index(
+        "ix_notifications_unread",
+        "notifications",
+        ["user_id"],
+        unique=False,
+        postgresql_where=sa.text("unread"),
+    )
+    op.add_column(
+        "users",
+        sa.Column(
+            "unread_notifications",
+            sa.Integer(),
+            server_default="0",
+            nullable=False,
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("users", "unread_notifications")
+    op.drop_index("ix_notifications_unread", table_name="notifications")
+    op.drop_index("ix_notifications_user_id_seq", table_name="notifications")
+    op.drop_table("notifications")
@@ -0,0 +1,73 @@
+"""Stored like counts and ranking scores of tweets
+
+Revision ID: d2b7e9f4a6c3
+Revises: a9e4c7b2d615
+Create Date: 2026-10-19 17:20:12.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d2b7e9f4a6c3"
+down_revision = "a9e4c7b2d615"
+branch_labels = None
+depends_on = None
+
+# services.ranking_service.score_of, with the defaults of core.config
+SCORE_SQL = """
+    likes_count / power(
+        greatest(
+            (extract(epoch FROM now()) * 1000 - ((id >> 12) + 1672531200000))
+            / 3600000.0,
+            0
+        ) + 2,
+        1.8
+    )
+"""
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tweets",
+        sa.Column(
+            "likes_count", sa.Integer(), server_default="0", nullable=False
+        ),
+    )
+    op.add_column(
+        "tweets",
+        sa.Column("score", sa.Float(), server_default="0", nullable=False),
+    )
+    # Likes live on the shard of their tweet: this is right on every shard.
+    op.execute(
+        """
+        UPDATE tweets SET likes_count = counts.total
+        FROM (
+            SELECT tweet_id, count(*) AS total FROM likes GROUP BY tweet_id
+        ) AS counts
+        WHERE tweets.id = counts.tweet_id
+        """
+    )
+    op.execute(f"UPDATE tweets SET score = {SCORE_SQL} WHERE likes_count > 0")
+    op.create_index(
+        "ix_tweets_user_id_score",
+        "tweets",
+        ["user_id", "score", "id"],
+        unique=False,
+        postgresql_where=sa.text("deleted_at IS NULL"),
+    )
+    op.create_index(
+        "ix_tweets_user_id_likes_count",
+        "tweets",
+        ["user_id", "likes_count", "id"],
+        unique=False,
+        postgresql_where=sa.text("deleted_at IS NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_tweets_user_id_likes_count", table_name="tweets")
+    op.drop_index("ix_tweets_user_id_score", table_name="tweets")
+    op.drop_column("tweets", "score")
+    op.drop_column("tweets", "likes_count")
@@ -0,0 +1,40 @@
+"""Depth in the index of reply threads
+
+Revision ID: d8f2b6a4c9e1
+Revises: c4e7a9b2d6f1
+Create Date: 2026-10-21 10:12:48.503617
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d8f2b6a4c9e1"
+down_revision = "c4e7a9b2d6f1"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Still ordered by path for the pages of a thread, with depth checked
+    # in the index for the pages limited to a few levels.
+    op.create_index(
+        "ix_tweets_root_id_path_depth",
+        "tweets",
+        ["root_id", "path", "depth"],
+        unique=False,
+        postgresql_where=sa.text("root_id IS NOT NULL"),
+    )
+    op.drop_index("ix_tweets_root_id_path", table_name="tweets")
+
+
+def downgrade() -> None:
+    op.create_index(
+        "ix_tweets_root_id_path",
+        "tweets",
+        ["root_id", "path"],
+        unique=False,
+        postgresql_where=sa.text("root_id IS NOT NULL"),
+    )
+    op.drop_index("ix_tweets_root_id_path_depth", table_name="tweets")
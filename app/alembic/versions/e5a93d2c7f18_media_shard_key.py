@@ -0,0 +1,69 @@
+"""Snowflake ids and uploader for media
+
+Revision ID: e5a93d2c7f18
+Revises: c41a9e6f0b73
+Create Date: 2026-10-19 13:05:12.640391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e5a93d2c7f18"
+down_revision = "c41a9e6f0b73"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.alter_column(
+        "medias",
+        "id",
+        type_=sa.BigInteger(),
+        existing_type=sa.Integer(),
+        server_default=None,
+        existing_nullable=False,
+    )
+    op.execute("DROP SEQUENCE IF EXISTS medias_id_seq")
+
+    # The uploader places media on a shard; attached media take the author.
+    op.add_column("medias", sa.Column("user_id", sa.Integer(), nullable=True))
+    op.create_foreign_key(
+        "medias_user_id_fkey",
+        "medias",
+        "users",
+        ["user_id"],
+        ["id"],
+        ondelete="CASCADE",
+    )
+    op.execute(
+        "UPDATE medias SET user_id = tweets.user_id "
+        "FROM tweets WHERE tweets.id = medias.tweet_id"
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint("medias_user_id_fkey", "medias", type_="foreignkey")
+    op.drop_column("medias", "user_id")
+
+    # Only possible while no generated id exceeds the integer range.
+    op.alter_column(
+        "medias",
+        "id",
+        type_=sa.Integer(),
+        existing_type=sa.BigInteger(),
+        existing_nullable=False,
+    )
+    op.execute("CREATE SEQUENCE medias_id_seq OWNED BY medias.id")
+    op.execute(
+        "SELECT setval('medias_id_seq', "
+        "(SELECT coalesce(max(id), 0) + 1 FROM medias), false)"
+    )
+    op.alter_column(
+        "medias",
+        "id",
+        server_default=sa.text("nextval('medias_id_seq')"),
+        existing_type=sa.Integer(),
+        existing_nullable=False,
+    )
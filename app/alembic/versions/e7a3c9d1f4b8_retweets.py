@@ -0,0 +1,46 @@
+"""Retweets and quotes by reference
+
+Revision ID: e7a3c9d1f4b8
+Revises: c4e8a2f6b1d9
+Create Date: 2026-10-19 20:31:05.118274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e7a3c9d1f4b8"
+down_revision = "c4e8a2f6b1d9"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tweets", sa.Column("retweet_of_id", sa.BigInteger(), nullable=True)
+    )
+    op.add_column(
+        "tweets", sa.Column("quote_of_id", sa.BigInteger(), nullable=True)
+    )
+    for name in ("retweets_count", "quotes_count"):
+        op.add_column(
+            "tweets",
+            sa.Column(name, sa.Integer(), server_default="0", nullable=False),
+        )
+    op.create_index(
+        "ix_tweets_user_id_retweet_of_id",
+        "tweets",
+        ["user_id", "retweet_of_id"],
+        unique=True,
+        postgresql_where=sa.text(
+            "retweet_of_id IS NOT NULL AND deleted_at IS NULL"
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_tweets_user_id_retweet_of_id", table_name="tweets")
+    for name in ("quotes_count", "retweets_count", "quote_of_id"):
+        op.drop_column("tweets", name)
+    op.drop_column("tweets", "retweet_of_id")
@@ -0,0 +1,48 @@
+"""Reply threads
+
+Revision ID: f1b5d7e3a9c2
+Revises: e7a3c9d1f4b8
+Create Date: 2026-10-19 21:47:52.603119
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "f1b5d7e3a9c2"
+down_revision = "e7a3c9d1f4b8"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tweets", sa.Column("parent_id", sa.BigInteger(), nullable=True)
+    )
+    op.add_column(
+        "tweets", sa.Column("root_id", sa.BigInteger(), nullable=True)
+    )
+    op.add_column(
+        "tweets",
+        sa.Column("path", sa.String(collation="C"), nullable=True),
+    )
+    for name in ("depth", "replies_count"):
+        op.add_column(
+            "tweets",
+            sa.Column(name, sa.Integer(), server_default="0", nullable=False),
+        )
+    op.create_index(
+        "ix_tweets_root_id_path",
+        "tweets",
+        ["root_id", "path"],
+        unique=False,
+        postgresql_where=sa.text("root_id IS NOT NULL"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_tweets_root_id_path", table_name="tweets")
+    for name in ("replies_count", "depth", "path", "root_id"):
+        op.drop_column("tweets", name)
+    op.drop_column("tweets", "parent_id")
@@ -0,0 +1,34 @@
+"""Indexes for the orphaned media collector
+
+Revision ID: f3c8a1d6e2b4
+Revises: 7b0d5c3e9a21
+Create Date: 2026-10-19 15:11:03.229571
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "f3c8a1d6e2b4"
+down_revision = "7b0d5c3e9a21"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_medias_unattached",
+        "medias",
+        ["id"],
+        unique=False,
+        postgresql_where=sa.text("tweet_id IS NULL"),
+    )
+    # Not unique: files uploaded before storage keys were random could be
+    # overwritten by a later upload of the same name and be shared.
+    op.create_index(op.f("ix_medias_key"), "medias", ["key"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_medias_key"), table_name="medias")
+    op.drop_index("ix_medias_unattached", table_name="medias")
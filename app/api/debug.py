@@ -0,0 +1,102 @@
+import asyncio
+from typing import Optional, Union
+
+from fastapi import APIRouter, Header, Query, Response
+
+from core.config import PROFILE_MAX_SECONDS
+from core.exceptions import BackendException
+from core.loop_monitor import slow_callbacks
+from core.profiling import Profile, check_admin, recent, sampler
+from db.schemas import ErrorSchema, SlowCallbacksOutSchema
+
+router = APIRouter(prefix="/debug", tags=["Debug"])
+
+PROFILE_FORMATS = "^(collapsed|svg)$"
+
+
+def profile_response(profile: Profile, format: str, title: str) -> Response:
+    if format == "svg":
+        return Response(profile.flamegraph(title), media_type="image/svg+xml")
+    return Response(profile.collapsed(), media_type="text/plain")
+
+
+@router.get(
+    "/profile",
+    summary="Профилирование воркера в течение N секунд",
+    response_description="Свёрнутые стеки или flamegraph",
+    response_model=ErrorSchema,
+    status_code=200,
+)
+async def profile_worker(
+    response: Response,
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+    format: str = Query("collapsed", regex=PROFILE_FORMATS),
+    x_admin_token: Optional[str] = Header(None),
+):
+    try:
+        check_admin(x_admin_token)
+    except BackendException as e:
+        response.status_code = 403
+        return e
+
+    profile = sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop(profile)
+    return profile_response(profile, format, f"Worker, {seconds:g} s")
+
+
+@router.get(
+    "/profile/{profile_id}",
+    summary="Профиль запроса, отправленного с заголовком X-Profile: 1",
+    response_description="Свёрнутые стеки или flamegraph",
+    response_model=ErrorSchema,
+    status_code=200,
+)
+async def get_request_profile(
+    response: Response,
+    profile_id: str,
+    format: str = Query("collapsed", regex=PROFILE_FORMATS),
+    x_admin_token: Optional[str] = Header(None),
+):
+    try:
+        check_admin(x_admin_token)
+    except BackendException as e:
+        response.status_code = 403
+        return e
+
+    profile = recent.get(profile_id)
+    if profile is None:
+        response.status_code = 404
+        return BackendException(
+            error_type="NO PROFILE", error_message="No profile with such id"
+        )
+    return profile_response(
+        profile, format, f"Request {profile_id}, {profile.duration:.3f} s"
+    )
+
+
+@router.get(
+    "/slow-callbacks",
+    summary="Последние колбэки, заблокировавшие event loop",
+    response_description="Маршрут, длительность и стек каждого",
+    response_model=Union[SlowCallbacksOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_slow_callbacks(
+    response: Response,
+    x_admin_token: Optional[str] = Header(None),
+) -> Union[SlowCallbacksOutSchema, ErrorSchema]:
+    try:
+        check_admin(x_admin_token)
+    except BackendException as e:
+        response.status_code = 403
+        return e
+
+    return {
+        "threshold": slow_callbacks.threshold,
+        "callbacks": [
+            report._asdict() for report in reversed(slow_callbacks.reports)
+        ],
+    }
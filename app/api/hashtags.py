@@ -0,0 +1,49 @@
+from typing import Optional, Union
+
+from fastapi import APIRouter, Depends, Header, Query, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.cache import cache_nothing, cache_private, cache_public, hashtag_key
+from core.config import TAG_PAGE_MAX, TAG_PAGE_SIZE
+from core.exceptions import BackendException
+from db.schemas import ErrorSchema, TweetPageOutSchema
+from dependencies import get_session
+from services.tweet_service import get_hashtag_tweets
+
+router = APIRouter(prefix="/hashtags", tags=["Hashtags"])
+
+
+@router.get(
+    "/{tag}/tweets",
+    summary="Получение твитов с хэштегом постранично",
+    response_description="Сообщение о результате со страницей твитов",
+    response_model=Union[TweetPageOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_hashtag_tweets_handler(
+    response: Response,
+    tag: str,
+    api_key: Optional[str] = Header(default=None),
+    cursor: Optional[int] = Query(None),
+    limit: int = Query(TAG_PAGE_SIZE, gt=0, le=TAG_PAGE_MAX),
+    session: AsyncSession = Depends(get_session),
+) -> Union[TweetPageOutSchema, ErrorSchema]:
+    try:
+        result = await get_hashtag_tweets(
+            session=session,
+            tag=tag,
+            api_key=api_key,
+            cursor=cursor,
+            limit=limit,
+        )
+    except BackendException as e:
+        response.status_code = 404
+        cache_nothing(response)
+        return e
+
+    if api_key is None:
+        cache_public(response, hashtag_key(tag.lstrip("#").lower()))
+        response.headers["Vary"] += ", api-key"
+    else:
+        cache_private(response)
+    return result
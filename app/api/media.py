@@ -1,14 +1,25 @@
 from typing import Union
 
-import aiofiles
-from fastapi import APIRouter, Depends, Header, Response, UploadFile
+from fastapi import APIRouter, Depends, Header, Request, Response, UploadFile
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from dependencies import get_session
 from core.exceptions import BackendException
-from db.schemas import MediaOutSchema, ErrorSchema
-from services.media_service import check_file, post_image
-from core.config import MEDIA_PATH, OUT_PATH
+from core.tracing import span
+from db.schemas import (
+    ErrorSchema,
+    MediaOutSchema,
+    MediaUploadIn,
+    MediaUploadOutSchema,
+    ResultSchema,
+)
+from dependencies import get_session
+from services.media_service import (
+    check_file,
+    complete_image_upload,
+    post_image,
+    presign_image_upload,
+    receive_upload,
+)
 
 router = APIRouter(prefix="/medias", tags=["Medias"])
 
@@ -28,16 +39,93 @@ async def post_image_handler(
 ) -> Union[MediaOutSchema, ErrorSchema]:
     try:
         check_file(file)
-        print(OUT_PATH)
-        filename = file.filename
-        file_data = await file.read()
-        path = "{}/{}".format(OUT_PATH, filename)
-        async with aiofiles.open(path, mode="wb") as some_file:
-            await some_file.write(file_data)
+        with span("file.read", **{"file.name": file.filename}) as read:
+            data = await file.read()
+            if read is not None:
+                read.attributes["file.size"] = len(data)
+        return await post_image(
+            session=session,
+            api_key=api_key,
+            filename=file.filename,
+            data=data,
+            content_type=file.content_type,
+        )
+    except BackendException as e:
+        response.status_code = 400
+        return e
+
+
+@router.post(
+    "/uploads",
+    summary="Ссылка для загрузки изображения напрямую в хранилище",
+    response_description="Запрос, которым клиент отправляет файл",
+    response_model=Union[MediaUploadOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def presign_upload_handler(
+    response: Response,
+    upload: MediaUploadIn,
+    api_key: str = Header(),
+    session: AsyncSession = Depends(get_session),
+) -> Union[MediaUploadOutSchema, ErrorSchema]:
+    try:
+        return await presign_image_upload(
+            session=session,
+            api_key=api_key,
+            filename=upload.filename,
+            content_type=upload.content_type,
+        )
+    except BackendException as e:
+        response.status_code = 400
+        return e
 
-        name_for_db = MEDIA_PATH + filename
 
-        return await post_image(session=session, image_name=name_for_db)
+@router.put(
+    "/uploads/{key}",
+    summary="Приём файла по ссылке загрузки (локальное хранилище)",
+    response_description="Результат",
+    response_model=Union[ResultSchema, ErrorSchema],
+    status_code=200,
+)
+async def receive_upload_handler(
+    request: Request,
+    response: Response,
+    key: str,
+    expires: int,
+    signature: str,
+    content_type: str = Header(),
+) -> Union[ResultSchema, ErrorSchema]:
+    try:
+        await receive_upload(
+            key=key,
+            content_type=content_type,
+            expires=expires,
+            signature=signature,
+            chunks=request.stream(),
+        )
+        return {"result": True}
+    except BackendException as e:
+        response.status_code = 403
+        return e
+
+
+@router.post(
+    "/{id}/complete",
+    summary="Подтверждение загрузки изображения",
+    response_description="Результат",
+    response_model=Union[MediaOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def complete_upload_handler(
+    response: Response,
+    id: int,
+    api_key: str = Header(),
+    session: AsyncSession = Depends(get_session),
+) -> Union[MediaOutSchema, ErrorSchema]:
+    try:
+        return await complete_image_upload(
+            session=session, api_key=api_key, media_id=id
+        )
     except BackendException as e:
         response.status_code = 400
         return e
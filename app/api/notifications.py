@@ -0,0 +1,61 @@
+from typing import Optional, Union
+
+from fastapi import APIRouter, Depends, Header, Query, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.cache import cache_private
+from core.config import NOTIFICATIONS_PAGE_MAX, NOTIFICATIONS_PAGE_SIZE
+from core.exceptions import BackendException
+from db.schemas import ErrorSchema, NotificationListOutSchema, ResultSchema
+from dependencies import get_session
+from services.notification_service import get_notifications, read_notifications
+
+router = APIRouter(prefix="/notifications", tags=["Notifications"])
+
+
+@router.get(
+    "/",
+    summary="Получение уведомлений пользователя постранично",
+    response_description="Сообщение о результате со страницей уведомлений",
+    response_model=Union[NotificationListOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_notifications_handler(
+    response: Response,
+    api_key: str = Header(default="test"),
+    cursor: Optional[int] = Query(None),
+    limit: int = Query(
+        NOTIFICATIONS_PAGE_SIZE, gt=0, le=NOTIFICATIONS_PAGE_MAX
+    ),
+    session: AsyncSession = Depends(get_session),
+) -> Union[NotificationListOutSchema, ErrorSchema]:
+    cache_private(response)
+    try:
+        result = await get_notifications(
+            session=session, api_key=api_key, cursor=cursor, limit=limit
+        )
+    except BackendException as e:
+        response.status_code = 404
+        result = e
+
+    return result
+
+
+@router.post(
+    "/read",
+    summary="Отметить все уведомления прочитанными",
+    response_description="Сообщение о результате",
+    response_model=Union[ResultSchema, ErrorSchema],
+    status_code=200,
+)
+async def read_notifications_handler(
+    response: Response,
+    api_key: str = Header(default="test"),
+    session: AsyncSession = Depends(get_session),
+) -> Union[ResultSchema, ErrorSchema]:
+    try:
+        await read_notifications(session=session, api_key=api_key)
+        return {"result": True}
+    except BackendException as e:
+        response.status_code = 404
+        return e
@@ -1,25 +1,44 @@
-from typing import Union
+from typing import Optional, Union
 
-from fastapi import APIRouter, Depends, Header, Response
+from fastapi import APIRouter, Depends, Header, Query, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from dependencies import get_session
+from core.cache import (
+    cache_nothing,
+    cache_private,
+    cache_public,
+    tweet_key,
+    user_key,
+)
+from core.config import (
+    LIKES_PAGE_MAX,
+    LIKES_PAGE_SIZE,
+    THREAD_PAGE_MAX,
+    THREAD_PAGE_SIZE,
+)
 from core.exceptions import BackendException
 from db.schemas import (
     BaseAnsTweet,
+    ErrorSchema,
+    LikeListOutSchema,
+    ResultSchema,
+    ThreadOutSchema,
     TweetIn,
     TweetListOutSchema,
     TweetSchema,
-    ErrorSchema,
-    ResultSchema,
 )
+from dependencies import get_session
 from services.tweet_service import (
     delete_like_to_tweet,
+    delete_retweet,
     delete_tweet,
+    get_thread,
     get_tweet,
+    get_tweet_likes,
     get_tweets,
     insert_media_to_tweet,
     post_like_to_tweet,
+    post_retweet,
     post_tweet,
 )
 
@@ -34,14 +53,89 @@ router = APIRouter(prefix="/tweets", tags=["Tweets"])
     status_code=200,
 )
 async def get_tweet_handler(
-    response: Response, id: int, session: AsyncSession = Depends(get_session)
+    response: Response,
+    id: int,
+    api_key: Optional[str] = Header(default=None),
+    session: AsyncSession = Depends(get_session),
 ) -> Union[TweetSchema, ErrorSchema]:
     try:
-        result = await get_tweet(session=session, tweet_id=id)
+        result = await get_tweet(session=session, tweet_id=id, api_key=api_key)
     except BackendException as e:
         response.status_code = 404
-        result = e
+        cache_nothing(response)
+        return e
+
+    if api_key is None:
+        cache_public(response, tweet_key(id), user_key(result.user_id))
+        response.headers["Vary"] += ", api-key"
+    else:
+        # liked_by_me is for the reader only.
+        cache_private(response)
+    return result
+
+
+@router.get(
+    "/{id}/likes",
+    summary="Получение лайков твита постранично",
+    response_description="Сообщение о результате со страницей лайков",
+    response_model=Union[LikeListOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_tweet_likes_handler(
+    response: Response,
+    id: int,
+    cursor: Optional[int] = Query(None),
+    limit: int = Query(LIKES_PAGE_SIZE, gt=0, le=LIKES_PAGE_MAX),
+    session: AsyncSession = Depends(get_session),
+) -> Union[LikeListOutSchema, ErrorSchema]:
+    try:
+        result = await get_tweet_likes(
+            session=session, tweet_id=id, cursor=cursor, limit=limit
+        )
+    except BackendException as e:
+        response.status_code = 404
+        cache_nothing(response)
+        return e
+
+    cache_public(response, tweet_key(id))
+    return result
+
+
+@router.get(
+    "/{id}/thread",
+    summary="Получение ветки ответов на твит",
+    response_description="Сообщение о результате с веткой ответов",
+    response_model=Union[ThreadOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_thread_handler(
+    response: Response,
+    id: int,
+    api_key: Optional[str] = Header(default=None),
+    depth: Optional[int] = Query(None, gt=0),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(THREAD_PAGE_SIZE, gt=0, le=THREAD_PAGE_MAX),
+    session: AsyncSession = Depends(get_session),
+) -> Union[ThreadOutSchema, ErrorSchema]:
+    try:
+        result = await get_thread(
+            session=session,
+            tweet_id=id,
+            api_key=api_key,
+            depth=depth,
+            cursor=cursor,
+            limit=limit,
+        )
+    except BackendException as e:
+        response.status_code = 404
+        cache_nothing(response)
+        return e
 
+    if api_key is None:
+        cache_public(response, tweet_key(id))
+        response.headers["Vary"] += ", api-key"
+    else:
+        cache_private(response)
     return result
 
 
@@ -55,10 +149,15 @@ async def get_tweet_handler(
 async def get_user_tweets_handler(
     response: Response,
     api_key: str = Header(default="test"),
+    order: str = Query("top", regex="^(ranked|recent|top)$"),
+    limit: Optional[int] = Query(None, gt=0),
     session: AsyncSession = Depends(get_session),
 ) -> Union[TweetListOutSchema, ErrorSchema]:
+    cache_private(response)
     try:
-        result = await get_tweets(session=session, api_key=api_key)
+        result = await get_tweets(
+            session=session, api_key=api_key, order=order, limit=limit
+        )
     except BackendException as e:
         response.status_code = 404
         result = e
@@ -81,7 +180,11 @@ async def post_tweet_handler(
 ) -> Union[BaseAnsTweet, ErrorSchema]:
     try:
         new_tweet_id = await post_tweet(
-            session=session, api_key=api_key, tweet_data=tweet.tweet_data
+            session=session,
+            api_key=api_key,
+            tweet_data=tweet.tweet_data,
+            quote_tweet_id=tweet.quote_tweet_id,
+            reply_to_id=tweet.reply_to_id,
         )
         if tweet.tweet_media_ids:
             await insert_media_to_tweet(
@@ -157,3 +260,47 @@ async def delete_like_to_tweet_handler(
     except BackendException as e:
         response.status_code = 404
         return e
+
+
+@router.post(
+    "/{id}/retweet",
+    summary="Ретвит",
+    response_description="Сообщение о результате",
+    response_model=Union[BaseAnsTweet, ErrorSchema],
+    status_code=200,
+)
+async def post_retweet_handler(
+    response: Response,
+    id: int,
+    api_key: str = Header(default="test"),
+    session: AsyncSession = Depends(get_session),
+) -> Union[BaseAnsTweet, ErrorSchema]:
+    try:
+        new_tweet_id = await post_retweet(
+            session=session, api_key=api_key, tweet_id=id
+        )
+        return {"result": True, "tweet_id": new_tweet_id}
+    except BackendException as e:
+        response.status_code = 404
+        return e
+
+
+@router.delete(
+    "/{id}/retweet",
+    summary="Отмена ретвита",
+    response_description="Сообщение о результате",
+    response_model=Union[ResultSchema, ErrorSchema],
+    status_code=200,
+)
+async def delete_retweet_handler(
+    response: Response,
+    id: int,
+    api_key: str = Header(default="test"),
+    session: AsyncSession = Depends(get_session),
+) -> Union[ResultSchema, ErrorSchema]:
+    try:
+        await delete_retweet(session=session, api_key=api_key, tweet_id=id)
+        return {"result": True}
+    except BackendException as e:
+        response.status_code = 404
+        return e
@@ -1,21 +1,118 @@
-from typing import Union
-from fastapi import APIRouter, Depends, Header, Response
+from typing import Optional, Union
+
+from fastapi import APIRouter, Depends, Header, Query, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from core.cache import (
+    cache_nothing,
+    cache_private,
+    cache_public,
+    mentions_key,
+    user_key,
+)
+from core.config import (
+    FOLLOWS_PAGE_MAX,
+    FOLLOWS_PAGE_SIZE,
+    TAG_PAGE_MAX,
+    TAG_PAGE_SIZE,
+)
 from core.exceptions import BackendException
-from db.schemas import ResultSchema, ErrorSchema, UserIn, UserOut, UserResultOutSchema
+from db.schemas import (
+    ErrorSchema,
+    ResultSchema,
+    TweetPageOutSchema,
+    UserIdsIn,
+    UserIdsOutSchema,
+    UserIn,
+    UserListOutSchema,
+    UserOut,
+    UserResultOutSchema,
+)
 from dependencies import get_session
+from services.account_service import delete_account
+from services.tweet_service import export_tweets, get_mentions
 from services.user_service import (
     add_follow_to_user,
-    get_user_me,
+    add_follows_to_user,
     delete_follow_from_user,
+    delete_follows_from_user,
+    get_follows,
     get_user,
+    get_user_me,
     post_user,
 )
 
 router = APIRouter(prefix="/users", tags=["Users"])
 
 
+@router.post(
+    "/follow/bulk",
+    summary="Отслеживать нескольких пользователей",
+    response_description="ID пользователей, которых стали отслеживать",
+    response_model=Union[UserIdsOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def follow_to_users(
+    response: Response,
+    follows: UserIdsIn,
+    api_key: str = Header(description="Текущий пользователь"),
+    session: AsyncSession = Depends(get_session),
+) -> Union[UserIdsOutSchema, ErrorSchema]:
+    """
+    The follow_to_users function follows several users in one transaction.
+
+    :param response: Response: Set the response status code
+    :param follows: UserIdsIn: Ids of the users to follow
+    :param api_key: str: Identify the current user
+    :param session: AsyncSession: Get the current session
+    :return: The ids of the users followed by this request
+    :doc-author: Trelent
+    """
+    try:
+        user_ids = await add_follows_to_user(
+            session=session, api_key=api_key, user_ids=follows.user_ids
+        )
+        return {"result": True, "user_ids": user_ids}
+    except BackendException as e:
+        response.status_code = 404
+        return e
+
+
+@router.delete(
+    "/follow/bulk",
+    summary="Перестать отслеживать нескольких пользователей",
+    response_description="ID пользователей, которых перестали отслеживать",
+    response_model=Union[UserIdsOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def delete_follow_to_users(
+    response: Response,
+    follows: UserIdsIn,
+    api_key: str = Header(description="Текущий пользователь"),
+    session: AsyncSession = Depends(get_session),
+) -> Union[UserIdsOutSchema, ErrorSchema]:
+    """
+    The delete_follow_to_users function unfollows several users in one
+    transaction.
+
+    :param response: Response: Set the response status code
+    :param follows: UserIdsIn: Ids of the users to unfollow
+    :param api_key: str: Identify the current user
+    :param session: AsyncSession: Get the current session
+    :return: The ids of the users unfollowed by this request
+    :doc-author: Trelent
+    """
+    try:
+        user_ids = await delete_follows_from_user(
+            session=session, api_key=api_key, user_ids=follows.user_ids
+        )
+        return {"result": True, "user_ids": user_ids}
+    except BackendException as e:
+        response.status_code = 404
+        return e
+
+
 @router.post(
     "/{id}/follow",
     summary="Отслеживать пользователя",
@@ -104,6 +201,7 @@ async def get_current_user(
   :return: A userresultoutschema, which is a schema that contains the user's data
   :doc-author: Trelent
   """
+    cache_private(response)
     try:
         return await get_user_me(session=session, api_key=api_key)
     except BackendException as e:
@@ -111,6 +209,185 @@ async def get_current_user(
         return e
 
 
+@router.delete(
+    "/me",
+    summary="Удаление аккаунта",
+    response_description="Результат",
+    response_model=Union[ResultSchema, ErrorSchema],
+    status_code=200,
+)
+async def delete_current_user(
+    response: Response,
+    api_key: str = Header(description="api-key пользователя"),
+    session: AsyncSession = Depends(get_session),
+) -> Union[ResultSchema, ErrorSchema]:
+    """
+    The delete_current_user function deletes the account of the current
+    user. It is hidden at once and erased in the background.
+
+    :param response: Response: Set the status code of the response
+    :param api_key: str: Identify the current user
+    :param session: AsyncSession: Get the session
+    :return: A resultschema object
+    :doc-author: Trelent
+    """
+    try:
+        await delete_account(session=session, api_key=api_key)
+        return {"result": True}
+    except BackendException as e:
+        response.status_code = 404
+        return e
+
+
+@router.get(
+    "/{id}/tweets/export",
+    summary="Выгрузка всех твитов пользователя в NDJSON",
+    response_description="Поток твитов, по одному JSON-объекту на строку",
+    response_model=ErrorSchema,
+    status_code=200,
+    responses={200: {"content": {"application/x-ndjson": {}}}},
+)
+async def export_user_tweets(
+        response: Response,
+        id: int,
+        session: AsyncSession = Depends(get_session),
+) -> Union[StreamingResponse, ErrorSchema]:
+    """
+  The export_user_tweets function streams every tweet of a user as NDJSON.
+  The first lines go out while the query is still running.
+
+  :param response: Response: Set the status code of the response
+  :param id: int: Get the user id
+  :param session: AsyncSession: Get the session, kept open until the stream
+      ends
+  :return: A streamingresponse, or an errorschema if there is no such user
+  :doc-author: Trelent
+  """
+    try:
+        tweets = await export_tweets(session=session, user_id=id)
+    except BackendException as e:
+        response.status_code = 404
+        return e
+
+    return StreamingResponse(
+        tweets,
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-store"},
+    )
+
+
+@router.get(
+    "/{id}/mentions",
+    summary="Получение твитов, упоминающих пользователя, постранично",
+    response_description="Сообщение о результате со страницей твитов",
+    response_model=Union[TweetPageOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_user_mentions(
+        response: Response,
+        id: int,
+        api_key: Optional[str] = Header(default=None),
+        cursor: Optional[int] = Query(None),
+        limit: int = Query(TAG_PAGE_SIZE, gt=0, le=TAG_PAGE_MAX),
+        session: AsyncSession = Depends(get_session),
+) -> Union[TweetPageOutSchema, ErrorSchema]:
+    """
+  The get_user_mentions function returns a page of the tweets mentioning a
+  user, newest first.
+
+  :param response: Response: Set the status code and the cache headers of the
+      response
+  :param id: int: Get the user id
+  :param api_key: Optional[str]: Identify the reader of the tweets
+  :param cursor: Optional[int]: next_cursor of the previous page
+  :param limit: int: Number of tweets per page
+  :param session: AsyncSession: Get the session
+  :return: A tweetpageoutschema, or an errorschema if there is no such user
+  :doc-author: Trelent
+  """
+    try:
+        result = await get_mentions(
+            session=session,
+            user_id=id,
+            api_key=api_key,
+            cursor=cursor,
+            limit=limit,
+        )
+    except BackendException as e:
+        response.status_code = 404
+        cache_nothing(response)
+        return e
+
+    if api_key is None:
+        cache_public(response, mentions_key(id))
+        response.headers["Vary"] += ", api-key"
+    else:
+        cache_private(response)
+    return result
+
+
+@router.get(
+    "/{id}/followers",
+    summary="Получение подписчиков пользователя постранично",
+    response_description="Сообщение о результате со страницей подписчиков",
+    response_model=Union[UserListOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_user_followers(
+    response: Response,
+    id: int,
+    cursor: Optional[int] = Query(None),
+    limit: int = Query(FOLLOWS_PAGE_SIZE, gt=0, le=FOLLOWS_PAGE_MAX),
+    session: AsyncSession = Depends(get_session),
+) -> Union[UserListOutSchema, ErrorSchema]:
+    try:
+        result = await get_follows(
+            session=session,
+            user_id=id,
+            side="followers",
+            cursor=cursor,
+            limit=limit,
+        )
+    except BackendException as e:
+        response.status_code = 404
+        cache_nothing(response)
+        return e
+
+    cache_public(response, user_key(id))
+    return result
+
+
+@router.get(
+    "/{id}/following",
+    summary="Получение подписок пользователя постранично",
+    response_description="Сообщение о результате со страницей подписок",
+    response_model=Union[UserListOutSchema, ErrorSchema],
+    status_code=200,
+)
+async def get_user_following(
+    response: Response,
+    id: int,
+    cursor: Optional[int] = Query(None),
+    limit: int = Query(FOLLOWS_PAGE_SIZE, gt=0, le=FOLLOWS_PAGE_MAX),
+    session: AsyncSession = Depends(get_session),
+) -> Union[UserListOutSchema, ErrorSchema]:
+    try:
+        result = await get_follows(
+            session=session,
+            user_id=id,
+            side="following",
+            cursor=cursor,
+            limit=limit,
+        )
+    except BackendException as e:
+        response.status_code = 404
+        cache_nothing(response)
+        return e
+
+    cache_public(response, user_key(id))
+    return result
+
+
 @router.get(
     "/{id}",
     summary="Получение информации о пользователе по id",
@@ -123,13 +400,16 @@ async def get_user_by_id(
         id: int = Header(description="ID пользователя"),
         session: AsyncSession = Depends(get_session),
 ) -> Union[UserResultOutSchema, ErrorSchema]:
-
     try:
-        return await get_user(session=session, user_id=id)
+        result = await get_user(session=session, user_id=id)
     except BackendException as e:
         response.status_code = 404
+        cache_nothing(response)
         return e
 
+    cache_public(response, user_key(id))
+    return result
+
 
 @router.post(
     "/",
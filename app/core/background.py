@@ -0,0 +1,49 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Coroutine, Set
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import async_session
+
+logger = logging.getLogger(__name__)
+
+_tasks: Set[asyncio.Task] = set()
+
+
+async def run_periodic(
+    job: Callable[[AsyncSession], Awaitable], interval: float
+):
+    """
+    Run ``job`` with a fresh session every ``interval`` seconds.
+
+    A failing run is logged and retried on the next tick, so one bad batch
+    never stops the loop.
+    """
+    while True:
+        try:
+            async with async_session() as session:
+                await job(session)
+        except Exception:
+            logger.exception("Background job %s failed", job.__name__)
+        await asyncio.sleep(interval)
+
+
+def start_task(coroutine: Coroutine) -> asyncio.Task:
+    """Run ``coroutine`` in the background until stop_all()."""
+    task = asyncio.create_task(coroutine)
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+def start_periodic(
+    job: Callable[[AsyncSession], Awaitable], interval: float
+) -> asyncio.Task:
+    return start_task(run_periodic(job, interval))
+
+
+async def stop_all():
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
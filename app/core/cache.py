@@ -0,0 +1,188 @@
+"""
+Cooperation with the HTTP cache in front of the app.
+
+Public GET responses carry ``Cache-Control`` for shared caches and a
+``Surrogate-Key`` header naming what they show (``tweet:ID``, ``user:ID``,
+``hashtag:TAG``, ``mentions:ID``).
+Writes call ``purge()`` with the keys they invalidate once committed, and the
+configured purger tells the cache to drop them:
+
+- ``local``: remembers the keys, for tests and setups without a cache;
+- ``http``: ``POST CACHE_PURGE_URL`` with the keys in ``Surrogate-Key``, as
+  CDNs and Varnish xkey expect;
+- ``nginx``: refetches the URLs behind the keys through the refresh server of
+  nginx/nginx.conf, which replaces the cached copies. nginx caches by URL,
+  so it only keeps the URLs without a query string, the ones refetched;
+  later pages and other limits or depths always reach the app.
+"""
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Deque, Iterable, List, Optional
+
+import httpx
+from fastapi import Response
+
+from core.config import (
+    CACHE_PURGE_TOKEN,
+    CACHE_PURGE_URL,
+    CACHE_PURGER,
+    CACHE_TTL,
+)
+from core.metrics import CACHE_PURGE_FAILURES, CACHE_PURGED_KEYS
+
+logger = logging.getLogger(__name__)
+
+PURGE_TIMEOUT = 2.0
+
+# URL of the public route showing the object behind each kind of key.
+KEY_PATHS = {
+    "tweet": "/api/tweets/{}",
+    "user": "/api/users/{}",
+    "hashtag": "/api/hashtags/{}/tweets",
+    "mentions": "/api/users/{}/mentions",
+}
+
+
+def tweet_key(tweet_id: int) -> str:
+    return f"tweet:{tweet_id}"
+
+
+def user_key(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def hashtag_key(tag: str) -> str:
+    return f"hashtag:{tag}"
+
+
+def mentions_key(user_id: int) -> str:
+    return f"mentions:{user_id}"
+
+
+def cache_public(response: Response, *keys: str):
+    """Let shared caches keep ``response`` until one of ``keys`` is purged."""
+    cache_control = f"public, max-age=0, s-maxage={CACHE_TTL}"
+    response.headers["Cache-Control"] = cache_control
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Surrogate-Key"] = " ".join(keys)
+
+
+def cache_private(response: Response):
+    """For responses that depend on the api-key header."""
+    response.headers["Cache-Control"] = "private, no-store"
+    response.headers["Vary"] = "Accept-Encoding, api-key"
+
+
+def cache_nothing(response: Response):
+    """For errors, which must not outlive the creation of what they miss."""
+    response.headers["Cache-Control"] = "no-store"
+
+
+class PurgeError(Exception):
+    """Some keys could not be purged, the others were."""
+
+    def __init__(self, failed: List[str]):
+        super().__init__(" ".join(failed))
+        self.failed = failed
+
+
+class Purger(ABC):
+    @abstractmethod
+    async def purge(self, keys: List[str]):
+        """Drop ``keys`` from the cache, raising PurgeError for those left."""
+
+
+class LocalPurger(Purger):
+    def __init__(self, size: int = 1000):
+        self.purged: Deque[str] = deque(maxlen=size)
+
+    async def purge(self, keys: List[str]):
+        self.purged.extend(keys)
+
+
+class HttpPurger(Purger):
+    def __init__(
+        self,
+        url: str,
+        token: Optional[str] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.url = url
+        self.headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self.transport = transport
+
+    async def purge(self, keys: List[str]):
+        async with httpx.AsyncClient(
+            timeout=PURGE_TIMEOUT, transport=self.transport
+        ) as client:
+            response = await client.post(
+                self.url,
+                headers={**self.headers, "Surrogate-Key": " ".join(keys)},
+            )
+            response.raise_for_status()
+
+
+class NginxPurger(Purger):
+    def __init__(
+        self,
+        base_url: str,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.transport = transport
+
+    async def purge(self, keys: List[str]):
+        async with httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=PURGE_TIMEOUT,
+            transport=self.transport,
+        ) as client:
+            failed = []
+            for key in keys:
+                kind, _, object_id = key.partition(":")
+                try:
+                    await client.get(KEY_PATHS[kind].format(object_id))
+                except httpx.HTTPError:
+                    failed.append(key)
+            if failed:
+                raise PurgeError(failed)
+
+
+def make_purger(name: str, url: Optional[str] = None) -> Purger:
+    if name == "http":
+        return HttpPurger(url, CACHE_PURGE_TOKEN)
+    if name == "nginx":
+        return NginxPurger(url)
+    return LocalPurger()
+
+
+purger: Purger = make_purger(CACHE_PURGER, CACHE_PURGE_URL)
+
+
+def set_purger(new_purger: Purger) -> Purger:
+    """Swap the purger, returning the previous one."""
+    global purger
+    previous, purger = purger, new_purger
+    return previous
+
+
+async def purge(keys: Iterable[str]):
+    """
+    Invalidate ``keys`` in the HTTP cache. Called after the commit, so a
+    reader that refills the cache right away already sees the change. A
+    failing purge is logged, the cached copies then expire after CACHE_TTL.
+    """
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return
+    try:
+        await purger.purge(keys)
+        CACHE_PURGED_KEYS.inc(len(keys))
+    except PurgeError as e:
+        CACHE_PURGED_KEYS.inc(len(keys) - len(e.failed))
+        CACHE_PURGE_FAILURES.inc()
+        logger.exception("Cache purge of %s failed", e.failed)
+    except Exception:
+        CACHE_PURGE_FAILURES.inc()
+        logger.exception("Cache purge of %s failed", keys)
@@ -1,15 +1,195 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
+import os
 from pathlib import Path
 
+from core.database import make_engine
+from core.sharding import PRIMARY_SHARD, make_session_maker
 
 # CONSTANTS
 MEDIA_PATH = "/static/media_files/"
 OUT_PATH = Path(__file__).parent.parent / "media_files"
 OUT_PATH = OUT_PATH.absolute()
 
-DATABASE_URL = "postgresql+asyncpg://admin:admin@db:5432/twitter_clone"
-engine = create_async_engine(DATABASE_URL, echo=True)
+# Media storage backend, "local" (OUT_PATH) or "s3", see core.storage.
+# STORAGE_SECRET signs the upload urls of the local backend, which does not
+# start without it. Files above MEDIA_MAX_SIZE bytes are refused.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+STORAGE_SECRET = os.getenv("STORAGE_SECRET", "")
+MEDIA_MAX_SIZE = int(os.getenv("MEDIA_MAX_SIZE", 10 * 1024 * 1024))
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", "http://minio:9000")
+S3_BUCKET = os.getenv("S3_BUCKET", "media")
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY", "")
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY", "")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_PUBLIC_URL = os.getenv("S3_PUBLIC_URL")
+# Seconds a presigned upload URL stays valid.
+UPLOAD_URL_EXPIRES = int(os.getenv("UPLOAD_URL_EXPIRES", 600))
 
-async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+# Soft-deleted tweets are purged every PURGE_INTERVAL seconds, at most
+# PURGE_BATCH_SIZE rows per statement with PURGE_PAUSE seconds in between.
+PURGE_INTERVAL = float(os.getenv("PURGE_INTERVAL", 30))
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", 1000))
+PURGE_PAUSE = float(os.getenv("PURGE_PAUSE", 0.05))
+
+# Accounts deleted by their owner are erased by services.account_service,
+# checked every ACCOUNT_DELETION_INTERVAL seconds, at most
+# ACCOUNT_DELETION_BATCH_SIZE rows per statement with ACCOUNT_DELETION_PAUSE
+# seconds in between, so the requests served meanwhile keep their latency.
+ACCOUNT_DELETION_INTERVAL = float(os.getenv("ACCOUNT_DELETION_INTERVAL", 30))
+ACCOUNT_DELETION_BATCH_SIZE = int(
+    os.getenv("ACCOUNT_DELETION_BATCH_SIZE", 500)
+)
+ACCOUNT_DELETION_PAUSE = float(os.getenv("ACCOUNT_DELETION_PAUSE", 0.1))
+
+# Monthly partitions of tweets and likes on PostgreSQL (see core.partitions),
+# kept by services.partition_service: checked every PARTITION_INTERVAL
+# seconds, PARTITION_MONTHS_AHEAD months are created in advance and, when
+# PARTITION_RETENTION_MONTHS is above 0, the partitions of older months are
+# detached. DDL waits at most PARTITION_LOCK_TIMEOUT seconds for its locks.
+# The media, hashtags and mentions of a partition about to be detached are
+# deleted first, with PARTITION_PAUSE seconds between batches.
+PARTITION_INTERVAL = float(os.getenv("PARTITION_INTERVAL", 3600))
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", 3))
+PARTITION_RETENTION_MONTHS = int(os.getenv("PARTITION_RETENTION_MONTHS", 0))
+PARTITION_LOCK_TIMEOUT = float(os.getenv("PARTITION_LOCK_TIMEOUT", 5))
+PARTITION_PAUSE = float(os.getenv("PARTITION_PAUSE", 0.05))
+
+# Rows fetched per round trip by the server-side cursor of the tweet export.
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 500))
+
+# Tweets carry the LIKE_PREVIEW_SIZE newest likers; the full list is paged
+# LIKES_PAGE_SIZE at a time by default, LIKES_PAGE_MAX at most.
+LIKE_PREVIEW_SIZE = int(os.getenv("LIKE_PREVIEW_SIZE", 3))
+LIKES_PAGE_SIZE = int(os.getenv("LIKES_PAGE_SIZE", 50))
+LIKES_PAGE_MAX = int(os.getenv("LIKES_PAGE_MAX", 200))
+
+# Replies of GET /api/tweets/{id}/thread per page.
+THREAD_PAGE_SIZE = int(os.getenv("THREAD_PAGE_SIZE", 50))
+THREAD_PAGE_MAX = int(os.getenv("THREAD_PAGE_MAX", 200))
+
+# Followers or followed users of GET /api/users/{id}/followers|following per
+# page.
+FOLLOWS_PAGE_SIZE = int(os.getenv("FOLLOWS_PAGE_SIZE", 50))
+FOLLOWS_PAGE_MAX = int(os.getenv("FOLLOWS_PAGE_MAX", 200))
+
+# Tweets of a hashtag or mentioning a user per page.
+TAG_PAGE_SIZE = int(os.getenv("TAG_PAGE_SIZE", 20))
+TAG_PAGE_MAX = int(os.getenv("TAG_PAGE_MAX", 100))
+
+# Users followed or unfollowed by one bulk request at most.
+FOLLOW_BULK_MAX = int(os.getenv("FOLLOW_BULK_MAX", 100))
+
+# Likes and follows are coalesced in memory and written as aggregated
+# notifications every NOTIFY_FLUSH_INTERVAL seconds.
+NOTIFY_FLUSH_INTERVAL = float(os.getenv("NOTIFY_FLUSH_INTERVAL", 1))
+# A group of events is dropped after failing to be written that many times.
+NOTIFY_FLUSH_ATTEMPTS = int(os.getenv("NOTIFY_FLUSH_ATTEMPTS", 5))
+NOTIFICATIONS_PAGE_SIZE = int(os.getenv("NOTIFICATIONS_PAGE_SIZE", 20))
+NOTIFICATIONS_PAGE_MAX = int(os.getenv("NOTIFICATIONS_PAGE_MAX", 100))
+
+# Shared caches keep public responses for CACHE_TTL seconds unless purged
+# earlier through CACHE_PURGER ("local", "http" or "nginx"), see core.cache.
+CACHE_TTL = int(os.getenv("CACHE_TTL", 60))
+CACHE_PURGER = os.getenv("CACHE_PURGER", "local")
+CACHE_PURGE_URL = os.getenv("CACHE_PURGE_URL")
+CACHE_PURGE_TOKEN = os.getenv("CACHE_PURGE_TOKEN")
+
+# Media never attached to a tweet, and stored files without a row, are
+# removed once older than MEDIA_GC_GRACE seconds (see services.gc_service),
+# MEDIA_GC_BATCH_SIZE at a time with MEDIA_GC_PAUSE seconds in between.
+MEDIA_GC_INTERVAL = float(os.getenv("MEDIA_GC_INTERVAL", 300))
+MEDIA_RECONCILE_INTERVAL = float(os.getenv("MEDIA_RECONCILE_INTERVAL", 3600))
+MEDIA_GC_GRACE = int(os.getenv("MEDIA_GC_GRACE", 24 * 3600))
+MEDIA_GC_BATCH_SIZE = int(os.getenv("MEDIA_GC_BATCH_SIZE", 500))
+MEDIA_GC_PAUSE = float(os.getenv("MEDIA_GC_PAUSE", 0.05))
+
+# Ranked tweet lists, see services.ranking_service: score = likes / (age in
+# hours + 2) ^ RANK_GRAVITY, refreshed every RESCORE_INTERVAL seconds for the
+# tweets younger than RESCORE_WINDOW seconds, RESCORE_BATCH_SIZE tweets at a
+# time with RESCORE_PAUSE seconds in between.
+RANK_GRAVITY = float(os.getenv("RANK_GRAVITY", 1.8))
+RESCORE_INTERVAL = float(os.getenv("RESCORE_INTERVAL", 600))
+RESCORE_WINDOW = int(os.getenv("RESCORE_WINDOW", 7 * 24 * 3600))
+RESCORE_BATCH_SIZE = int(os.getenv("RESCORE_BATCH_SIZE", 1000))
+RESCORE_PAUSE = float(os.getenv("RESCORE_PAUSE", 0.05))
+
+# Concurrent identical reads share one query, see core.singleflight; a
+# caller waits at most SINGLE_FLIGHT_TIMEOUT seconds for it.
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", 2))
+
+# Admin routes (api/debug.py) are disabled while ADMIN_TOKEN is unset.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# Sampling profiler, see core.profiling
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 100))
+
+# Event loop monitoring, see core.loop_monitor. Callbacks blocking the loop
+# for more than SLOW_CALLBACK_THRESHOLD seconds are reported, 0 disables the
+# detector (it patches asyncio, keep it for dev and staging).
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+SLOW_CALLBACK_THRESHOLD = float(os.getenv("SLOW_CALLBACK_THRESHOLD", 0))
+
+# Request tracing, see core.tracing. TRACE_EXPORTER is memory, file or otlp.
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "memory")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_URL = os.getenv("TRACE_OTLP_URL", "http://otel-collector:4318")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+TRACE_SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_THRESHOLD", 1.0))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", 5))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", 10000))
+
+# Correction of the denormalized user counters, see services.counter_service,
+# COUNTER_REPAIR_BATCH_SIZE users at a time with COUNTER_REPAIR_PAUSE seconds
+# in between.
+COUNTER_REPAIR_INTERVAL = float(os.getenv("COUNTER_REPAIR_INTERVAL", 3600))
+COUNTER_REPAIR_BATCH_SIZE = int(os.getenv("COUNTER_REPAIR_BATCH_SIZE", 1000))
+COUNTER_REPAIR_PAUSE = float(os.getenv("COUNTER_REPAIR_PAUSE", 0.05))
+
+# PostgreSQL, or SQLite for a single node without a database server, e.g.
+# sqlite+aiosqlite:///twitter.db (see core.database).
+DATABASE_URL = os.getenv(
+    "DATABASE_URL", "postgresql+asyncpg://admin:admin@db:5432/twitter_clone"
+)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "foreign_keys": "ON",
+    "busy_timeout": os.getenv("SQLITE_BUSY_TIMEOUT", "5000"),
+    "cache_size": os.getenv("SQLITE_CACHE_SIZE", "-65536"),
+    "mmap_size": os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    "temp_store": "MEMORY",
+}
+# Seconds a transaction waits for its turn in the SQLite writer queue.
+SQLITE_WRITER_TIMEOUT = float(os.getenv("SQLITE_WRITER_TIMEOUT", 30))
+# Statements kept compiled by SQLAlchemy per engine, and prepared by asyncpg
+# per connection.
+COMPILED_CACHE_SIZE = int(os.getenv("COMPILED_CACHE_SIZE", 1000))
+PREPARED_STATEMENT_CACHE_SIZE = int(
+    os.getenv("PREPARED_STATEMENT_CACHE_SIZE", 500)
+)
+# Extra databases for tweets, likes and media (see core.sharding). Ids below
+# SHARD_ID_FLOOR were minted before sharding and are looked up everywhere.
+SHARD_DATABASE_URLS = [
+    url for url in os.getenv("SHARD_DATABASE_URLS", "").split(",") if url
+]
+SHARD_ID_FLOOR = int(os.getenv("SHARD_ID_FLOOR", 0))
+
+ENGINE_OPTIONS = dict(
+    prepared_statement_cache_size=PREPARED_STATEMENT_CACHE_SIZE,
+    query_cache_size=COMPILED_CACHE_SIZE,
+)
+engine = make_engine(
+    DATABASE_URL,
+    SQLITE_PRAGMAS,
+    SQLITE_WRITER_TIMEOUT,
+    echo=True,
+    **ENGINE_OPTIONS,
+)
+shard_engines = {PRIMARY_SHARD: engine}
+for number, url in enumerate(SHARD_DATABASE_URLS, start=1):
+    shard_engines[str(number)] = make_engine(
+        url, SQLITE_PRAGMAS, SQLITE_WRITER_TIMEOUT, echo=True, **ENGINE_OPTIONS
+    )
+
+async_session = make_session_maker(shard_engines, id_floor=SHARD_ID_FLOOR)
 session = async_session()
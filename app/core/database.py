@@ -0,0 +1,155 @@
+"""
+Database engines for the two supported backends.
+
+DATABASE_URL picks the backend: PostgreSQL through asyncpg for deployments,
+or SQLite through aiosqlite (``sqlite+aiosqlite:///path/to/twitter.db``)
+for a single node without a database server, at the edge or on a laptop.
+On SQLite:
+
+- every connection gets the pragmas of SQLITE_PRAGMAS: WAL, so readers and
+  the writer do not block each other, NORMAL sync, which WAL keeps safe,
+  foreign keys for the cascades, and a page cache and mmap sized for a
+  small server;
+- writes go through a single-writer queue. A transaction takes the writer
+  lock of its database at its first INSERT, UPDATE or DELETE and gives it
+  back at commit or rollback, so concurrent requests wait in line on the
+  event loop instead of failing with "database is locked". Transactions
+  only begin at their first write (the sqlite3 default), so a transaction
+  never writes on a stale snapshot;
+- ``greatest`` and ``power``, built into PostgreSQL, are registered as
+  functions;
+- the schema is created from the models by ``create_schema`` at startup,
+  alembic migrations are for PostgreSQL.
+
+Services stay portable through ``insert_for`` and ``dialect_of``.
+
+On both backends the hot reads execute statements built once at import (see
+tweet_service), so SQLAlchemy finds them in its compiled cache and asyncpg
+reuses its server-side prepared statements, kept per connection by SQL
+text. ``sqlalchemy_compiled_cache_total`` counts the cache lookups of every
+statement sent.
+"""
+import asyncio
+import math
+import re
+from typing import Dict
+
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    create_async_engine,
+)
+from sqlalchemy.util import await_only
+
+from core.metrics import SQL_COMPILED_CACHE
+from core.sharding import router_of
+
+WRITE = re.compile(r"\s*(INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+
+
+def is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+def make_engine(
+    url: str,
+    sqlite_pragmas: Dict[str, str],
+    writer_timeout: float,
+    prepared_statement_cache_size: int = 100,
+    **kwargs,
+) -> AsyncEngine:
+    """Engine for ``url``, set up for single-node use when it is SQLite."""
+    if make_url(url).get_driver_name() == "asyncpg":
+        connect_args = kwargs.setdefault("connect_args", {})
+        connect_args.setdefault(
+            "prepared_statement_cache_size", prepared_statement_cache_size
+        )
+    engine = create_async_engine(url, **kwargs)
+    if is_sqlite(url):
+        configure_sqlite(engine, sqlite_pragmas, writer_timeout)
+    return engine
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_compiled_cache(conn, cursor, statement, parameters, context, many):
+    if context is not None:
+        SQL_COMPILED_CACHE.labels(context.cache_hit.name.lower()).inc()
+
+
+def greatest(*values):
+    return max(value for value in values if value is not None)
+
+
+def configure_sqlite(
+    engine: AsyncEngine, pragmas: Dict[str, str], writer_timeout: float
+):
+    writer = asyncio.Lock()
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def setup_connection(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+        for name, arguments, function in (
+            ("greatest", -1, greatest),
+            ("power", 2, math.pow),
+        ):
+            dbapi_connection.run_async(
+                lambda connection: connection.create_function(
+                    name, arguments, function, deterministic=True
+                )
+            )
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def queue_writer(conn, cursor, statement, parameters, context, many):
+        if conn.info.get("writer") or not WRITE.match(statement):
+            return
+        await_only(asyncio.wait_for(writer.acquire(), writer_timeout))
+        conn.info["writer"] = True
+
+    def release_writer(info: dict):
+        if info.pop("writer", False):
+            writer.release()
+
+    # Both events come before the DBAPI call: the transaction is ended here
+    # already, so the next writer never finds the database still locked.
+    @event.listens_for(engine.sync_engine, "commit")
+    def release_on_commit(conn):
+        if conn.info.get("writer"):
+            conn.connection.commit()
+            release_writer(conn.info)
+
+    @event.listens_for(engine.sync_engine, "rollback")
+    def release_on_rollback(conn):
+        if conn.info.get("writer"):
+            conn.connection.rollback()
+            release_writer(conn.info)
+
+    @event.listens_for(engine.sync_engine.pool, "reset")
+    def release_on_reset(dbapi_connection, connection_record, reset_state):
+        if connection_record.info.get("writer"):
+            dbapi_connection.rollback()
+            release_writer(connection_record.info)
+
+
+async def create_schema(engine: AsyncEngine):
+    """Create the missing tables and indexes of the models."""
+    from db.models import Base
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+def dialect_of(session: AsyncSession) -> str:
+    return router_of(session).dialect
+
+
+def insert_for(session: AsyncSession, table):
+    """INSERT with the ON CONFLICT clauses of the dialect of ``session``."""
+    if dialect_of(session) == "sqlite":
+        return sqlite.insert(table)
+    return postgresql.insert(table)
@@ -0,0 +1,174 @@
+"""
+Visibility into what blocks the event loop.
+
+``monitor_lag`` sleeps LOOP_LAG_INTERVAL seconds in a loop and records how
+late it wakes up in the ``event_loop_lag_seconds`` histogram: the time the
+loop spent running other callbacks instead.
+
+``SlowCallbackDetector``, enabled by SLOW_CALLBACK_THRESHOLD, times every
+callback the loop runs. A watchdog thread captures the stack of the loop
+thread while a callback is still blocking it, so the report shows the line
+that blocks, and the callback's context tells which request scheduled it
+(``LoopMonitorMiddleware`` records it). It patches ``asyncio.Handle``, which
+costs a few microseconds per callback and does nothing under uvloop: meant
+for dev and staging.
+"""
+import asyncio
+import io
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from contextvars import ContextVar
+from typing import Deque, Dict, NamedTuple, Optional
+
+from core.config import LOOP_LAG_INTERVAL, SLOW_CALLBACK_THRESHOLD
+from core.metrics import EVENT_LOOP_LAG, SLOW_CALLBACKS
+
+logger = logging.getLogger(__name__)
+
+# ASGI scope of the request a callback runs for.
+request_scope: ContextVar[Optional[dict]] = ContextVar(
+    "request_scope", default=None
+)
+
+
+async def monitor_lag(interval: float = LOOP_LAG_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(loop.time() - started - interval, 0))
+
+
+def route_of(scope: Optional[dict]) -> str:
+    """``METHOD endpoint`` of a request, once routing matched it."""
+    if scope is None:
+        return "-"
+    endpoint = scope.get("endpoint")
+    target = endpoint.__name__ if endpoint else scope.get("path", "?")
+    return f"{scope.get('method', scope['type'])} {target}"
+
+
+class SlowCallback(NamedTuple):
+    route: str
+    duration: float
+    callback: str
+    stack: str
+
+
+class Running:
+    def __init__(self, handle: asyncio.Handle):
+        self.handle = handle
+        self.started = time.perf_counter()
+        self.stack: Optional[str] = None
+
+
+class SlowCallbackDetector:
+    def __init__(self, threshold: float, keep: int = 100):
+        self.threshold = threshold
+        self.reports: Deque[SlowCallback] = deque(maxlen=keep)
+        self.lock = threading.Lock()
+        # Callback being run by each loop thread.
+        self.running: Dict[int, Running] = {}
+        self.original_run = None
+        self.stopped = threading.Event()
+
+    def install(self):
+        if self.original_run is not None:
+            return
+        original_run = self.original_run = asyncio.Handle._run
+        detector = self
+
+        def _run(handle: asyncio.Handle):
+            thread_id = threading.get_ident()
+            running = Running(handle)
+            with detector.lock:
+                detector.running[thread_id] = running
+            try:
+                original_run(handle)
+            finally:
+                with detector.lock:
+                    del detector.running[thread_id]
+                duration = time.perf_counter() - running.started
+                if duration > detector.threshold:
+                    detector.report(running, duration)
+
+        asyncio.Handle._run = _run
+        self.stopped.clear()
+        threading.Thread(
+            target=self.watch, name="slow-callbacks", daemon=True
+        ).start()
+
+    def uninstall(self):
+        if self.original_run is not None:
+            asyncio.Handle._run = self.original_run
+            self.original_run = None
+            self.stopped.set()
+
+    def watch(self):
+        """Capture the stack of callbacks that are over the threshold."""
+        while not self.stopped.wait(self.threshold / 2):
+            now = time.perf_counter()
+            with self.lock:
+                late = [
+                    (thread_id, running)
+                    for thread_id, running in self.running.items()
+                    if running.stack is None
+                    and now - running.started > self.threshold
+                ]
+                if not late:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, running in late:
+                    if thread_id in frames:
+                        running.stack = "".join(
+                            traceback.format_stack(frames[thread_id])
+                        )
+                del frames
+
+    def report(self, running: Running, duration: float):
+        handle = running.handle
+        route = route_of(handle._context.get(request_scope))
+        stack = running.stack or describe(handle)
+        self.reports.append(SlowCallback(route, duration, repr(handle), stack))
+        SLOW_CALLBACKS.labels(route).inc()
+        logger.warning(
+            "Callback blocked the event loop for %.3f s in %s: %r\n%s",
+            duration,
+            route,
+            handle,
+            stack,
+        )
+
+
+def describe(handle: asyncio.Handle) -> str:
+    """
+    Where the task behind ``handle`` is suspended now, for callbacks that
+    ended before the watchdog caught them.
+    """
+    task = getattr(handle._callback, "__self__", None)
+    if not isinstance(task, asyncio.Task):
+        return ""
+    output = io.StringIO()
+    task.print_stack(file=output)
+    return output.getvalue()
+
+
+slow_callbacks = SlowCallbackDetector(SLOW_CALLBACK_THRESHOLD)
+
+
+class LoopMonitorMiddleware:
+    """Remember the request in the context of every callback it schedules."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        token = request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_scope.reset(token)
@@ -0,0 +1,107 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+PURGED_ROWS = Counter(
+    "purged_rows_total",
+    "Rows removed by the soft-delete purger",
+    ["table"],
+)
+PURGED_FILES = Counter(
+    "purged_media_files_total",
+    "Media files unlinked by the soft-delete purger",
+)
+PURGE_PENDING_TWEETS = Gauge(
+    "purge_pending_tweets",
+    "Soft-deleted tweets still waiting to be purged",
+)
+PURGE_FAILURES = Counter(
+    "purge_failures_total",
+    "Purges of a soft-deleted tweet that failed, retried on the next run",
+)
+PENDING_ACCOUNT_DELETIONS = Gauge(
+    "pending_account_deletions",
+    "Deleted accounts whose rows are still being erased",
+)
+ACCOUNT_DELETION_FAILURES = Counter(
+    "account_deletion_failures_total",
+    "Erasures of a deleted account that failed, retried on the next run",
+)
+ACCOUNT_DELETION_ROWS = Counter(
+    "account_deletion_rows_total",
+    "Rows removed or hidden by the erasure of deleted accounts",
+    ["table"],
+)
+TABLE_PARTITIONS = Gauge(
+    "table_partitions",
+    "Attached monthly partitions of the partitioned tables",
+    ["table"],
+)
+DETACHED_PARTITIONS = Counter(
+    "detached_partitions_total",
+    "Partitions detached past the retention period",
+    ["table"],
+)
+CACHE_PURGED_KEYS = Counter(
+    "cache_purged_keys_total",
+    "Surrogate keys sent to the HTTP cache purger",
+)
+CACHE_PURGE_FAILURES = Counter(
+    "cache_purge_failures_total",
+    "Purge calls to the HTTP cache that failed",
+)
+MEDIA_GC_DELETED = Counter(
+    "media_gc_deleted_total",
+    "Media removed by the orphaned media collector",
+    ["kind"],
+)
+MEDIA_GC_RECLAIMED_BYTES = Counter(
+    "media_gc_reclaimed_bytes_total",
+    "Storage bytes freed by the orphaned media collector",
+    ["source"],
+)
+COUNTER_DRIFT_REPAIRED = Counter(
+    "user_counter_drift_repaired_total",
+    "User counters found out of step with their rows and corrected",
+    ["counter"],
+)
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Delay of a timer callback past its due time, i.e. how long the event "
+    "loop was busy with other callbacks",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+SLOW_CALLBACKS = Counter(
+    "event_loop_slow_callbacks_total",
+    "Callbacks that blocked the event loop longer than the threshold",
+    ["route"],
+)
+NOTIFICATION_EVENTS = Counter(
+    "notification_events_total",
+    "Likes and follows queued for notifications",
+    ["kind"],
+)
+NOTIFICATION_ROWS_WRITTEN = Counter(
+    "notification_rows_written_total",
+    "Aggregated notification rows inserted or bumped by a flush",
+)
+NOTIFICATION_GROUPS_DROPPED = Counter(
+    "notification_groups_dropped_total",
+    "Groups of notification events dropped after failing every write",
+)
+SINGLE_FLIGHT_CALLS = Counter(
+    "single_flight_calls_total",
+    "Calls of coalesced reads: leaders start a query, followers share the "
+    "one in flight, timeouts gave up waiting and queried on their own",
+    ["function", "role"],
+)
+SINGLE_FLIGHT_CALLERS = Histogram(
+    "single_flight_callers",
+    "Callers sharing each coalesced query",
+    ["function"],
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500),
+)
+SQL_COMPILED_CACHE = Counter(
+    "sqlalchemy_compiled_cache_total",
+    "Statements sent to the database by outcome of the compiled cache "
+    "lookup: cache_hit, cache_miss, no_cache_key, ...",
+    ["result"],
+)
@@ -0,0 +1,266 @@
+"""
+Monthly range partitions of tweets and likes.
+
+Ids are snowflakes whose high bits are the creation time, so the range of
+ids minted during a month is the month itself: tweets are partitioned on
+id and likes on tweet_id, which keeps the likes of a tweet in the partition
+of the same month as the tweet. No created_at column is needed, primary and
+foreign keys on tweets.id stay as they were, and every query bounded by an
+id, a tweet_id or an id range is pruned to the partitions it can match.
+
+The migration turns the existing tables into partitioned ones with
+``partition_table``: the old table becomes the partition of everything
+before the next month. services.partition_service then keeps
+PARTITION_MONTHS_AHEAD months of partitions created in advance and detaches
+the partitions older than PARTITION_RETENTION_MONTHS, if set. Detached
+partitions stay in the database as plain tables, for archiving.
+
+A unique index without the partition key cannot span partitions: those of
+LOCAL_UNIQUE_INDEXES are created on each partition, so they hold within a
+month and the services check across months.
+
+PostgreSQL only. On SQLite, and on databases created from the models as in
+the tests, the tables are plain.
+"""
+import re
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from core.snowflake import min_id_at
+
+# Partitioned tables and their partition key, referenced tables first.
+PARTITION_KEYS = {"tweets": "id", "likes": "tweet_id"}
+# Name and definition of the unique indexes kept per partition.
+LOCAL_UNIQUE_INDEXES: Dict[str, List[Tuple[str, str]]] = {
+    "tweets": [
+        (
+            "ix_tweets_user_id_retweet_of_id",
+            "(user_id, retweet_of_id) "
+            "WHERE retweet_of_id IS NOT NULL AND deleted_at IS NULL",
+        )
+    ],
+}
+BOUNDS = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+TABLE_INDEXES_SQL = """
+    SELECT indexname, indexdef FROM pg_indexes
+    WHERE schemaname = current_schema() AND tablename = :table
+"""
+TABLE_CONSTRAINTS_SQL = """
+    SELECT conname, CAST(contype AS text), pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE conrelid = CAST(:table AS regclass) AND contype IN ('p', 'u', 'f')
+        AND conparentid = 0
+"""
+REFERENCES_SQL = """
+    SELECT CAST(CAST(conrelid AS regclass) AS text), conname,
+        pg_get_constraintdef(oid)
+    FROM pg_constraint
+    WHERE confrelid = CAST(:table AS regclass) AND contype = 'f'
+        AND conparentid = 0 AND conrelid <> confrelid
+"""
+PARTITIONS_SQL = """
+    SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+    FROM pg_inherits
+    JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+    WHERE pg_inherits.inhparent = CAST(:table AS regclass)
+"""
+
+
+class Partition(NamedTuple):
+    name: str
+    # Ids from lower, None for no bound, to upper excluded.
+    lower: Optional[int]
+    upper: int
+
+
+def month_start(moment: datetime, months: int = 0) -> datetime:
+    """First instant of the month of ``moment``, ``months`` months later."""
+    month = moment.year * 12 + moment.month - 1 + months
+    return datetime(month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(table: str, month: datetime) -> str:
+    return f"{table}_p{month:%Y%m}"
+
+
+def is_partitioned(conn: Connection, table: str) -> bool:
+    return bool(
+        conn.execute(
+            text(
+                "SELECT 1 FROM pg_partitioned_table "
+                "WHERE partrelid = to_regclass(:table)"
+            ),
+            {"table": table},
+        ).scalar()
+    )
+
+
+def list_partitions(conn: Connection, table: str) -> List[Partition]:
+    """Partitions of ``table``, in id order."""
+    partitions = []
+    for name, bound in conn.execute(text(PARTITIONS_SQL), {"table": table}):
+        lower, upper = (
+            None if value == "MINVALUE" else int(value.strip("'"))
+            for value in BOUNDS.search(bound).groups()
+        )
+        partitions.append(Partition(name, lower, upper))
+    return sorted(partitions, key=lambda partition: partition.upper)
+
+
+def create_partition(conn: Connection, table: str, month: datetime) -> str:
+    """Create the partition of ``table`` holding the ids of ``month``."""
+    name = partition_name(table, month)
+    lower, upper = min_id_at(month), min_id_at(month_start(month, 1))
+    conn.execute(
+        text(
+            f"CREATE TABLE {name} PARTITION OF {table} "
+            f"FOR VALUES FROM ({lower}) TO ({upper})"
+        )
+    )
+    for index, definition in LOCAL_UNIQUE_INDEXES.get(table, ()):
+        local = index.replace(table, name, 1)
+        conn.execute(
+            text(f"CREATE UNIQUE INDEX {local} ON {name} {definition}")
+        )
+    return name
+
+
+def create_partitions(
+    conn: Connection, table: str, now: datetime, months_ahead: int
+) -> List[str]:
+    """
+    Create the monthly partitions of ``table`` missing after its last one,
+    up to ``months_ahead`` months after the month of ``now``.
+    """
+    partitions = list_partitions(conn, table)
+    month = month_start(now)
+    if partitions:
+        while min_id_at(month) < partitions[-1].upper:
+            month = month_start(month, 1)
+    created = []
+    while month <= month_start(now, months_ahead):
+        created.append(create_partition(conn, table, month))
+        month = month_start(month, 1)
+    return created
+
+
+def expired_partitions(
+    conn: Connection, table: str, before: datetime
+) -> List[Partition]:
+    """Partitions of ``table`` holding only ids minted before ``before``."""
+    return [
+        partition
+        for partition in list_partitions(conn, table)
+        if partition.upper <= min_id_at(before)
+    ]
+
+
+def detach_partition(conn: Connection, table: str, name: str):
+    conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+
+
+def key_columns(definition: str) -> str:
+    return definition.split("(", 1)[1].split(")", 1)[0]
+
+
+def partition_table(conn: Connection, table: str, upper: int):
+    """
+    Turn ``table`` into a table partitioned by range of its partition key.
+    The existing table is renamed ``<table>_legacy`` and becomes the
+    partition of every id below ``upper``; its indexes are kept and
+    attached to those of the new table. Foreign keys to ``table`` are
+    moved to the new table.
+    """
+    key = PARTITION_KEYS[table]
+    legacy = f"{table}_legacy"
+    parameters = {"table": table}
+    indexes = conn.execute(text(TABLE_INDEXES_SQL), parameters).all()
+    constraints = conn.execute(text(TABLE_CONSTRAINTS_SQL), parameters).all()
+    references = conn.execute(text(REFERENCES_SQL), parameters).all()
+    constraint_names = {name for name, _, _ in constraints}
+
+    for referencing, name, _ in references:
+        conn.execute(text(f"ALTER TABLE {referencing} DROP CONSTRAINT {name}"))
+    conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+    for name, _ in indexes:
+        conn.execute(text(f"ALTER INDEX {name} RENAME TO {name}_legacy"))
+    # Cloned from the new table on attach instead: foreign keys merged into
+    # those of the parent cannot be detached again on some PostgreSQL
+    # releases.
+    for name, kind, _ in constraints:
+        if kind == "f":
+            conn.execute(text(f"ALTER TABLE {legacy} DROP CONSTRAINT {name}"))
+
+    conn.execute(
+        text(
+            f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) "
+            f"PARTITION BY RANGE ({key})"
+        )
+    )
+    for name, kind, definition in constraints:
+        if kind == "f" or key in key_columns(definition).split(", "):
+            conn.execute(
+                text(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+            )
+    local = {name for name, _ in LOCAL_UNIQUE_INDEXES.get(table, ())}
+    for name, definition in indexes:
+        if name not in constraint_names and name not in local:
+            conn.execute(text(definition))
+    conn.execute(
+        text(
+            f"ALTER TABLE {table} ATTACH PARTITION {legacy} "
+            f"FOR VALUES FROM (MINVALUE) TO ({upper})"
+        )
+    )
+    for referencing, name, definition in references:
+        conn.execute(
+            text(
+                f"ALTER TABLE {referencing} ADD CONSTRAINT {name} {definition}"
+            )
+        )
+
+
+def unpartition_table(conn: Connection, table: str):
+    """
+    Copy a partitioned ``table`` back into a plain table, the reverse of
+    partition_table. Detached partitions are left alone.
+    """
+    partitioned = f"{table}_partitioned"
+    parameters = {"table": table}
+    indexes = conn.execute(text(TABLE_INDEXES_SQL), parameters).all()
+    constraints = conn.execute(text(TABLE_CONSTRAINTS_SQL), parameters).all()
+    references = conn.execute(text(REFERENCES_SQL), parameters).all()
+    constraint_names = {name for name, _, _ in constraints}
+
+    for referencing, name, _ in references:
+        conn.execute(text(f"ALTER TABLE {referencing} DROP CONSTRAINT {name}"))
+    conn.execute(text(f"ALTER TABLE {table} RENAME TO {partitioned}"))
+    for name, _ in indexes:
+        conn.execute(text(f"ALTER INDEX {name} RENAME TO {name}_partitioned"))
+
+    conn.execute(
+        text(f"CREATE TABLE {table} (LIKE {partitioned} INCLUDING DEFAULTS)")
+    )
+    conn.execute(text(f"INSERT INTO {table} SELECT * FROM {partitioned}"))
+    for name, _, definition in constraints:
+        conn.execute(
+            text(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+        )
+    for name, definition in indexes:
+        if name not in constraint_names:
+            conn.execute(text(definition))
+    for name, definition in LOCAL_UNIQUE_INDEXES.get(table, ()):
+        conn.execute(
+            text(f"CREATE UNIQUE INDEX {name} ON {table} {definition}")
+        )
+    conn.execute(text(f"DROP TABLE {partitioned}"))
+    for referencing, name, definition in references:
+        conn.execute(
+            text(
+                f"ALTER TABLE {referencing} ADD CONSTRAINT {name} {definition}"
+            )
+        )
@@ -0,0 +1,238 @@
+"""
+Sampling profiler for the live worker.
+
+A daemon thread wakes up every PROFILE_INTERVAL seconds, reads the stack of
+the event loop thread with ``sys._current_frames()`` and counts it. Nothing
+is traced between samples, so a running profile costs a few percent of one
+core and an idle profiler costs nothing: the thread exits when no profile
+is active.
+
+Two ways to use it, both guarded by ADMIN_TOKEN (see api/debug.py):
+
+- ``GET /debug/profile?seconds=N`` samples the whole worker for N seconds;
+- a request sent with ``X-Profile: 1`` is profiled alone: only the samples
+  taken while its own coroutine runs are kept. The response carries an
+  ``X-Profile-Id`` to fetch the result from ``GET /debug/profile/{id}``.
+
+Results come as collapsed stacks, one ``frame;frame;frame count`` line per
+stack as read by flamegraph.pl and speedscope, or as an SVG flamegraph.
+"""
+import hashlib
+import hmac
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from html import escape
+from types import FrameType
+from typing import Dict, List, Optional, Set
+from uuid import uuid4
+
+from core.config import ADMIN_TOKEN, PROFILE_INTERVAL, PROFILE_KEEP
+from core.exceptions import BackendException
+
+FLAMEGRAPH_WIDTH = 1200
+FRAME_HEIGHT = 16
+FONT_SIZE = 11
+# Roughly how many pixels a character of the frame labels takes.
+CHAR_WIDTH = 6.5
+
+
+def check_admin(token: Optional[str]):
+    if not ADMIN_TOKEN or not hmac.compare_digest(
+        (token or "").encode(), ADMIN_TOKEN.encode()
+    ):
+        raise BackendException(
+            error_type="FORBIDDEN", error_message="Admin token required"
+        )
+
+
+def frame_name(frame: FrameType) -> str:
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module}:{frame.f_code.co_name}"
+
+
+class Profile:
+    def __init__(self, thread_id: int, marker: Optional[FrameType] = None):
+        self.thread_id = thread_id
+        # Only stacks going through this frame are counted.
+        self.marker = marker
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started = time.monotonic()
+        self.duration = 0.0
+
+    def add(self, frames: List[FrameType]):
+        if self.marker is not None and not any(
+            frame is self.marker for frame in frames
+        ):
+            return
+        self.samples += 1
+        self.stacks[
+            ";".join(frame_name(frame) for frame in reversed(frames))
+        ] += 1
+
+    def collapsed(self) -> str:
+        return "".join(
+            f"{stack} {count}\n"
+            for stack, count in sorted(self.stacks.items())
+        )
+
+    def flamegraph(self, title: str = "Flame graph") -> str:
+        return render_flamegraph(self.stacks, title)
+
+
+class Sampler:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.profiles: Set[Profile] = set()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self, marker: Optional[FrameType] = None) -> Profile:
+        """Start profiling the calling thread, the event loop."""
+        profile = Profile(threading.get_ident(), marker)
+        with self.lock:
+            self.profiles.add(profile)
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="profiler", daemon=True
+                )
+                self.thread.start()
+        return profile
+
+    def stop(self, profile: Profile) -> Profile:
+        with self.lock:
+            self.profiles.discard(profile)
+        profile.duration = time.monotonic() - profile.started
+        return profile
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.profiles:
+                    self.thread = None
+                    return
+                current = sys._current_frames()
+                for profile in self.profiles:
+                    frame = current.get(profile.thread_id)
+                    frames = []
+                    while frame is not None:
+                        frames.append(frame)
+                        frame = frame.f_back
+                    if frames:
+                        profile.add(frames)
+                del current
+
+
+sampler = Sampler(PROFILE_INTERVAL)
+# Profiles of single requests, by X-Profile-Id, the oldest dropped first.
+recent: "OrderedDict[str, Profile]" = OrderedDict()
+
+
+def keep(profile: Profile) -> str:
+    profile_id = uuid4().hex
+    recent[profile_id] = profile
+    while len(recent) > PROFILE_KEEP:
+        recent.popitem(last=False)
+    return profile_id
+
+
+def frame_color(name: str) -> str:
+    """Warm color, stable for a frame name across flamegraphs."""
+    digest = hashlib.md5(name.encode()).digest()
+    return f"rgb({205 + digest[0] % 50},{digest[1] % 230},{digest[2] % 55})"
+
+
+def render_flamegraph(stacks: Dict[str, int], title: str) -> str:
+    """
+    SVG flamegraph of collapsed stacks: callers at the bottom, every frame
+    as wide as the share of samples it appears in.
+    """
+    root: dict = {"count": 0, "children": {}}
+    for stack, count in stacks.items():
+        root["count"] += count
+        node = root
+        for name in stack.split(";"):
+            node = node["children"].setdefault(
+                name, {"count": 0, "children": {}}
+            )
+            node["count"] += count
+
+    def depth(node: dict) -> int:
+        return 1 + max(map(depth, node["children"].values()), default=0)
+
+    levels = depth(root) - 1
+    height = (levels + 2) * FRAME_HEIGHT
+    scale = FLAMEGRAPH_WIDTH / max(root["count"], 1)
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" '
+        f'width="{FLAMEGRAPH_WIDTH}" height="{height}" '
+        f'font-family="monospace" font-size="{FONT_SIZE}">',
+        f'<text x="4" y="{FRAME_HEIGHT - 4}">{escape(title)} '
+        f'({root["count"]} samples)</text>',
+    ]
+
+    def draw(node: dict, x: float, level: int):
+        for name, child in sorted(node["children"].items()):
+            width = child["count"] * scale
+            y = height - (level + 1) * FRAME_HEIGHT
+            label = escape(name)
+            parts.append(
+                f'<g><title>{label} ({child["count"]} samples)</title>'
+                f'<rect x="{x:.1f}" y="{y}" width="{width:.1f}" '
+                f'height="{FRAME_HEIGHT - 1}" fill="{frame_color(name)}"/>'
+            )
+            chars = int(width / CHAR_WIDTH)
+            if chars >= 3:
+                text = name if len(name) <= chars else name[: chars - 2] + ".."
+                parts.append(
+                    f'<text x="{x + 2:.1f}" y="{y + FRAME_HEIGHT - 4}">'
+                    f"{escape(text)}</text>"
+                )
+            parts.append("</g>")
+            draw(child, x, level + 1)
+            x += width
+
+    draw(root, 0.0, 0)
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+class ProfilingMiddleware:
+    """
+    Profile the requests sent with ``X-Profile: 1`` and a valid
+    ``X-Admin-Token``. A plain ASGI middleware, so the endpoint runs in the
+    coroutine whose frame marks the samples of the request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if headers.get(b"x-profile") != b"1":
+            return await self.app(scope, receive, send)
+        try:
+            check_admin(headers.get(b"x-admin-token", b"").decode())
+        except BackendException:
+            return await self.app(scope, receive, send)
+
+        profile = sampler.start(marker=sys._getframe())
+        profile_id = keep(profile)
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-profile-id", profile_id.encode()),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.stop(profile)
@@ -0,0 +1,245 @@
+"""
+Shard routing for tweets, likes and media.
+
+Users and follows live on the primary shard "0". Tweets are placed by their
+author: ``user_id % SHARD_BUCKETS`` picks a bucket and buckets are spread
+over the configured databases. Likes, media, hashtags and mentions sit next
+to their tweet. Every tweet, like and media id carries its bucket (see
+core.snowflake), so a lookup by id goes straight to one database. Ids minted
+before sharding was enabled are below ``id_floor`` and are looked up on
+every shard.
+
+Each shard also holds a reference copy (id and name) of every user, which
+keeps the foreign keys and author joins local.
+"""
+import asyncio
+import heapq
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import Insert, Select
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.ext.horizontal_shard import ShardedSession, set_shard_id
+from sqlalchemy.orm import ORMExecuteState, sessionmaker
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BindParameter, ColumnClause
+from sqlalchemy.sql.util import find_tables
+
+from core.snowflake import SHARD_BUCKETS, bucket_of
+
+PRIMARY_SHARD = "0"
+SHARDED_TABLES = {
+    "tweets",
+    "likes",
+    "medias",
+    "tweet_hashtags",
+    "tweet_mentions",
+}
+
+# Columns whose value decides the shard of a row: ids that carry a bucket,
+# and user ids whose bucket places the row.
+ID_KEYS = {
+    ("tweets", "id"),
+    ("likes", "tweet_id"),
+    ("medias", "id"),
+    ("medias", "tweet_id"),
+    ("tweet_hashtags", "tweet_id"),
+    ("tweet_mentions", "tweet_id"),
+}
+USER_KEYS = {("tweets", "user_id"), ("medias", "user_id")}
+
+
+class ShardRouter:
+    def __init__(self, shard_ids: List[str], id_floor: int = 0):
+        self.shard_ids = shard_ids
+        self.id_floor = id_floor
+        self.session_maker: Optional[sessionmaker] = None
+        # Name of the SQL dialect of the shards, see core.database.
+        self.dialect = "postgresql"
+
+    def for_bucket(self, bucket: int) -> str:
+        return self.shard_ids[bucket % len(self.shard_ids)]
+
+    def for_user(self, user_id: int) -> str:
+        return self.for_bucket(bucket_for_user(user_id))
+
+    def for_id(self, snowflake_id: int) -> Optional[str]:
+        """Shard of a tweet/like/media id, None if it predates sharding."""
+        if len(self.shard_ids) == 1:
+            return PRIMARY_SHARD
+        if snowflake_id < self.id_floor:
+            return None
+        return self.for_bucket(bucket_of(snowflake_id))
+
+    def shards_for_statement(
+        self, statement, parameters: Optional[Dict[str, Any]]
+    ) -> List[str]:
+        tables = {
+            getattr(table, "name", None)
+            for table in find_tables(
+                statement,
+                include_crud=True,
+                include_joins=True,
+                check_columns=True,
+            )
+        }
+        if not tables & SHARDED_TABLES:
+            return [PRIMARY_SHARD]
+
+        if isinstance(statement, Insert):
+            values = dict(statement.compile().params)
+            values.update(parameters or {})
+            shard = self.shard_for_values(statement.table.name, values)
+            if shard is None:
+                raise ValueError(
+                    f"Insert into {statement.table.name} needs a shard_id"
+                )
+            return [shard]
+
+        shards = self.shards_for_criteria(statement, parameters or {})
+        return sorted(shards) if shards else self.shard_ids
+
+    def shard_for_values(
+        self, table: str, values: Dict[str, Any]
+    ) -> Optional[str]:
+        for column, value in values.items():
+            if value is None:
+                continue
+            shard = None
+            if (table, column) in ID_KEYS:
+                shard = self.for_id(value)
+            elif (table, column) in USER_KEYS:
+                shard = self.for_user(value)
+            if shard is not None:
+                return shard
+        return None
+
+    def shards_for_criteria(
+        self, statement, parameters: Dict[str, Any]
+    ) -> Set[str]:
+        """
+        Collect shards named by ``column == value`` / ``column IN values``
+        comparisons on a routing column. An empty set means "all shards".
+        """
+        shards: Set[str] = set()
+        for element in visitors.iterate(statement):
+            if element.__visit_name__ != "binary":
+                continue
+            column, bind = element.left, element.right
+            if not (
+                isinstance(column, ColumnClause)
+                and isinstance(bind, BindParameter)
+                and element.operator in (operators.eq, operators.in_op)
+                and column.table is not None
+            ):
+                continue
+
+            key = (column.table.name, column.name)
+            if key not in ID_KEYS | USER_KEYS:
+                continue
+            value = parameters.get(bind.key, bind.value)
+            values = value if element.operator is operators.in_op else [value]
+            for item in values or ():
+                shard = self.shard_for_values(key[0], {key[1]: item})
+                if shard is None:
+                    return set()
+                shards.add(shard)
+        return shards
+
+    def shard_chooser(self, mapper, instance, clause=None, **kw) -> str:
+        if instance is None or mapper.local_table.name not in SHARDED_TABLES:
+            return PRIMARY_SHARD
+        values = {
+            column.key: getattr(instance, column.key, None)
+            for column in mapper.local_table.columns
+        }
+        shard = self.shard_for_values(mapper.local_table.name, values)
+        if shard is None:
+            raise ValueError(f"Can't choose a shard for {instance!r}")
+        return shard
+
+    def identity_chooser(self, mapper, primary_key, **kw) -> List[str]:
+        if mapper.local_table.name not in SHARDED_TABLES:
+            return [PRIMARY_SHARD]
+        shard = self.for_id(primary_key[0])
+        return [shard] if shard is not None else self.shard_ids
+
+    def execute_chooser(self, orm_context: ORMExecuteState) -> List[str]:
+        parameters = orm_context.parameters
+        if isinstance(parameters, list):
+            parameters = parameters[0] if parameters else None
+        return self.shards_for_statement(orm_context.statement, parameters)
+
+
+class RoutingSession(ShardedSession):
+    def __init__(self, router: ShardRouter, **kwargs):
+        super().__init__(
+            shard_chooser=router.shard_chooser,
+            identity_chooser=router.identity_chooser,
+            execute_chooser=router.execute_chooser,
+            **kwargs,
+        )
+        self.router = router
+
+
+def bucket_for_user(user_id: int) -> int:
+    return user_id % SHARD_BUCKETS
+
+
+def make_session_maker(
+    engines: Dict[str, AsyncEngine], id_floor: int = 0
+) -> sessionmaker:
+    """
+    Build an AsyncSession factory routing over ``engines``. The key of the
+    primary engine must be PRIMARY_SHARD.
+    """
+    router = ShardRouter(list(engines), id_floor=id_floor)
+    router.dialect = engines[PRIMARY_SHARD].dialect.name
+    router.session_maker = sessionmaker(
+        class_=AsyncSession,
+        sync_session_class=RoutingSession,
+        expire_on_commit=False,
+        router=router,
+        shards={
+            shard_id: engine.sync_engine
+            for shard_id, engine in engines.items()
+        },
+    )
+    return router.session_maker
+
+
+def router_of(session: AsyncSession) -> ShardRouter:
+    return session.sync_session.router
+
+
+def on_shard(shard_id: str) -> Dict[str, str]:
+    """``bind_arguments`` pinning a statement to one shard."""
+    return {"shard_id": shard_id}
+
+
+async def scatter_gather(
+    session: AsyncSession,
+    statement: Select,
+    key: Callable[[Any], Any],
+    reverse: bool = False,
+    limit: Optional[int] = None,
+    shard_ids: Optional[Iterable[str]] = None,
+) -> List[Any]:
+    """
+    Run ``statement`` on every shard concurrently, each in its own session,
+    and merge the per-shard results, already sorted by ``key``, into one
+    list of at most ``limit`` scalars.
+    """
+    router = router_of(session)
+
+    async def fetch(shard_id: str) -> List[Any]:
+        async with router.session_maker() as shard_session:
+            result = await shard_session.execute(
+                statement.options(set_shard_id(shard_id))
+            )
+            return result.scalars().all()
+
+    results = await asyncio.gather(
+        *(fetch(shard_id) for shard_id in shard_ids or router.shard_ids)
+    )
+    return list(islice(heapq.merge(*results, key=key, reverse=reverse), limit))
@@ -0,0 +1,114 @@
+"""
+Coalescing of identical concurrent reads.
+
+A read service decorated with ``@single_flight`` runs once for all the
+callers asking for the same thing at the same time: the first caller starts
+a flight, callers with the same arguments arriving before it lands share
+its result (or its exception). A hot tweet then costs one set of queries
+per round trip instead of one per request.
+
+The flight is a task of its own with its own session, so a caller that goes
+away (a client disconnecting cancels its request) neither cancels the
+flight of the others nor closes a session the flight still uses. Callers
+wait at most SINGLE_FLIGHT_TIMEOUT seconds: past that, the key is released
+for the next callers and the late caller runs the read on its own session.
+
+The result comes from a read that started before the caller arrived, at
+most one round trip earlier: fine for the public reads it wraps, not for
+reading one's own writes inside a transaction.
+"""
+import asyncio
+import functools
+import inspect
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from core.config import SINGLE_FLIGHT_TIMEOUT
+from core.metrics import SINGLE_FLIGHT_CALLERS, SINGLE_FLIGHT_CALLS
+from core.sharding import router_of
+
+
+class FlightTimeout(Exception):
+    pass
+
+
+class Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.callers = 1
+
+
+class SingleFlight:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.flights: Dict[Hashable, Flight] = {}
+
+    async def do(
+        self, key: Hashable, compute: Callable[[], Awaitable], name: str
+    ) -> Any:
+        """
+        Result of ``compute()``, shared with the concurrent callers of the
+        same key. Raises FlightTimeout when the flight takes too long.
+        """
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = Flight(asyncio.ensure_future(compute()))
+            self.flights[key] = flight
+            flight.task.add_done_callback(
+                functools.partial(self.land, key, flight, name)
+            )
+            SINGLE_FLIGHT_CALLS.labels(name, "leader").inc()
+        else:
+            flight.callers += 1
+            SINGLE_FLIGHT_CALLS.labels(name, "follower").inc()
+
+        # Unlike wait_for, wait neither cancels the flight when it times
+        # out nor when this caller is cancelled.
+        done, _ = await asyncio.wait({flight.task}, timeout=self.timeout)
+        if not done:
+            self.release(key, flight)
+            SINGLE_FLIGHT_CALLS.labels(name, "timeout").inc()
+            raise FlightTimeout(key)
+        return flight.task.result()
+
+    def release(self, key: Hashable, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def land(self, key: Hashable, flight: Flight, name: str, task):
+        self.release(key, flight)
+        SINGLE_FLIGHT_CALLERS.labels(name).observe(flight.callers)
+        if not task.cancelled():
+            # Retrieved even when every caller has gone away.
+            task.exception()
+
+
+flights = SingleFlight(SINGLE_FLIGHT_TIMEOUT)
+
+
+def single_flight(function):
+    """
+    Coalesce concurrent calls of a read service with equal arguments. The
+    service takes a ``session``; every other argument is part of the key.
+    """
+    name = f"{function.__module__.rpartition('.')[2]}.{function.__name__}"
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        session = arguments.pop("session")
+        key = (name, *sorted(arguments.items()))
+
+        async def compute():
+            session_maker = router_of(session).session_maker
+            async with session_maker() as flight_session:
+                return await function(session=flight_session, **arguments)
+
+        try:
+            return await flights.do(key, compute, name)
+        except FlightTimeout:
+            return await function(session=session, **arguments)
+
+    return wrapper
@@ -0,0 +1,149 @@
+"""
+Time-ordered ids for tweets, likes and media.
+
+An id is ``timestamp | shard | worker | sequence``: milliseconds since
+EPOCH_MS, the shard bucket the row is placed in (see core.sharding), the id
+of the process that generated it, and a per-millisecond counter. The layout
+is kept within 53 bits so that the ids survive a round trip through the
+JavaScript client, which parses them as plain numbers.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+EPOCH_MS = 1672531200000  # 2023-01-01T00:00:00Z
+
+TIMESTAMP_BITS = 41
+SHARD_BITS = 4
+WORKER_BITS = 3
+SEQUENCE_BITS = 5
+
+SHARD_BUCKETS = 1 << SHARD_BITS
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+WORKER_SHIFT = SEQUENCE_BITS
+SHARD_SHIFT = SEQUENCE_BITS + WORKER_BITS
+TIMESTAMP_SHIFT = SEQUENCE_BITS + WORKER_BITS + SHARD_BITS
+
+# pg_try_advisory_lock(ADVISORY_LOCK_NAMESPACE, worker_id) guards a worker id
+ADVISORY_LOCK_NAMESPACE = 0x5F1A
+
+
+class SnowflakeGenerator:
+    def __init__(self, worker_id: int):
+        self.lock = threading.Lock()
+        self.last_timestamp = -1
+        self.sequence = 0
+        self.worker_id = 0
+        self.set_worker_id(worker_id)
+
+    def set_worker_id(self, worker_id: int):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker id must be in 0..{MAX_WORKER_ID}")
+        with self.lock:
+            self.worker_id = worker_id
+
+    @staticmethod
+    def now() -> int:
+        return time.time_ns() // 1_000_000 - EPOCH_MS
+
+    def next_id(self, bucket: int = 0) -> int:
+        with self.lock:
+            timestamp = self.now()
+            # Never go back in time, even if the wall clock does.
+            timestamp = max(timestamp, self.last_timestamp)
+            if timestamp == self.last_timestamp:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    while timestamp <= self.last_timestamp:
+                        timestamp = self.now()
+            else:
+                self.sequence = 0
+            self.last_timestamp = timestamp
+
+            return (
+                (timestamp << TIMESTAMP_SHIFT)
+                | ((bucket % SHARD_BUCKETS) << SHARD_SHIFT)
+                | (self.worker_id << WORKER_SHIFT)
+                | self.sequence
+            )
+
+
+generator = SnowflakeGenerator(
+    int(os.getenv("WORKER_ID", os.getpid() % (MAX_WORKER_ID + 1)))
+)
+_lease: Optional[AsyncConnection] = None
+
+
+def next_id(bucket: int = 0) -> int:
+    return generator.next_id(bucket)
+
+
+def make_id(
+    milliseconds: int, bucket: int = 0, worker_id: int = 0, sequence: int = 0
+) -> int:
+    """Id minted at ``milliseconds`` since the Unix epoch, for bulk loads."""
+    return (
+        ((milliseconds - EPOCH_MS) << TIMESTAMP_SHIFT)
+        | ((bucket % SHARD_BUCKETS) << SHARD_SHIFT)
+        | ((worker_id & MAX_WORKER_ID) << WORKER_SHIFT)
+        | (sequence & MAX_SEQUENCE)
+    )
+
+
+def bucket_of(snowflake_id: int) -> int:
+    return (snowflake_id >> SHARD_SHIFT) & (SHARD_BUCKETS - 1)
+
+
+def timestamp_of(snowflake_id: int) -> datetime:
+    """Creation time encoded in an id."""
+    milliseconds = (snowflake_id >> TIMESTAMP_SHIFT) + EPOCH_MS
+    return datetime.fromtimestamp(milliseconds / 1000, tz=timezone.utc)
+
+
+def min_id_at(moment: datetime) -> int:
+    """Smallest id that can be generated at ``moment`` or later."""
+    milliseconds = int(moment.timestamp() * 1000) - EPOCH_MS
+    return max(milliseconds, 0) << TIMESTAMP_SHIFT
+
+
+async def claim_worker_id(engine: AsyncEngine) -> int:
+    """
+    Lease a worker id that no other process connected to the same database
+    holds, so several uvicorn workers never mint the same id.
+
+    The lease is a session-level advisory lock and lives as long as the
+    connection kept in ``_lease``. An explicit WORKER_ID setting wins. SQLite
+    has no advisory locks: a single process keeps the default worker id,
+    several processes sharing a database file need WORKER_ID each.
+    """
+    global _lease
+    if "WORKER_ID" in os.environ or engine.dialect.name == "sqlite":
+        return generator.worker_id
+
+    connection = await engine.connect()
+    for worker_id in range(MAX_WORKER_ID + 1):
+        result = await connection.execute(
+            text("SELECT pg_try_advisory_lock(:namespace, :worker_id)"),
+            {"namespace": ADVISORY_LOCK_NAMESPACE, "worker_id": worker_id},
+        )
+        if result.scalar():
+            await connection.commit()
+            generator.set_worker_id(worker_id)
+            _lease = connection
+            return worker_id
+
+    await connection.close()
+    raise RuntimeError("All snowflake worker ids are taken")
+
+
+async def release_worker_id():
+    global _lease
+    if _lease is not None:
+        await _lease.close()
+        _lease = None
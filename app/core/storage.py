@@ -0,0 +1,446 @@
+"""
+Where media files live.
+
+``LocalStorage`` keeps files under OUT_PATH, served by nginx from a shared
+volume. ``S3Storage`` talks to any S3-compatible object store (AWS, MinIO,
+Ceph...) with requests signed by AWS Signature Version 4, so the app can run
+on any number of hosts.
+
+Both backends hand out presigned uploads: the client sends the bytes straight
+to the returned URL and the app only records the metadata. With S3 that URL
+points to the object store; the local backend accepts the upload itself on
+``PUT /api/medias/uploads/{key}``.
+"""
+import asyncio
+import hashlib
+import hmac
+import os
+import time
+import xml.etree.ElementTree as ElementTree
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from itertools import islice
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional
+from urllib.parse import quote, urlsplit
+from uuid import uuid4
+
+import aiofiles
+import aiofiles.os
+import httpx
+
+from core.config import (
+    MEDIA_PATH,
+    OUT_PATH,
+    S3_ACCESS_KEY,
+    S3_BUCKET,
+    S3_ENDPOINT_URL,
+    S3_PUBLIC_URL,
+    S3_REGION,
+    S3_SECRET_KEY,
+    STORAGE_BACKEND,
+    STORAGE_SECRET,
+)
+from core.tracing import span
+
+UPLOAD_PATH = "/api/medias/uploads/"
+REQUEST_TIMEOUT = 30.0
+LIST_PAGE_SIZE = 1000
+S3_NAMESPACE = {"s3": "http://s3.amazonaws.com/doc/2006-03-01/"}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class StoredObject(NamedTuple):
+    key: str
+    size: int
+    modified: datetime
+
+
+def new_key(filename: str) -> str:
+    """Random object key keeping the extension of the uploaded file."""
+    return uuid4().hex + os.path.splitext(filename)[1].lower()
+
+
+class Storage(ABC):
+    @abstractmethod
+    def url(self, key: str) -> str:
+        """Public URL of an object, stored as the media name."""
+
+    @abstractmethod
+    async def save(self, key: str, data: bytes, content_type: str):
+        """Store ``data`` as ``key``, replacing any previous object."""
+
+    @abstractmethod
+    async def size(self, key: str) -> Optional[int]:
+        """Size of an object in bytes, None if it does not exist."""
+
+    @abstractmethod
+    async def delete(self, key: str):
+        """Delete an object, a missing one is not an error."""
+
+    @abstractmethod
+    def list_objects(self) -> AsyncIterator[List[StoredObject]]:
+        """Every stored object, in pages of at most LIST_PAGE_SIZE."""
+
+    @abstractmethod
+    def presign_upload(
+        self, key: str, content_type: str, expires: int
+    ) -> Dict[str, object]:
+        """
+        Describe the request that uploads ``key`` without the app: the
+        ``method`` and ``url`` to use and the ``headers`` to send, valid for
+        ``expires`` seconds.
+        """
+
+
+class LocalStorage(Storage):
+    def __init__(self, root: Path, base_url: str, secret: str):
+        self.root = Path(root)
+        self.base_url = base_url
+        self.secret = secret.encode()
+
+    def path(self, key: str) -> Path:
+        return self.root / os.path.basename(key)
+
+    def url(self, key: str) -> str:
+        return self.base_url + key
+
+    async def save(self, key: str, data: bytes, content_type: str):
+        with span("file.write", **{"file.name": key, "file.size": len(data)}):
+            async with aiofiles.open(self.path(key), mode="wb") as file:
+                await file.write(data)
+
+    async def save_stream(self, key: str, chunks, max_size: int):
+        """
+        Write the chunks of an upload to ``key``. Past ``max_size`` bytes
+        the partial file is removed and UploadTooLarge raised.
+        """
+        size = 0
+        with span("file.write", **{"file.name": key}):
+            async with aiofiles.open(self.path(key), mode="wb") as file:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > max_size:
+                        break
+                    await file.write(chunk)
+        if size > max_size:
+            await self.delete(key)
+            raise UploadTooLarge(key)
+
+    async def size(self, key: str) -> Optional[int]:
+        try:
+            return (await aiofiles.os.stat(self.path(key))).st_size
+        except FileNotFoundError:
+            return None
+
+    async def delete(self, key: str):
+        try:
+            with span("file.delete", **{"file.name": key}):
+                await aiofiles.os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    async def list_objects(self) -> AsyncIterator[List[StoredObject]]:
+        def read_page(entries) -> List[StoredObject]:
+            page = []
+            for entry in islice(entries, LIST_PAGE_SIZE):
+                # Dotfiles such as .gitkeep are not media.
+                if entry.is_file() and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    modified = datetime.fromtimestamp(
+                        stat.st_mtime, tz=timezone.utc
+                    )
+                    page.append(
+                        StoredObject(entry.name, stat.st_size, modified)
+                    )
+            return page
+
+        with os.scandir(self.root) as entries:
+            while page := await asyncio.to_thread(read_page, entries):
+                yield page
+
+    def signature(self, key: str, content_type: str, expires: int) -> str:
+        message = f"{key}\n{content_type}\n{expires}".encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def presign_upload(
+        self, key: str, content_type: str, expires: int
+    ) -> Dict[str, object]:
+        deadline = int(time.time()) + expires
+        signature = self.signature(key, content_type, deadline)
+        return {
+            "method": "PUT",
+            "url": (
+                f"{UPLOAD_PATH}{key}"
+                f"?expires={deadline}&signature={signature}"
+            ),
+            "headers": {"Content-Type": content_type},
+        }
+
+    def check_upload(
+        self, key: str, content_type: str, expires: int, signature: str
+    ) -> bool:
+        """Whether a PUT to the upload route was presigned by this app."""
+        if not self.secret:
+            return False
+        expected = self.signature(key, content_type, expires)
+        return expires >= time.time() and hmac.compare_digest(
+            expected, signature
+        )
+
+
+def _hmac(key: bytes, message: str) -> bytes:
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _quote(value: str) -> str:
+    return quote(value, safe="-_.~")
+
+
+class S3Storage(Storage):
+    ALGORITHM = "AWS4-HMAC-SHA256"
+    UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+
+    def __init__(
+        self,
+        endpoint_url: str,
+        bucket: str,
+        access_key: str,
+        secret_key: str,
+        region: str = "us-east-1",
+        public_url: Optional[str] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.endpoint_url = endpoint_url.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.public_url = (
+            public_url or f"{self.endpoint_url}/{bucket}"
+        ).rstrip("/")
+        self.transport = transport
+
+    def url(self, key: str) -> str:
+        return f"{self.public_url}/{key}"
+
+    def object_url(self, key: str) -> str:
+        return f"{self.endpoint_url}/{self.bucket}/{quote(key)}"
+
+    def scope(self, now: datetime) -> str:
+        return f"{now:%Y%m%d}/{self.region}/s3/aws4_request"
+
+    def signature(
+        self,
+        method: str,
+        url: str,
+        headers: Dict[str, str],
+        query: Dict[str, str],
+        payload_hash: str,
+        now: datetime,
+    ) -> str:
+        """Signature Version 4 of a request, over all ``headers``."""
+        names = sorted(name.lower() for name in headers)
+        values = {name.lower(): value for name, value in headers.items()}
+        canonical_request = "\n".join(
+            (
+                method,
+                urlsplit(url).path or "/",
+                "&".join(
+                    f"{_quote(name)}={_quote(query[name])}"
+                    for name in sorted(query)
+                ),
+                "".join(f"{name}:{values[name].strip()}\n" for name in names),
+                ";".join(names),
+                payload_hash,
+            )
+        )
+        string_to_sign = "\n".join(
+            (
+                self.ALGORITHM,
+                f"{now:%Y%m%dT%H%M%SZ}",
+                self.scope(now),
+                _sha256(canonical_request.encode()),
+            )
+        )
+        key = _hmac(f"AWS4{self.secret_key}".encode(), f"{now:%Y%m%d}")
+        for part in (self.region, "s3", "aws4_request"):
+            key = _hmac(key, part)
+        return hmac.new(
+            key, string_to_sign.encode(), hashlib.sha256
+        ).hexdigest()
+
+    def presign_upload(
+        self,
+        key: str,
+        content_type: str,
+        expires: int,
+        now: Optional[datetime] = None,
+    ) -> Dict[str, object]:
+        now = now or datetime.now(timezone.utc)
+        url = self.object_url(key)
+        headers = {"host": urlsplit(url).netloc, "content-type": content_type}
+        query = {
+            "X-Amz-Algorithm": self.ALGORITHM,
+            "X-Amz-Credential": f"{self.access_key}/{self.scope(now)}",
+            "X-Amz-Date": f"{now:%Y%m%dT%H%M%SZ}",
+            "X-Amz-Expires": str(expires),
+            "X-Amz-SignedHeaders": ";".join(sorted(headers)),
+        }
+        query["X-Amz-Signature"] = self.signature(
+            "PUT", url, headers, query, self.UNSIGNED_PAYLOAD, now
+        )
+        return {
+            "method": "PUT",
+            "url": url
+            + "?"
+            + "&".join(
+                f"{name}={_quote(value)}" for name, value in query.items()
+            ),
+            "headers": {"Content-Type": content_type},
+        }
+
+    def authorize(
+        self,
+        method: str,
+        url: str,
+        data: bytes,
+        headers: Dict[str, str],
+        query: Dict[str, str],
+        now: datetime,
+    ) -> Dict[str, str]:
+        """``headers`` plus the ones signing the request."""
+        headers = {
+            **headers,
+            "host": urlsplit(url).netloc,
+            "x-amz-content-sha256": _sha256(data),
+            "x-amz-date": f"{now:%Y%m%dT%H%M%SZ}",
+        }
+        signature = self.signature(
+            method, url, headers, query, headers["x-amz-content-sha256"], now
+        )
+        signed_headers = ";".join(sorted(name.lower() for name in headers))
+        headers["Authorization"] = (
+            f"{self.ALGORITHM} "
+            f"Credential={self.access_key}/{self.scope(now)}, "
+            f"SignedHeaders={signed_headers}, "
+            f"Signature={signature}"
+        )
+        return headers
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        data: bytes = b"",
+        headers: Optional[Dict[str, str]] = None,
+        query: Optional[Dict[str, str]] = None,
+    ) -> httpx.Response:
+        query = query or {}
+        headers = self.authorize(
+            method,
+            url,
+            data,
+            headers or {},
+            query,
+            datetime.now(timezone.utc),
+        )
+        with span(
+            "storage.request", **{"http.method": method, "http.url": url}
+        ):
+            async with httpx.AsyncClient(
+                timeout=REQUEST_TIMEOUT, transport=self.transport
+            ) as client:
+                return await client.request(
+                    method, url, content=data, headers=headers, params=query
+                )
+
+    async def save(self, key: str, data: bytes, content_type: str):
+        response = await self.request(
+            "PUT",
+            self.object_url(key),
+            data,
+            headers={"content-type": content_type},
+        )
+        response.raise_for_status()
+
+    async def size(self, key: str) -> Optional[int]:
+        response = await self.request("HEAD", self.object_url(key))
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return int(response.headers["content-length"])
+
+    async def delete(self, key: str):
+        response = await self.request("DELETE", self.object_url(key))
+        if response.status_code != 404:
+            response.raise_for_status()
+
+    async def list_objects(self) -> AsyncIterator[List[StoredObject]]:
+        query = {"list-type": "2", "max-keys": str(LIST_PAGE_SIZE)}
+        while True:
+            response = await self.request(
+                "GET", f"{self.endpoint_url}/{self.bucket}", query=query
+            )
+            response.raise_for_status()
+            result = ElementTree.fromstring(response.content)
+            yield [
+                StoredObject(
+                    item.findtext("s3:Key", namespaces=S3_NAMESPACE),
+                    int(item.findtext("s3:Size", namespaces=S3_NAMESPACE)),
+                    datetime.fromisoformat(
+                        item.findtext(
+                            "s3:LastModified", namespaces=S3_NAMESPACE
+                        ).replace("Z", "+00:00")
+                    ),
+                )
+                for item in result.findall("s3:Contents", S3_NAMESPACE)
+            ]
+            token = result.findtext(
+                "s3:NextContinuationToken", namespaces=S3_NAMESPACE
+            )
+            if not token:
+                return
+            query = {**query, "continuation-token": token}
+
+
+def make_storage(name: str) -> Storage:
+    if name == "s3":
+        return S3Storage(
+            S3_ENDPOINT_URL,
+            S3_BUCKET,
+            S3_ACCESS_KEY,
+            S3_SECRET_KEY,
+            S3_REGION,
+            S3_PUBLIC_URL,
+        )
+    return LocalStorage(OUT_PATH, MEDIA_PATH, STORAGE_SECRET)
+
+
+storage: Storage = make_storage(STORAGE_BACKEND)
+
+
+def get_storage() -> Storage:
+    return storage
+
+
+def check_storage():
+    """Refuse to start when the local backend could not sign its uploads."""
+    if isinstance(storage, LocalStorage) and not storage.secret:
+        raise RuntimeError(
+            "STORAGE_SECRET must be set to sign the local upload urls"
+        )
+
+
+def set_storage(new_storage: Storage) -> Storage:
+    """Swap the storage backend, returning the previous one."""
+    global storage
+    previous, storage = storage, new_storage
+    return previous
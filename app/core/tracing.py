@@ -0,0 +1,398 @@
+"""
+Lightweight in-process tracing.
+
+Every request gets a trace: ``TracingMiddleware`` opens the root span, SQL
+statements get child spans from engine events, and service functions
+decorated with ``@traced`` or code wrapped in ``with span(...)`` add their
+own. The current span lives in a context variable, so spans nest along the
+coroutines of the request without being passed around.
+
+Context comes from the W3C ``traceparent`` header when the caller sends one,
+and ``X-Request-ID`` is kept as the ``request.id`` attribute (a new one is
+generated otherwise); both are returned in the response.
+
+Sampling happens twice. At the head, a request is sampled when its
+traceparent says so or with probability TRACE_SAMPLE_RATE. At the tail,
+every trace is recorded anyway and also kept when it took longer than
+TRACE_SLOW_THRESHOLD or failed. The slow ``delete_like_to_tweet`` shows up
+even if the dice said no.
+
+Kept traces are buffered and exported in batches by ``export_loop`` as OTLP
+JSON, the format of the OpenTelemetry collector's HTTP receiver. The
+configured exporter decides where they go:
+
+- ``memory``: keeps them, for tests and setups without a collector;
+- ``file``: appends one OTLP document per line to TRACE_FILE;
+- ``otlp``: ``POST TRACE_OTLP_URL/v1/traces``.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+import aiofiles
+import httpx
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from core.config import (
+    TRACE_BUFFER_SIZE,
+    TRACE_EXPORT_INTERVAL,
+    TRACE_EXPORTER,
+    TRACE_FILE,
+    TRACE_OTLP_URL,
+    TRACE_SAMPLE_RATE,
+    TRACE_SLOW_THRESHOLD,
+)
+from core.loop_monitor import route_of
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "twitter-clone"
+EXPORT_TIMEOUT = 5.0
+MAX_STATEMENT_LENGTH = 1000
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+# OTLP span kinds and status codes
+SPAN_INTERNAL = 1
+SPAN_SERVER = 2
+SPAN_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    def __init__(
+        self,
+        trace: "Trace",
+        name: str,
+        parent_id: Optional[str],
+        attributes: Optional[Dict[str, Any]] = None,
+        kind: int = SPAN_INTERNAL,
+    ):
+        self.trace = trace
+        self.kind = kind
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.start = time.time_ns()
+        self.end: Optional[int] = None
+        self.error = False
+
+    def finish(self, error: bool = False):
+        self.end = time.time_ns()
+        self.error = self.error or error
+        self.trace.spans.append(self)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [
+                {"key": key, "value": otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": STATUS_ERROR if self.error else STATUS_OK},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class Trace:
+    def __init__(
+        self,
+        trace_id: Optional[str] = None,
+        parent_id: Optional[str] = None,
+        sampled: bool = False,
+    ):
+        self.trace_id = trace_id or os.urandom(16).hex()
+        # Span of the caller, from its traceparent.
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.spans: List[Span] = []
+
+    def keep(self, root: Span) -> bool:
+        """Tail sampling: sampled at the head, slow, or failed."""
+        duration = (root.end - root.start) / 1e9
+        return self.sampled or root.error or duration >= TRACE_SLOW_THRESHOLD
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar(
+    "current_span", default=None
+)
+
+
+def otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def start_span(
+    name: str, kind: int = SPAN_INTERNAL, **attributes
+) -> Optional[Span]:
+    """Child of the current span, None outside of a trace."""
+    parent = current_span.get()
+    if parent is None:
+        return None
+    return Span(parent.trace, name, parent.span_id, attributes, kind)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """Trace the block as a child of the current span."""
+    child = start_span(name, **attributes)
+    if child is None:
+        yield None
+        return
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException:
+        child.finish(error=True)
+        raise
+    else:
+        child.finish()
+    finally:
+        current_span.reset(token)
+
+
+def traced(function):
+    """Trace every call of an async function, named after its module."""
+    name = f"{function.__module__.rpartition('.')[2]}.{function.__name__}"
+
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        with span(name):
+            return await function(*args, **kwargs)
+
+    return wrapper
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_statement(conn, cursor, statement, parameters, context, many):
+    child = start_span(
+        "db.query",
+        SPAN_CLIENT,
+        **{
+            "db.system": conn.dialect.name,
+            "db.name": conn.engine.url.database,
+            "db.statement": statement[:MAX_STATEMENT_LENGTH],
+        },
+    )
+    if context is not None:
+        context._trace_span = child
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_statement(conn, cursor, statement, parameters, context, many):
+    child = getattr(context, "_trace_span", None)
+    if child is not None:
+        if cursor is not None and cursor.rowcount >= 0:
+            child.attributes["db.rows"] = cursor.rowcount
+        child.finish()
+        context._trace_span = None
+
+
+@event.listens_for(Engine, "handle_error")
+def _fail_statement(exception_context):
+    context = exception_context.execution_context
+    child = getattr(context, "_trace_span", None)
+    if child is not None:
+        child.finish(error=True)
+        context._trace_span = None
+
+
+def otlp_payload(traces: List[Trace]) -> Dict[str, Any]:
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {
+                            "key": "service.name",
+                            "value": otlp_value(SERVICE_NAME),
+                        }
+                    ]
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": __name__},
+                        "spans": [
+                            span.to_otlp()
+                            for trace in traces
+                            for span in trace.spans
+                        ],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+class Exporter(ABC):
+    @abstractmethod
+    async def export(self, traces: List[Trace]):
+        """Send finished traces to where they are kept."""
+
+
+class MemoryExporter(Exporter):
+    def __init__(self, size: int = 1000):
+        self.traces: Deque[Trace] = deque(maxlen=size)
+
+    async def export(self, traces: List[Trace]):
+        self.traces.extend(traces)
+
+
+class FileExporter(Exporter):
+    def __init__(self, path: str):
+        self.path = path
+
+    async def export(self, traces: List[Trace]):
+        async with aiofiles.open(self.path, mode="a") as file:
+            await file.write(json.dumps(otlp_payload(traces)) + "\n")
+
+
+class OtlpExporter(Exporter):
+    def __init__(
+        self,
+        url: str,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.url = url.rstrip("/") + "/v1/traces"
+        self.transport = transport
+
+    async def export(self, traces: List[Trace]):
+        async with httpx.AsyncClient(
+            timeout=EXPORT_TIMEOUT, transport=self.transport
+        ) as client:
+            response = await client.post(self.url, json=otlp_payload(traces))
+            response.raise_for_status()
+
+
+def make_exporter(name: str) -> Exporter:
+    if name == "file":
+        return FileExporter(TRACE_FILE)
+    if name == "otlp":
+        return OtlpExporter(TRACE_OTLP_URL)
+    return MemoryExporter()
+
+
+exporter: Exporter = make_exporter(TRACE_EXPORTER)
+# Kept traces waiting for the next export; the oldest are dropped when the
+# exporter cannot keep up.
+pending: Deque[Trace] = deque(maxlen=TRACE_BUFFER_SIZE)
+
+
+def set_exporter(new_exporter: Exporter) -> Exporter:
+    """Swap the exporter, returning the previous one."""
+    global exporter
+    previous, exporter = exporter, new_exporter
+    return previous
+
+
+async def flush():
+    """Export the pending traces. A failing export is logged and dropped."""
+    traces = []
+    while pending:
+        traces.append(pending.popleft())
+    if not traces:
+        return
+    try:
+        await exporter.export(traces)
+    except Exception:
+        logger.exception("Export of %d traces failed", len(traces))
+
+
+async def export_loop(interval: float = TRACE_EXPORT_INTERVAL):
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await flush()
+    finally:
+        await flush()
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[Trace]:
+    match = TRACEPARENT.match(value or "")
+    if not match or match.group(1) == "0" * 32:
+        return None
+    trace_id, parent_id, flags = match.groups()
+    return Trace(trace_id, parent_id, sampled=bool(int(flags, 16) & 1))
+
+
+class TracingMiddleware:
+    """Root span of every HTTP request, with the sampling decisions."""
+
+    def __init__(self, app, sample_rate: float = TRACE_SAMPLE_RATE):
+        self.app = app
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = {
+            name.decode("latin-1"): value.decode("latin-1")
+            for name, value in scope["headers"]
+        }
+        trace = parse_traceparent(headers.get("traceparent"))
+        if trace is None:
+            trace = Trace(sampled=random.random() < self.sample_rate)
+        request_id = headers.get("x-request-id") or trace.trace_id
+        root = Span(
+            trace,
+            scope["method"],
+            trace.parent_id,
+            {
+                "http.method": scope["method"],
+                "http.target": scope["path"],
+                "request.id": request_id,
+            },
+            SPAN_SERVER,
+        )
+        flags = "01" if trace.sampled else "00"
+
+        async def send_with_context(message):
+            if message["type"] == "http.response.start":
+                root.attributes["http.status_code"] = message["status"]
+                root.error = message["status"] >= 500
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (
+                        b"traceparent",
+                        f"00-{trace.trace_id}-{root.span_id}-{flags}".encode(),
+                    ),
+                    (b"x-request-id", request_id.encode("latin-1")),
+                ]
+            await send(message)
+
+        token = current_span.set(root)
+        try:
+            await self.app(scope, receive, send_with_context)
+        except BaseException:
+            root.error = True
+            raise
+        finally:
+            current_span.reset(token)
+            root.name = route_of(scope)
+            root.finish()
+            if trace.keep(root):
+                pending.append(trace)
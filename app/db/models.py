@@ -1,18 +1,46 @@
+from typing import Any, Dict
+
 from sqlalchemy import (
+    BigInteger,
+    Boolean,
     Column,
+    DateTime,
+    Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     Table,
     UniqueConstraint,
+    func,
+    text,
 )
 from sqlalchemy.ext.associationproxy import association_proxy
-from sqlalchemy.orm import relationship, declarative_base
-from typing import Any, Dict
+from sqlalchemy.orm import declarative_base, relationship, synonym
+
+from core.sharding import bucket_for_user
+from core.snowflake import bucket_of, next_id
 
 Base = declarative_base()
 
 
+def tweet_id_default(context) -> int:
+    """Mint the id in the shard bucket of the tweet's author."""
+    user_id = context.get_current_parameters()["user_id"]
+    return next_id(bucket_for_user(user_id))
+
+
+def like_id_default(context) -> int:
+    """Mint the id in the bucket of the liked tweet."""
+    return next_id(bucket_of(context.get_current_parameters()["tweet_id"]))
+
+
+def media_id_default(context) -> int:
+    """Mint the id in the shard bucket of the uploader."""
+    user_id = context.get_current_parameters().get("user_id")
+    return next_id(bucket_for_user(user_id or 0))
+
+
 class JsonMixin:
     def to_json(self) -> Dict[str, Any]:
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -31,16 +59,49 @@ followers = Table(
         ForeignKey("users.id", ondelete="CASCADE"),
         primary_key=True,
     ),
+    Index(
+        "ix_followers_followed_user_id",
+        "followed_user_id",
+        "following_user_id",
+    ),
 )
 
 
 class User(Base, JsonMixin):
     __tablename__: str = "users"
+    __table_args__ = (
+        # Queue of services.account_service.
+        Index(
+            "ix_users_deleted_at",
+            "deleted_at",
+            postgresql_where=text("deleted_at IS NOT NULL"),
+            sqlite_where=text("deleted_at IS NOT NULL"),
+        ),
+    )
 
-    id = Column(Integer, primary_key=True, index=True, unique=True)
+    id = Column(Integer, primary_key=True)
     name = Column(String)
     api_key = Column(String, index=True, unique=True)
     password = Column(String)
+    # Set by delete_account, which also revokes the api_key: the user is
+    # hidden at once, the rows are removed later by
+    # services.account_service in bounded batches.
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
+    # Changed together with the rows they count by user_service and
+    # tweet_service, corrected by services.counter_service.
+    followers_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    following_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    tweets_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    # Notifications not read yet, kept by services.notification_service.
+    unread_notifications = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
 
     following = relationship(
         "User",
@@ -68,11 +129,112 @@ class User(Base, JsonMixin):
         return f"Пользователь {self.name}"
 
 
+# Resolves the @mentions of new tweets, see services.tag_service.
+Index("ix_users_lower_name", func.lower(User.name))
+
+
 class Tweet(Base, JsonMixin):
     __tablename__ = "tweets"
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (
+        Index("ix_tweets_user_id_id", "user_id", "id"),
+        Index(
+            "ix_tweets_deleted_at",
+            "deleted_at",
+            postgresql_where=text("deleted_at IS NOT NULL"),
+            sqlite_where=text("deleted_at IS NOT NULL"),
+        ),
+        # First pages of order=ranked and order=top, read backwards.
+        Index(
+            "ix_tweets_user_id_score",
+            "user_id",
+            "score",
+            "id",
+            postgresql_where=text("deleted_at IS NULL"),
+            sqlite_where=text("deleted_at IS NULL"),
+        ),
+        Index(
+            "ix_tweets_user_id_likes_count",
+            "user_id",
+            "likes_count",
+            "id",
+            postgresql_where=text("deleted_at IS NULL"),
+            sqlite_where=text("deleted_at IS NULL"),
+        ),
+        # Subtrees of a conversation, in thread order. depth is checked in
+        # the index, so replies below the depth asked for are skipped
+        # without reading their rows.
+        Index(
+            "ix_tweets_root_id_path_depth",
+            "root_id",
+            "path",
+            "depth",
+            postgresql_where=text("root_id IS NOT NULL"),
+            sqlite_where=text("root_id IS NOT NULL"),
+        ),
+        # One live retweet of a tweet per user.
+        Index(
+            "ix_tweets_user_id_retweet_of_id",
+            "user_id",
+            "retweet_of_id",
+            unique=True,
+            postgresql_where=text(
+                "retweet_of_id IS NOT NULL AND deleted_at IS NULL"
+            ),
+            sqlite_where=text(
+                "retweet_of_id IS NOT NULL AND deleted_at IS NULL"
+            ),
+        ),
+    )
+
+    id = Column(
+        BigInteger,
+        primary_key=True,
+        autoincrement=False,
+        default=tweet_id_default,
+    )
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
-    content = Column(String, index=True)
+    content = Column(String)
+    # Set by delete_tweet; the row and its likes/media are removed later by
+    # services.purge_service in bounded batches.
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
+    # Changed with the likes by tweet_service; score is the ranking of
+    # services.ranking_service, kept fresh for recent tweets by rescore_recent.
+    likes_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    score = Column(Float, nullable=False, default=0, server_default="0")
+    like_count = synonym("likes_count")
+    # A retweet has no content of its own, a quote has; both only point to
+    # the original, which may live on another shard, hence no foreign key.
+    retweet_of_id = Column(BigInteger, nullable=True)
+    quote_of_id = Column(BigInteger, nullable=True)
+    # Replies: the tweet answered and the first tweet of the conversation.
+    # path lists the fixed width ids from the root down to the reply, so a
+    # subtree is one range of (root_id, path) and sorts in thread order.
+    parent_id = Column(BigInteger, nullable=True)
+    root_id = Column(BigInteger, nullable=True)
+    path = Column(
+        String(collation="C").with_variant(String(), "sqlite"), nullable=True
+    )
+    depth = Column(Integer, nullable=False, default=0, server_default="0")
+    replies_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    retweets_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    quotes_count = Column(
+        Integer, nullable=False, default=0, server_default="0"
+    )
+    # Set by tweet_service for the reader of the tweet, whose reads also
+    # load only the newest likes into the likes collection.
+    liked_by_me = False
+    # The tweet retweeted or quoted, loaded by tweet_service.
+    original = None
+
+    @property
+    def original_id(self):
+        return self.retweet_of_id or self.quote_of_id
 
     attachments = association_proxy("media", "name")
 
@@ -97,9 +259,33 @@ class Tweet(Base, JsonMixin):
 
 class Media(Base, JsonMixin):
     __tablename__ = "medias"
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (
+        # Queue of the orphaned media collector, see services.gc_service.
+        Index(
+            "ix_medias_unattached",
+            "id",
+            postgresql_where=text("tweet_id IS NULL"),
+            sqlite_where=text("tweet_id IS NULL"),
+        ),
+        # Uploads of a deleted account, see services.account_service.
+        Index("ix_medias_user_id", "user_id"),
+    )
+    id = Column(
+        BigInteger,
+        primary_key=True,
+        autoincrement=False,
+        default=media_id_default,
+    )
+    # Public URL of the file, key of the object in core.storage, and its
+    # size in bytes once the upload is known to have finished.
     name = Column(String, nullable=False)
-    tweet_id = Column(Integer, ForeignKey("tweets.id", ondelete="CASCADE"))
+    key = Column(String, nullable=False, index=True)
+    size = Column(BigInteger, nullable=True)
+    # Uploader; places media next to the tweets it can be attached to.
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    tweet_id = Column(
+        BigInteger, ForeignKey("tweets.id", ondelete="CASCADE"), index=True
+    )
     tweet = relationship("Tweet", back_populates="media")
 
     def __repr__(self):
@@ -109,12 +295,24 @@ class Media(Base, JsonMixin):
 class Like(Base, JsonMixin):
     __tablename__ = "likes"
     __table_args__ = (
-        UniqueConstraint("user_id", "tweet_id", name="_unique_who_tweet_likes"),
+        UniqueConstraint(
+            "user_id", "tweet_id", name="_unique_who_tweet_likes"
+        ),
+        # Newest likes of a tweet first, for previews and pages.
+        Index("ix_likes_tweet_id_id", "tweet_id", "id"),
     )
 
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(ForeignKey("users.id", ondelete="CASCADE"), index=True)
-    tweet_id = Column(ForeignKey("tweets.id", ondelete="CASCADE"), index=True)
+    id = Column(
+        BigInteger,
+        primary_key=True,
+        autoincrement=False,
+        default=like_id_default,
+    )
+    user_id = Column(ForeignKey("users.id", ondelete="CASCADE"))
+    # Part of the key as the partition key of likes, see core.partitions.
+    tweet_id = Column(
+        ForeignKey("tweets.id", ondelete="CASCADE"), primary_key=True
+    )
 
     user = relationship("User", back_populates="likes")
     tweet = relationship("Tweet", back_populates="likes")
@@ -123,3 +321,96 @@ class Like(Base, JsonMixin):
 
     def __repr__(self):
         return f"Лайк {self.id}"
+
+
+class TweetHashtag(Base, JsonMixin):
+    """A #hashtag of a tweet, lowercased, stored next to the tweet."""
+
+    __tablename__ = "tweet_hashtags"
+    __table_args__ = (Index("ix_tweet_hashtags_tweet_id", "tweet_id"),)
+
+    # Newest tweets of a tag first: one range of the primary key.
+    tag = Column(String, primary_key=True)
+    tweet_id = Column(
+        BigInteger,
+        ForeignKey("tweets.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+
+class TweetMention(Base, JsonMixin):
+    """An @mention of a user in a tweet, stored next to the tweet."""
+
+    __tablename__ = "tweet_mentions"
+    __table_args__ = (Index("ix_tweet_mentions_tweet_id", "tweet_id"),)
+
+    user_id = Column(
+        Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True
+    )
+    tweet_id = Column(
+        BigInteger,
+        ForeignKey("tweets.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+
+
+class Notification(Base, JsonMixin):
+    """
+    One row per group of events: every like of a tweet, or every follow of
+    a user, adds up in the same row. A new event moves the row to the top
+    (seq) and marks it unread again.
+    """
+
+    __tablename__ = "notifications"
+    __table_args__ = (
+        UniqueConstraint(
+            "user_id", "kind", "tweet_id", name="_unique_notification_group"
+        ),
+        Index("ix_notifications_user_id_seq", "user_id", "seq"),
+        # Notifications of the actions of a deleted account.
+        Index("ix_notifications_actor_id", "actor_id"),
+        Index(
+            "ix_notifications_unread",
+            "user_id",
+            postgresql_where=text("unread"),
+            sqlite_where=text("unread"),
+        ),
+    )
+
+    # SQLite only numbers INTEGER primary keys by itself.
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    user_id = Column(
+        ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
+    kind = Column(String, nullable=False)
+    # 0 for follows. Tweets live on other shards, hence no foreign key.
+    tweet_id = Column(BigInteger, nullable=False, server_default="0")
+    # The latest of the actors_count users behind the events.
+    actor_id = Column(
+        ForeignKey("users.id", ondelete="CASCADE"), nullable=False
+    )
+    actors_count = Column(Integer, nullable=False, server_default="1")
+    # Snowflake id of the latest event, the order of the notifications.
+    seq = Column(BigInteger, nullable=False)
+    unread = Column(Boolean, nullable=False, server_default=text("true"))
+
+    actor = relationship("User", foreign_keys=[actor_id])
+
+    @property
+    def text(self) -> str:
+        action = NOTIFICATION_ACTIONS[self.kind]
+        if self.actors_count == 1:
+            return f"{self.actor.name} {action}"
+        others = self.actors_count - 1
+        noun = "other" if others == 1 else "others"
+        return f"{self.actor.name} and {others} {noun} {action}"
+
+
+NOTIFICATION_ACTIONS = {
+    "like": "liked your tweet",
+    "follow": "followed you",
+    "retweet": "retweeted your tweet",
+    "quote": "quoted your tweet",
+    "reply": "replied to your tweet",
+    "mention": "mentioned you",
+}
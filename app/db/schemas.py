@@ -1,4 +1,5 @@
-from typing import List, Optional
+from typing import Dict, List, Optional
+
 from pydantic import BaseModel, Field, validator
 from pydantic.schema import Sequence
 from sqlalchemy.ext.associationproxy import _AssociationList
@@ -27,6 +28,16 @@ class UserIn(BaseUser):
     ...
 
 
+class UserIdsIn(BaseModel):
+    user_ids: List[int]
+
+
+class UserIdsOutSchema(BaseModel):
+    result: bool = True
+    # Users whose follow changed, in id order.
+    user_ids: List[int]
+
+
 class UserOut(BaseUser):
     id: int
 
@@ -53,6 +64,9 @@ class AuthorLikeSchema(BaseModel):
 class UserOutSchema(BaseModel):
     id: int
     name: str
+    followers_count: int = 0
+    following_count: int = 0
+    tweets_count: int = 0
     followers: Optional[List[AuthorBaseSchema]]
     following: Optional[List[AuthorBaseSchema]]
 
@@ -68,6 +82,12 @@ class UserResultOutSchema(BaseModel):
         orm_mode = True
 
 
+class UserListOutSchema(BaseModel):
+    result: bool = True
+    users: List[AuthorBaseSchema]
+    next_cursor: Optional[int]
+
+
 class MediaOutSchema(BaseModel):
     result: bool = True
     media_id: int
@@ -76,9 +96,24 @@ class MediaOutSchema(BaseModel):
         orm_mode = True
 
 
+class MediaUploadIn(BaseModel):
+    filename: str = Field(example="cat.png")
+    content_type: str = Field(example="image/png")
+
+
+class MediaUploadOutSchema(BaseModel):
+    result: bool = True
+    media_id: int
+    method: str
+    upload_url: str
+    headers: Dict[str, str]
+
+
 class TweetIn(BaseModel):
     tweet_data: str
     tweet_media_ids: Optional[List[int]]
+    quote_tweet_id: Optional[int]
+    reply_to_id: Optional[int]
 
     class Config:
         orm_mode = True
@@ -94,7 +129,19 @@ class TweetSchema(BaseModel):
     content: str = Field(example="tweet")
     attachments: Optional[Sequence[str]]
     author: AuthorBaseSchema
+    like_count: int = 0
+    liked_by_me: bool = False
+    # The newest likers only, see GET /api/tweets/{id}/likes for the rest.
     likes: Optional[List[AuthorLikeSchema]]
+    retweet_of_id: Optional[int]
+    quote_of_id: Optional[int]
+    retweets_count: int = 0
+    quotes_count: int = 0
+    # The retweeted or quoted tweet, None when it was deleted.
+    original: Optional["TweetSchema"]
+    parent_id: Optional[int]
+    depth: int = 0
+    replies_count: int = 0
 
     @validator("attachments", pre=True, whole=True)
     def check_roles(cls, v):
@@ -106,6 +153,65 @@ class TweetSchema(BaseModel):
         orm_mode = True
 
 
+TweetSchema.update_forward_refs()
+
+
 class TweetListOutSchema(BaseModel):
     result: bool = True
     tweets: Optional[List[TweetSchema]]
+
+
+class TweetPageOutSchema(BaseModel):
+    result: bool = True
+    tweets: List[TweetSchema]
+    next_cursor: Optional[int]
+
+
+class LikeListOutSchema(BaseModel):
+    result: bool = True
+    likes: List[AuthorLikeSchema]
+    next_cursor: Optional[int]
+
+
+class NotificationSchema(BaseModel):
+    id: int
+    kind: str
+    # 0 for follows.
+    tweet_id: int
+    actor: AuthorBaseSchema
+    actors_count: int
+    text: str
+    unread: bool
+    seq: int
+
+    class Config:
+        orm_mode = True
+
+
+class NotificationListOutSchema(BaseModel):
+    result: bool = True
+    unread_count: int
+    notifications: List[NotificationSchema]
+    next_cursor: Optional[int]
+
+
+class ThreadOutSchema(BaseModel):
+    result: bool = True
+    tweet: TweetSchema
+    # From the root of the conversation down to the parent of the tweet.
+    ancestors: List[TweetSchema]
+    replies: List[TweetSchema]
+    next_cursor: Optional[str]
+
+
+class SlowCallbackSchema(BaseModel):
+    route: str
+    duration: float
+    callback: str
+    stack: str
+
+
+class SlowCallbacksOutSchema(BaseModel):
+    result: bool = True
+    threshold: float
+    callbacks: List[SlowCallbackSchema]
@@ -1,4 +1,4 @@
-from sqlalchemy import select
+from sqlalchemy import bindparam, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from core.config import async_session
@@ -11,8 +11,12 @@ async def get_session():
         yield session
 
 
+# Built once: every request authenticates, see core.database.
+USER_BY_API_KEY = select(User).where(User.api_key == bindparam("api_key"))
+
+
 async def get_user_by_api_key(session: AsyncSession, api_key: str) -> User:
-    user = await session.execute(select(User).where(User.api_key == api_key))
+    user = await session.execute(USER_BY_API_KEY, {"api_key": api_key})
     user = user.scalars().one_or_none()
 
     if not user:
@@ -2,17 +2,53 @@ from fastapi import APIRouter, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from prometheus_fastapi_instrumentator import Instrumentator
 
-from core.config import session, engine
-from api import users, tweets, media
+from api import debug, hashtags, media, notifications, tweets, users
+from core.background import start_periodic, start_task, stop_all
+from core.config import (
+    ACCOUNT_DELETION_INTERVAL,
+    COUNTER_REPAIR_INTERVAL,
+    DATABASE_URL,
+    MEDIA_GC_INTERVAL,
+    MEDIA_RECONCILE_INTERVAL,
+    NOTIFY_FLUSH_INTERVAL,
+    PARTITION_INTERVAL,
+    PURGE_INTERVAL,
+    RESCORE_INTERVAL,
+    SLOW_CALLBACK_THRESHOLD,
+    async_session,
+    engine,
+    session,
+    shard_engines,
+)
+from core.database import create_schema, is_sqlite
+from core.loop_monitor import (
+    LoopMonitorMiddleware,
+    monitor_lag,
+    slow_callbacks,
+)
+from core.profiling import ProfilingMiddleware
+from core.snowflake import claim_worker_id, release_worker_id
+from core.storage import check_storage
+from core.tracing import TracingMiddleware, export_loop
+from services.account_service import delete_accounts
+from services.counter_service import repair_counters
+from services.gc_service import collect_orphaned_media, reconcile_storage
+from services.notification_service import flush_notifications
+from services.partition_service import maintain_partitions
+from services.purge_service import purge_deleted_tweets
+from services.ranking_service import rescore_recent
 
 api_router = APIRouter()
 api_router.include_router(users.router)
 api_router.include_router(tweets.router)
 api_router.include_router(media.router)
+api_router.include_router(notifications.router)
+api_router.include_router(hashtags.router)
 
 app = FastAPI()
 
 app.include_router(api_router, prefix="/api")
+app.include_router(debug.router)
 
 app.add_middleware(
     CORSMiddleware,
@@ -21,13 +57,43 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(LoopMonitorMiddleware)
+app.add_middleware(TracingMiddleware)
 Instrumentator().instrument(app).expose(app)
 @app.get("/api/test")
 def test_api():
     return {"result": "True"}
 
 
+@app.on_event("startup")
+async def startup():
+    check_storage()
+    if is_sqlite(DATABASE_URL):
+        await create_schema(engine)
+    await claim_worker_id(engine)
+    start_task(monitor_lag())
+    start_task(export_loop())
+    if SLOW_CALLBACK_THRESHOLD:
+        slow_callbacks.install()
+    start_periodic(purge_deleted_tweets, PURGE_INTERVAL)
+    start_periodic(delete_accounts, ACCOUNT_DELETION_INTERVAL)
+    start_periodic(collect_orphaned_media, MEDIA_GC_INTERVAL)
+    start_periodic(reconcile_storage, MEDIA_RECONCILE_INTERVAL)
+    start_periodic(repair_counters, COUNTER_REPAIR_INTERVAL)
+    start_periodic(rescore_recent, RESCORE_INTERVAL)
+    start_periodic(flush_notifications, NOTIFY_FLUSH_INTERVAL)
+    start_periodic(maintain_partitions, PARTITION_INTERVAL)
+
+
 @app.on_event("shutdown")
 async def shutdown():
+    await stop_all()
+    # What the last flush did not write yet.
+    async with async_session() as flush_session:
+        await flush_notifications(flush_session)
+    slow_callbacks.uninstall()
+    await release_worker_id()
     await session.close()
-    await engine.dispose()
+    for shard_engine in shard_engines.values():
+        await shard_engine.dispose()
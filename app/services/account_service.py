@@ -0,0 +1,475 @@
+import asyncio
+import functools
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.cache import purge, tweet_key, user_key
+from core.config import ACCOUNT_DELETION_BATCH_SIZE, ACCOUNT_DELETION_PAUSE
+from core.metrics import (
+    ACCOUNT_DELETION_FAILURES,
+    ACCOUNT_DELETION_ROWS,
+    PENDING_ACCOUNT_DELETIONS,
+)
+from core.sharding import PRIMARY_SHARD, on_shard, router_of
+from core.storage import get_storage
+from core.tracing import traced
+from db.models import (
+    Like,
+    Media,
+    Notification,
+    Tweet,
+    TweetMention,
+    User,
+    followers,
+)
+from dependencies import get_user_by_api_key
+from services.counter_service import (
+    change_counters,
+    change_many_counters,
+    change_tweet_counters,
+)
+from services.purge_service import purge_tweet
+from services.ranking_service import score_of
+
+logger = logging.getLogger(__name__)
+
+# Both sides of the follows of a deleted user: its own column, the column of
+# the other user, and the counter the other user loses.
+FOLLOW_SIDES = (
+    (
+        followers.c.following_user_id,
+        followers.c.followed_user_id,
+        "followers_count",
+    ),
+    (
+        followers.c.followed_user_id,
+        followers.c.following_user_id,
+        "following_count",
+    ),
+)
+
+
+@traced
+async def delete_account(session: AsyncSession, api_key: str):
+    """
+    The delete_account function deletes the account of the user with
+    api_key. The user is hidden at once: the api_key is revoked, and the
+    profile, the tweets and the follows of the user disappear from every
+    read. The rows of the account are erased
+    afterwards by delete_accounts, in bounded batches.
+
+    :param session: AsyncSession: Connect to the database
+    :param api_key: str: Identify the user deleting their account
+    :return: None
+    """
+    user = await get_user_by_api_key(session=session, api_key=api_key)
+    await session.execute(
+        update(User)
+        .where(User.id == user.id)
+        .values(api_key=None, deleted_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+    # The reference copies on the other shards hide the tweets there.
+    for shard_id in router_of(session).shard_ids:
+        if shard_id != PRIMARY_SHARD:
+            await session.execute(
+                update(User)
+                .where(User.id == user.id)
+                .values(deleted_at=func.now())
+                .execution_options(synchronize_session=False),
+                bind_arguments=on_shard(shard_id),
+            )
+    await session.commit()
+    PENDING_ACCOUNT_DELETIONS.inc()
+    await purge([user_key(user.id)])
+
+
+async def hide_tweets(
+    session: AsyncSession, shard_id: str, user_id: int, batch_size: int
+) -> int:
+    """
+    The hide_tweets function marks at most batch_size live tweets of a user
+    as deleted and takes them off the counters of their originals and
+    parents, as delete_tweet does. Hiding comes first so the tweets leave
+    the reads quickly; the rows are purged later.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard to hide tweets on
+    :param user_id: int: Deleted user
+    :param batch_size: int: Upper bound of rows changed by one statement
+    :return: The number of hidden tweets
+    """
+    response = await session.execute(
+        update(Tweet)
+        .where(
+            Tweet.id.in_(
+                select(Tweet.id)
+                .where(Tweet.user_id == user_id, Tweet.deleted_at.is_(None))
+                .limit(batch_size)
+                .scalar_subquery()
+            ),
+            Tweet.deleted_at.is_(None),
+        )
+        .values(deleted_at=func.now())
+        .returning(
+            Tweet.id, Tweet.retweet_of_id, Tweet.quote_of_id, Tweet.parent_id
+        )
+        .execution_options(synchronize_session=False),
+        bind_arguments=on_shard(shard_id),
+    )
+    tweets = response.all()
+
+    deltas: Dict[int, Counter] = defaultdict(Counter)
+    for tweet in tweets:
+        if tweet.retweet_of_id is not None:
+            deltas[tweet.retweet_of_id]["retweets_count"] -= 1
+        elif tweet.quote_of_id is not None:
+            deltas[tweet.quote_of_id]["quotes_count"] -= 1
+        if tweet.parent_id is not None:
+            deltas[tweet.parent_id]["replies_count"] -= 1
+    for tweet_id in sorted(deltas):
+        await change_tweet_counters(session, tweet_id, **deltas[tweet_id])
+    await session.commit()
+    ACCOUNT_DELETION_ROWS.labels("tweets").inc(len(tweets))
+    await purge([tweet_key(i) for i in [*(t.id for t in tweets), *deltas]])
+    return len(tweets)
+
+
+async def delete_likes(
+    session: AsyncSession, shard_id: str, user_id: int, batch_size: int
+) -> int:
+    """
+    The delete_likes function deletes at most batch_size likes of a user
+    and takes them off the likes and scores of the liked tweets.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard to delete likes on
+    :param user_id: int: Deleted user
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :return: The number of deleted likes
+    """
+    response = await session.execute(
+        delete(Like)
+        .where(
+            Like.id.in_(
+                select(Like.id)
+                .where(Like.user_id == user_id)
+                .limit(batch_size)
+                .scalar_subquery()
+            )
+        )
+        .returning(Like.tweet_id)
+        .execution_options(synchronize_session=False),
+        bind_arguments=on_shard(shard_id),
+    )
+    # A user likes a tweet once.
+    tweet_ids = sorted(response.scalars().all())
+    if tweet_ids:
+        likes = Tweet.likes_count - 1
+        await session.execute(
+            update(Tweet)
+            .where(Tweet.id.in_(tweet_ids))
+            .values(
+                likes_count=likes,
+                score=score_of(likes, datetime.now(timezone.utc)),
+            )
+            .execution_options(synchronize_session=False),
+            bind_arguments=on_shard(shard_id),
+        )
+    await session.commit()
+    ACCOUNT_DELETION_ROWS.labels("likes").inc(len(tweet_ids))
+    await purge([tweet_key(tweet_id) for tweet_id in tweet_ids])
+    return len(tweet_ids)
+
+
+async def delete_follows(
+    session: AsyncSession, side: tuple, user_id: int, batch_size: int
+) -> int:
+    """
+    The delete_follows function deletes at most batch_size follows of one
+    side of FOLLOW_SIDES and changes the follow counters of the other users
+    in the same transaction.
+
+    :param session: AsyncSession: Connect to the database
+    :param side: tuple: Columns and counter of FOLLOW_SIDES
+    :param user_id: int: Deleted user
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :return: The number of deleted follows
+    """
+    own, other, counter = side
+    response = await session.execute(
+        delete(followers)
+        .where(
+            own == user_id,
+            other.in_(
+                select(other)
+                .where(own == user_id)
+                .limit(batch_size)
+                .scalar_subquery()
+            ),
+        )
+        .returning(other)
+    )
+    user_ids = sorted(response.scalars().all())
+    if user_ids:
+        await change_many_counters(session, user_ids, **{counter: -1})
+    await session.commit()
+    ACCOUNT_DELETION_ROWS.labels("followers").inc(len(user_ids))
+    await purge([user_key(other_id) for other_id in user_ids])
+    return len(user_ids)
+
+
+async def delete_mentions(
+    session: AsyncSession, shard_id: str, user_id: int, batch_size: int
+) -> int:
+    """
+    The delete_mentions function deletes at most batch_size mentions of a
+    user in tweets; the tweets themselves stay.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard to delete mentions on
+    :param user_id: int: Deleted user
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :return: The number of deleted mentions
+    """
+    result = await session.execute(
+        delete(TweetMention)
+        .where(
+            TweetMention.user_id == user_id,
+            TweetMention.tweet_id.in_(
+                select(TweetMention.tweet_id)
+                .where(TweetMention.user_id == user_id)
+                .limit(batch_size)
+                .scalar_subquery()
+            ),
+        )
+        .execution_options(synchronize_session=False),
+        bind_arguments=on_shard(shard_id),
+    )
+    await session.commit()
+    ACCOUNT_DELETION_ROWS.labels("tweet_mentions").inc(result.rowcount)
+    return result.rowcount
+
+
+async def delete_notifications(
+    session: AsyncSession, column, user_id: int, batch_size: int
+) -> int:
+    """
+    The delete_notifications function deletes at most batch_size
+    notifications where column is the user: those it received, or those of
+    its own actions. The unread counters of the other recipients lose the
+    unread ones.
+
+    :param session: AsyncSession: Connect to the database
+    :param column: Notification.user_id or Notification.actor_id
+    :param user_id: int: Deleted user
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :return: The number of deleted notifications
+    """
+    response = await session.execute(
+        delete(Notification)
+        .where(
+            Notification.id.in_(
+                select(Notification.id)
+                .where(column == user_id)
+                .limit(batch_size)
+                .scalar_subquery()
+            )
+        )
+        .returning(Notification.user_id, Notification.unread)
+        .execution_options(synchronize_session=False)
+    )
+    rows = response.all()
+    unread = Counter(
+        recipient_id
+        for recipient_id, is_unread in rows
+        if is_unread and recipient_id != user_id
+    )
+    for recipient_id in sorted(unread):
+        await change_counters(
+            session, recipient_id, unread_notifications=-unread[recipient_id]
+        )
+    await session.commit()
+    ACCOUNT_DELETION_ROWS.labels("notifications").inc(len(rows))
+    return len(rows)
+
+
+async def purge_tweets(
+    session: AsyncSession, shard_id: str, user_id: int, batch_size: int
+) -> int:
+    """
+    The purge_tweets function purges at most batch_size hidden tweets of a
+    user with their likes and media, see services.purge_service.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard to purge tweets on
+    :param user_id: int: Deleted user
+    :param batch_size: int: Number of tweets, and of dependent rows per
+        statement
+    :return: The number of purged tweets
+    """
+    response = await session.execute(
+        select(Tweet.id)
+        .where(Tweet.user_id == user_id, Tweet.deleted_at.is_not(None))
+        .limit(batch_size),
+        bind_arguments=on_shard(shard_id),
+    )
+    tweet_ids = response.scalars().all()
+    for tweet_id in tweet_ids:
+        await purge_tweet(session, shard_id, tweet_id, batch_size)
+    return len(tweet_ids)
+
+
+async def delete_uploads(
+    session: AsyncSession, shard_id: str, user_id: int, batch_size: int
+) -> int:
+    """
+    The delete_uploads function deletes the files of at most batch_size
+    media of a user that were never attached to a tweet, then their rows.
+    Attached media go with their tweets.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard to delete media on
+    :param user_id: int: Deleted user
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :return: The number of deleted media rows
+    """
+    response = await session.execute(
+        select(Media.id, Media.key)
+        .where(Media.user_id == user_id, Media.tweet_id.is_(None))
+        .limit(batch_size),
+        bind_arguments=on_shard(shard_id),
+    )
+    medias = response.all()
+    if not medias:
+        return 0
+
+    for _, key in medias:
+        await get_storage().delete(key)
+    await session.execute(
+        delete(Media).where(
+            Media.id.in_([media_id for media_id, _ in medias]),
+            Media.tweet_id.is_(None),
+        ),
+        bind_arguments=on_shard(shard_id),
+    )
+    await session.commit()
+    ACCOUNT_DELETION_ROWS.labels("medias").inc(len(medias))
+    return len(medias)
+
+
+async def drain(step: Callable[[], Awaitable[int]]) -> int:
+    """
+    Run ``step`` until it has nothing left to do, pausing
+    ACCOUNT_DELETION_PAUSE seconds between batches so the requests served
+    meanwhile get the database and the event loop.
+    """
+    total = 0
+    while True:
+        done = await step()
+        if not done:
+            return total
+        total += done
+        await asyncio.sleep(ACCOUNT_DELETION_PAUSE)
+
+
+async def erase_account(
+    session: AsyncSession, user_id: int, batch_size: int
+) -> None:
+    """
+    The erase_account function removes everything of a deleted user, in
+    batches of batch_size rows each committed on its own: its tweets are
+    hidden, then its likes, follows, mentions and notifications go, then
+    its tweets with their likes and media, and its unattached uploads. The
+    user rows are deleted last, with nothing left for ON DELETE CASCADE to
+    do. Every step picks up what is left, so an interrupted erasure is
+    simply run again.
+
+    :param session: AsyncSession: Connect to the database
+    :param user_id: int: Deleted user
+    :param batch_size: int: Upper bound of rows changed by one statement
+    :return: None
+    """
+    shard_ids = router_of(session).shard_ids
+    steps: List[Callable[[], Awaitable[int]]] = []
+    for shard_step in (hide_tweets, delete_likes, delete_mentions):
+        steps.extend(
+            functools.partial(
+                shard_step, session, shard_id, user_id, batch_size
+            )
+            for shard_id in shard_ids
+        )
+    steps.extend(
+        functools.partial(delete_follows, session, side, user_id, batch_size)
+        for side in FOLLOW_SIDES
+    )
+    steps.extend(
+        functools.partial(
+            delete_notifications, session, column, user_id, batch_size
+        )
+        for column in (Notification.user_id, Notification.actor_id)
+    )
+    for shard_step in (purge_tweets, delete_uploads):
+        steps.extend(
+            functools.partial(
+                shard_step, session, shard_id, user_id, batch_size
+            )
+            for shard_id in shard_ids
+        )
+    for step in steps:
+        await drain(step)
+
+    # The reference copies first: the account stays queued on the primary
+    # until they are gone.
+    for shard_id in sorted(shard_ids, key=lambda i: i == PRIMARY_SHARD):
+        await session.execute(
+            delete(User).where(User.id == user_id),
+            bind_arguments=on_shard(shard_id),
+        )
+        await session.commit()
+    ACCOUNT_DELETION_ROWS.labels("users").inc()
+
+
+async def delete_accounts(
+    session: AsyncSession, batch_size: int = ACCOUNT_DELETION_BATCH_SIZE
+) -> int:
+    """
+    The delete_accounts function erases up to batch_size deleted accounts
+    one after the other, oldest deletion first. An account whose erasure
+    fails is logged and left for the next run, after the others.
+
+    :param session: AsyncSession: Connect to the database
+    :param batch_size: int: Number of accounts, and upper bound of rows
+        changed by one statement
+    :return: The number of erased accounts
+    """
+    pending = await session.execute(
+        select(func.count(User.id)).where(User.deleted_at.is_not(None)),
+        bind_arguments=on_shard(PRIMARY_SHARD),
+    )
+    PENDING_ACCOUNT_DELETIONS.set(pending.scalar())
+
+    response = await session.execute(
+        select(User.id)
+        .where(User.deleted_at.is_not(None))
+        .order_by(User.deleted_at)
+        .limit(batch_size),
+        bind_arguments=on_shard(PRIMARY_SHARD),
+    )
+    erased = 0
+    for user_id in response.scalars().all():
+        try:
+            await erase_account(session, user_id, batch_size)
+        except Exception:
+            await session.rollback()
+            ACCOUNT_DELETION_FAILURES.inc()
+            logger.exception("Erasure of account %s failed", user_id)
+            continue
+        PENDING_ACCOUNT_DELETIONS.dec()
+        erased += 1
+    return erased
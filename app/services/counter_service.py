@@ -0,0 +1,250 @@
+import asyncio
+from collections import Counter
+from typing import Dict, List
+
+from sqlalchemy import case, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import COUNTER_REPAIR_BATCH_SIZE, COUNTER_REPAIR_PAUSE
+from core.metrics import COUNTER_DRIFT_REPAIRED
+from db.models import Tweet, User, followers
+
+COUNTERS = ("followers_count", "following_count", "tweets_count")
+
+
+async def change_counters(session: AsyncSession, user_id: int, **deltas: int):
+    """
+    The change_counters function adds deltas to the counters of a user, as
+    in change_counters(session, 1, tweets_count=1). It is executed in the
+    transaction of the write it accounts for and committed with it; the
+    increment happens in the database, so concurrent writers do not lose
+    updates.
+
+    :param session: AsyncSession: Connect to the database
+    :param user_id: int: User whose counters change
+    :param **deltas: int: Amount added to each named counter
+    :return: None
+    """
+    await session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(
+            {
+                getattr(User, name): getattr(User, name) + delta
+                for name, delta in deltas.items()
+            }
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def change_tweet_counters(
+    session: AsyncSession, tweet_id: int, **deltas: int
+):
+    """
+    The change_tweet_counters function is change_counters for the counters
+    of a tweet, as in change_tweet_counters(session, 5, retweets_count=1).
+    The update is routed to the shard of the tweet.
+
+    :param session: AsyncSession: Connect to the database
+    :param tweet_id: int: Tweet whose counters change
+    :param **deltas: int: Amount added to each named counter
+    :return: None
+    """
+    await session.execute(
+        update(Tweet)
+        .where(Tweet.id == tweet_id)
+        .values(
+            {
+                getattr(Tweet, name): getattr(Tweet, name) + delta
+                for name, delta in deltas.items()
+            }
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def change_follow_counters(
+    session: AsyncSession, follower_id: int, followed_id: int, delta: int
+):
+    """
+    The change_follow_counters function accounts for a follow added
+    (delta=1) or removed (delta=-1). Both users are updated in id order, so
+    two users following each other at the same time cannot deadlock.
+
+    :param session: AsyncSession: Connect to the database
+    :param follower_id: int: User who follows
+    :param followed_id: int: User who is followed
+    :param delta: int: 1 for a new follow, -1 for a removed one
+    :return: None
+    """
+    changes = {
+        follower_id: {"following_count": delta},
+        followed_id: {"followers_count": delta},
+    }
+    for user_id in sorted(changes):
+        await change_counters(session, user_id, **changes[user_id])
+
+
+async def change_many_counters(
+    session: AsyncSession, user_ids: List[int], **deltas: int
+):
+    """
+    The change_many_counters function is change_counters for many users at
+    once, the same deltas for each, in two statements whatever their
+    number: the rows are locked in id order first, as
+    change_bulk_follow_counters does.
+
+    :param session: AsyncSession: Connect to the database
+    :param user_ids: List[int]: Users whose counters change
+    :param **deltas: int: Amount added to each named counter
+    :return: None
+    """
+    await session.execute(
+        select(User.id)
+        .where(User.id.in_(user_ids))
+        .order_by(User.id)
+        .with_for_update()
+    )
+    await session.execute(
+        update(User)
+        .where(User.id.in_(user_ids))
+        .values(
+            {
+                getattr(User, name): getattr(User, name) + delta
+                for name, delta in deltas.items()
+            }
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def change_bulk_follow_counters(
+    session: AsyncSession,
+    follower_id: int,
+    followed_ids: List[int],
+    delta: int,
+):
+    """
+    The change_bulk_follow_counters function is change_follow_counters for
+    one user following (delta=1) or unfollowing (delta=-1) many, in two
+    statements whatever their number. The rows are locked in id order
+    first, so bulk and single follows cannot deadlock each other.
+
+    :param session: AsyncSession: Connect to the database
+    :param follower_id: int: User who follows
+    :param followed_ids: List[int]: Users whose follow was added or removed
+    :param delta: int: 1 for new follows, -1 for removed ones
+    :return: None
+    """
+    user_ids = [follower_id, *followed_ids]
+    await session.execute(
+        select(User.id)
+        .where(User.id.in_(user_ids))
+        .order_by(User.id)
+        .with_for_update()
+    )
+    await session.execute(
+        update(User)
+        .where(User.id.in_(user_ids))
+        .values(
+            followers_count=User.followers_count
+            + case((User.id.in_(followed_ids), delta), else_=0),
+            following_count=User.following_count
+            + case(
+                (User.id == follower_id, delta * len(followed_ids)), else_=0
+            ),
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def count_rows(
+    session: AsyncSession, user_ids: List[int]
+) -> Dict[str, Counter]:
+    """
+    The count_rows function counts, from the rows themselves, what the
+    counters of user_ids should say. Tweets marked as deleted are not
+    counted, they already disappeared from every read.
+
+    :param session: AsyncSession: Connect to the database
+    :param user_ids: List[int]: Users to count for
+    :return: The actual value of each counter by user id
+    """
+    statements = {
+        "followers_count": select(followers.c.followed_user_id, func.count())
+        .where(followers.c.followed_user_id.in_(user_ids))
+        .group_by(followers.c.followed_user_id),
+        "following_count": select(followers.c.following_user_id, func.count())
+        .where(followers.c.following_user_id.in_(user_ids))
+        .group_by(followers.c.following_user_id),
+        # Routed to the shards of these authors; the counts add up.
+        "tweets_count": select(Tweet.user_id, func.count())
+        .where(Tweet.user_id.in_(user_ids), Tweet.deleted_at.is_(None))
+        .group_by(Tweet.user_id),
+    }
+    actual = {}
+    for name, statement in statements.items():
+        actual[name] = Counter()
+        for user_id, count in await session.execute(statement):
+            actual[name][user_id] += count
+    return actual
+
+
+async def repair_counters(
+    session: AsyncSession, batch_size: int = COUNTER_REPAIR_BATCH_SIZE
+) -> int:
+    """
+    The repair_counters function walks the users in batches of batch_size,
+    recounts their followers, followings and tweets, and corrects the
+    counters that drifted: after a write spanning two shards failed half
+    way, or after followers rows went away with a deleted user.
+
+    :param session: AsyncSession: Connect to the database
+    :param batch_size: int: Number of users checked at once
+    :return: The number of corrected users
+    """
+    repaired = 0
+    last_id = 0
+    while True:
+        response = await session.execute(
+            select(User.id, *(getattr(User, name) for name in COUNTERS))
+            .where(User.id > last_id)
+            .order_by(User.id)
+            .limit(batch_size)
+        )
+        users = response.all()
+        if not users:
+            return repaired
+        last_id = users[-1].id
+
+        actual = await count_rows(session, [user.id for user in users])
+        for user in users:
+            changed = {
+                name: actual[name][user.id]
+                for name in COUNTERS
+                if getattr(user, name) != actual[name][user.id]
+            }
+            if not changed:
+                continue
+            # A write that committed since the batch was read has moved the
+            # counter already: leave that user to the next run.
+            result = await session.execute(
+                update(User)
+                .where(
+                    User.id == user.id,
+                    *(
+                        getattr(User, name) == getattr(user, name)
+                        for name in changed
+                    ),
+                )
+                .values(changed)
+                .execution_options(synchronize_session=False)
+            )
+            if not result.rowcount:
+                continue
+            for name in changed:
+                COUNTER_DRIFT_REPAIRED.labels(name).inc()
+            repaired += 1
+        await session.commit()
+        await asyncio.sleep(COUNTER_REPAIR_PAUSE)
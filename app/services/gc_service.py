@@ -0,0 +1,149 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Set
+
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import MEDIA_GC_BATCH_SIZE, MEDIA_GC_GRACE, MEDIA_GC_PAUSE
+from core.metrics import MEDIA_GC_DELETED, MEDIA_GC_RECLAIMED_BYTES
+from core.sharding import on_shard, router_of
+from core.snowflake import min_id_at
+from core.storage import get_storage
+from db.models import Media
+
+
+async def referenced_keys(
+    session: AsyncSession, keys: Iterable[str]
+) -> Set[str]:
+    """
+    The referenced_keys function returns the storage keys that a media row
+    on any shard still points to.
+
+    :param session: AsyncSession: Connect to the database
+    :param keys: Iterable[str]: Storage keys to look up
+    :return: The subset of keys that are in use
+    """
+    response = await session.execute(
+        select(Media.key).where(Media.key.in_(list(keys)))
+    )
+    return set(response.scalars())
+
+
+async def collect_shard_batch(
+    session: AsyncSession, shard_id: str, before_id: int, batch_size: int
+) -> int:
+    """
+    The collect_shard_batch function deletes at most batch_size media of one
+    shard that are not attached to a tweet and were created before
+    before_id, then the files that no other row points to. Rows go first:
+    if the run stops in between, the files are left to reconcile_storage.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard to collect
+    :param before_id: int: Media ids below this one are old enough
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :return: The number of deleted rows
+    """
+    response = await session.execute(
+        delete(Media)
+        .where(
+            Media.id.in_(
+                select(Media.id)
+                .where(Media.tweet_id.is_(None), Media.id < before_id)
+                .order_by(Media.id)
+                .limit(batch_size)
+                .scalar_subquery()
+            ),
+            # Attached since the batch was picked: keep it.
+            Media.tweet_id.is_(None),
+        )
+        .returning(Media.key, Media.size)
+        .execution_options(synchronize_session=False),
+        bind_arguments=on_shard(shard_id),
+    )
+    deleted = dict(response.all())
+    await session.commit()
+    MEDIA_GC_DELETED.labels("rows").inc(len(deleted))
+    if not deleted:
+        return 0
+
+    storage = get_storage()
+    in_use = await referenced_keys(session, deleted)
+    for key, size in deleted.items():
+        if key in in_use:
+            continue
+        # Pending presigned uploads have no recorded size yet.
+        if size is None:
+            size = await storage.size(key) or 0
+        await storage.delete(key)
+        MEDIA_GC_DELETED.labels("files").inc()
+        MEDIA_GC_RECLAIMED_BYTES.labels("unattached").inc(size)
+    return len(deleted)
+
+
+async def collect_orphaned_media(
+    session: AsyncSession,
+    batch_size: int = MEDIA_GC_BATCH_SIZE,
+    grace: int = MEDIA_GC_GRACE,
+) -> int:
+    """
+    The collect_orphaned_media function removes the media that were uploaded
+    more than grace seconds ago and never attached to a tweet, on every
+    shard, in batches of batch_size with a short pause in between. The
+    creation time comes from the snowflake id, so the unattached partial
+    index is all it needs.
+
+    :param session: AsyncSession: Connect to the database
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :param grace: int: Seconds an upload has to get attached
+    :return: The number of deleted media
+    """
+    before_id = min_id_at(
+        datetime.now(timezone.utc) - timedelta(seconds=grace)
+    )
+    collected = 0
+    for shard_id in router_of(session).shard_ids:
+        while True:
+            deleted = await collect_shard_batch(
+                session, shard_id, before_id, batch_size
+            )
+            collected += deleted
+            if deleted < batch_size:
+                break
+            await asyncio.sleep(MEDIA_GC_PAUSE)
+    return collected
+
+
+async def reconcile_storage(
+    session: AsyncSession, grace: int = MEDIA_GC_GRACE
+) -> int:
+    """
+    The reconcile_storage function walks the storage page by page and
+    deletes the files older than grace seconds that no media row points to:
+    leftovers of interrupted collections and purges, and uploads whose row
+    was never written. The grace period keeps files of uploads in progress.
+
+    :param session: AsyncSession: Connect to the database
+    :param grace: int: Minimum age of a file in seconds
+    :return: The number of deleted files
+    """
+    storage = get_storage()
+    modified_before = datetime.now(timezone.utc) - timedelta(seconds=grace)
+    removed = 0
+    async for page in storage.list_objects():
+        candidates = [item for item in page if item.modified < modified_before]
+        if not candidates:
+            continue
+        in_use = await referenced_keys(
+            session, (item.key for item in candidates)
+        )
+        for item in candidates:
+            if item.key in in_use:
+                continue
+            await storage.delete(item.key)
+            MEDIA_GC_DELETED.labels("files").inc()
+            MEDIA_GC_RECLAIMED_BYTES.labels("unreferenced").inc(item.size)
+            removed += 1
+        await asyncio.sleep(MEDIA_GC_PAUSE)
+    return removed
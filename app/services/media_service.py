@@ -1,25 +1,205 @@
-from sqlalchemy import insert
+from typing import AsyncIterator
+
+from sqlalchemy import insert, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from db.models import Media
+from core.config import MEDIA_MAX_SIZE, UPLOAD_URL_EXPIRES
 from core.exceptions import BackendException
+from core.sharding import bucket_for_user
+from core.snowflake import next_id
+from core.storage import LocalStorage, UploadTooLarge, get_storage, new_key
+from core.tracing import traced
+from db.models import Media, User
+from dependencies import get_user_by_api_key
+
+IMAGE_TYPES = ("image/jpeg", "image/png")
+
+
+@traced
+async def insert_media(
+    session: AsyncSession, user: User, key: str, size=None
+) -> int:
+    """
+    The insert_media function records a media object stored under key.
+    The id carries the uploader's shard bucket, so the media sits next to
+    the tweets it is attached to.
+
+    :param session: AsyncSession: Pass the session object to the function
+    :param user: User: The uploader
+    :param key: str: Key of the file in core.storage
+    :param size: Size of the file in bytes, None while the upload is pending
+    :return: The id of the new media
+    :doc-author: Trelent
+    """
+    media_id = next_id(bucket_for_user(user.id))
+    await session.execute(
+        insert(Media).values(
+            id=media_id,
+            name=get_storage().url(key),
+            key=key,
+            size=size,
+            user_id=user.id,
+        )
+    )
+    await session.commit()
+    return media_id
+
+
+@traced
+async def post_image(
+    session: AsyncSession,
+    api_key: str,
+    filename: str,
+    data: bytes,
+    content_type: str,
+) -> dict:
+    """
+    The post_image function takes in a session, the uploader's api_key and
+    an uploaded file, stores the file and returns the media_id of the newly
+    created image.
+
+    :param session: AsyncSession: Pass the session object to the function
+    :param api_key: str: Get the user who uploads the image
+    :param filename: str: Name of the uploaded file, only its extension is
+        kept
+    :param data: bytes: Content of the file
+    :param content_type: str: MIME type of the file
+    :return: A dictionary with the result and media_id
+    :doc-author: Trelent
+    """
+    check_content_type(content_type)
+    if len(data) > MEDIA_MAX_SIZE:
+        raise BackendException(
+            error_type="BAD FILE", error_message="File is too large"
+        )
+    user = await get_user_by_api_key(session=session, api_key=api_key)
+
+    key = new_key(filename)
+    await get_storage().save(key, data, content_type)
+    media_id = await insert_media(session, user, key, size=len(data))
+    return {"result": True, "media_id": media_id}
+
 
+@traced
+async def presign_image_upload(
+    session: AsyncSession, api_key: str, filename: str, content_type: str
+) -> dict:
+    """
+    The presign_image_upload function records a pending media and returns
+    the request that uploads its file straight to the storage, so the bytes
+    never pass through the app. The client then confirms the upload with
+    complete_image_upload.
+
+    :param session: AsyncSession: Pass the session object to the function
+    :param api_key: str: Get the user who uploads the image
+    :param filename: str: Name of the file, only its extension is kept
+    :param content_type: str: MIME type the client will send
+    :return: A dictionary with the media_id and the upload method, url and
+        headers
+    :doc-author: Trelent
+    """
+    check_content_type(content_type)
+    user = await get_user_by_api_key(session=session, api_key=api_key)
+
+    key = new_key(filename)
+    media_id = await insert_media(session, user, key)
+    upload = get_storage().presign_upload(
+        key, content_type, UPLOAD_URL_EXPIRES
+    )
+    return {
+        "result": True,
+        "media_id": media_id,
+        "method": upload["method"],
+        "upload_url": upload["url"],
+        "headers": upload["headers"],
+    }
 
-async def post_image(session: AsyncSession, image_name: str) -> dict:
+
+@traced
+async def complete_image_upload(
+    session: AsyncSession, api_key: str, media_id: int
+) -> dict:
+    """
+    The complete_image_upload function checks that the file of a presigned
+    upload has arrived in the storage and records its size. A file above
+    MEDIA_MAX_SIZE is deleted and refused.
+
+    :param session: AsyncSession: Pass the session object to the function
+    :param api_key: str: Get the user who uploaded the image
+    :param media_id: int: Media returned by presign_image_upload
+    :return: A dictionary with the result and media_id
+    :doc-author: Trelent
     """
-The post_image function takes in a session and an image name,
-and returns the media_id of the newly created image.
+    user = await get_user_by_api_key(session=session, api_key=api_key)
+    response = await session.execute(
+        select(Media.key).where(Media.id == media_id, Media.user_id == user.id)
+    )
+    key = response.scalar_one_or_none()
+    if key is None:
+        raise BackendException(
+            error_type="NO MEDIA", error_message="No media with such id"
+        )
 
+    size = await get_storage().size(key)
+    if size is None:
+        raise BackendException(
+            error_type="NO UPLOAD", error_message="File was not uploaded"
+        )
+    # An object store takes whatever a presigned url is sent.
+    if size > MEDIA_MAX_SIZE:
+        await get_storage().delete(key)
+        raise BackendException(
+            error_type="BAD FILE", error_message="File is too large"
+        )
 
-:param session: AsyncSession: Pass the session object to the function
-:param image_name: str: Pass the name of the image to be inserted into the database
-:return: A dictionary with the result and media_id
-:doc-author: Trelent
-"""
-    img = await session.execute(insert(Media).values(name=image_name))
-    image_id = img.inserted_primary_key[0]
+    await session.execute(
+        update(Media).where(Media.id == media_id).values(size=size)
+    )
     await session.commit()
-    return {"result": True, "media_id": image_id}
+    return {"result": True, "media_id": media_id}
+
+
+@traced
+async def receive_upload(
+    key: str,
+    content_type: str,
+    expires: int,
+    signature: str,
+    chunks: AsyncIterator[bytes],
+):
+    """
+    The receive_upload function stores the body of a presigned upload when
+    the local storage is used, as there is no object store to send it to.
+
+    :param key: str: Key of the file from the upload url
+    :param content_type: str: Content-Type header of the upload
+    :param expires: int: Expiry from the upload url
+    :param signature: str: Signature from the upload url
+    :param chunks: AsyncIterator[bytes]: Body of the request
+    :return: Nothing
+    :doc-author: Trelent
+    """
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage) or not storage.check_upload(
+        key, content_type, expires, signature
+    ):
+        raise BackendException(
+            error_type="BAD UPLOAD",
+            error_message="Upload url is invalid or expired",
+        )
+    try:
+        await storage.save_stream(key, chunks, MEDIA_MAX_SIZE)
+    except UploadTooLarge:
+        raise BackendException(
+            error_type="BAD FILE", error_message="File is too large"
+        )
+
+
+def check_content_type(content_type: str):
+    if content_type not in IMAGE_TYPES:
+        raise BackendException(
+            error_type="BAD FILE", error_message="Bad file type"
+        )
 
 
 def check_file(file):
@@ -32,5 +212,4 @@ def check_file(file):
     :return: True if the file is a jpeg or png, and raises an exception otherwise
     :doc-author: Trelent
     """
-    if file.content_type not in ("image/jpeg", "image/png"):
-        raise BackendException(error_type="BAD FILE", error_message="Bad file type")
+    check_content_type(file.content_type)
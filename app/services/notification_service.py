@@ -0,0 +1,266 @@
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from core.config import NOTIFICATIONS_PAGE_SIZE, NOTIFY_FLUSH_ATTEMPTS
+from core.database import insert_for
+from core.metrics import (
+    NOTIFICATION_EVENTS,
+    NOTIFICATION_GROUPS_DROPPED,
+    NOTIFICATION_ROWS_WRITTEN,
+)
+from core.sharding import bucket_for_user
+from core.snowflake import next_id
+from core.tracing import traced
+from db.models import Notification
+from dependencies import get_user_by_api_key
+from services.counter_service import change_counters
+
+# Events not written yet, coalesced by notification group
+# (user_id, kind, tweet_id) into (latest actor_id, number of events, seq
+# of the latest event).
+pending: Dict[Tuple[int, str, int], Tuple[int, int, int]] = {}
+# Failed writes of the groups being retried.
+attempts: Dict[Tuple[int, str, int], int] = {}
+
+
+def notify(user_id: int, kind: str, actor_id: int, tweet_id: int = 0):
+    """
+    The notify function queues an event for user_id. It only touches
+    memory: a burst of likes on one tweet becomes a single row update at
+    the next flush_notifications.
+
+    :param user_id: int: User to notify
+    :param kind: str: "like" or "follow"
+    :param actor_id: int: User who liked or followed
+    :param tweet_id: int: Liked tweet, 0 for follows
+    :return: None
+    """
+    if user_id == actor_id:
+        return
+    NOTIFICATION_EVENTS.labels(kind).inc()
+    key = (user_id, kind, tweet_id)
+    _, count, _ = pending.get(key, (actor_id, 0, 0))
+    pending[key] = (actor_id, count + 1, next_id(bucket_for_user(user_id)))
+
+
+async def write_groups(
+    session: AsyncSession,
+    groups: Dict[Tuple[int, str, int], Tuple[int, int, int]],
+) -> int:
+    """
+    The write_groups function writes some of the queued groups in one
+    transaction. Missing rows are inserted first: the unique group keeps
+    concurrent workers from inserting the same row twice, so a row returned
+    by this insert is new and unread for this worker alone. The other rows
+    exist by then; they are locked, their unread flag read, and updated in
+    one upsert. Every group adds its events to actors_count, takes the
+    latest actor, moves to the top and becomes unread; the unread counter
+    of a user grows by the groups that were not unread yet. Rows are
+    inserted and locked in key order, so concurrent workers cannot
+    deadlock.
+
+    :param session: AsyncSession: Connect to the database
+    :param groups: Dict: Queued events by group, as in pending
+    :return: The number of notification rows written
+    """
+    keys = sorted(groups)
+    rows = []
+    for user_id, kind, tweet_id in keys:
+        actor_id, count, seq = groups[user_id, kind, tweet_id]
+        rows.append(
+            {
+                "user_id": user_id,
+                "kind": kind,
+                "tweet_id": tweet_id,
+                "actor_id": actor_id,
+                "actors_count": count,
+                "seq": seq,
+            }
+        )
+    group = tuple_(
+        Notification.user_id, Notification.kind, Notification.tweet_id
+    )
+    response = await session.execute(
+        insert_for(session, Notification)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=[*group.clauses])
+        .returning(*group.clauses)
+    )
+    inserted = set(map(tuple, response.all()))
+    newly_unread = Counter(user_id for user_id, _, _ in inserted)
+
+    existing = [row for key, row in zip(keys, rows) if key not in inserted]
+    if existing:
+        response = await session.execute(
+            select(*group.clauses, Notification.unread)
+            .where(group.in_([key for key in keys if key not in inserted]))
+            .order_by(*group.clauses)
+            .with_for_update()
+        )
+        already_unread = {
+            (user_id, kind, tweet_id)
+            for user_id, kind, tweet_id, unread in response.all()
+            if unread
+        }
+        statement = insert_for(session, Notification).values(existing)
+        await session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[*group.clauses],
+                set_={
+                    "actor_id": statement.excluded.actor_id,
+                    "actors_count": Notification.actors_count
+                    + statement.excluded.actors_count,
+                    "seq": statement.excluded.seq,
+                    "unread": True,
+                },
+            )
+        )
+        newly_unread.update(
+            row["user_id"]
+            for row in existing
+            if (row["user_id"], row["kind"], row["tweet_id"])
+            not in already_unread
+        )
+
+    for user_id in sorted(newly_unread):
+        await change_counters(
+            session, user_id, unread_notifications=newly_unread[user_id]
+        )
+    await session.commit()
+    return len(rows)
+
+
+def requeue(key: Tuple[int, str, int], events: Tuple[int, int, int]):
+    """
+    The requeue function puts back the events of a group whose write
+    failed, or drops them once the group failed NOTIFY_FLUSH_ATTEMPTS
+    times, e.g. because its actor was erased meanwhile.
+
+    :param key: Tuple[int, str, int]: Group of the events
+    :param events: Tuple[int, int, int]: Events of the group, as in pending
+    :return: None
+    """
+    attempts[key] = attempts.get(key, 0) + 1
+    if attempts[key] >= NOTIFY_FLUSH_ATTEMPTS:
+        del attempts[key]
+        NOTIFICATION_GROUPS_DROPPED.inc()
+        return
+    actor_id, count, seq = events
+    # Events queued during the failed write are the latest ones.
+    latest, queued, latest_seq = pending.get(key, (actor_id, 0, seq))
+    pending[key] = (latest, queued + count, latest_seq)
+
+
+async def flush_notifications(session: AsyncSession) -> int:
+    """
+    The flush_notifications function writes the queued events with
+    write_groups, in one transaction for all of them. Groups whose write
+    failed before are written in a transaction each instead, so that one
+    bad row cannot hold back the others; they are dropped after
+    NOTIFY_FLUSH_ATTEMPTS failures. When a write fails its events are
+    queued again and the error raised once the other groups are written.
+
+    :param session: AsyncSession: Connect to the database
+    :return: The number of notification rows written
+    """
+    if not pending:
+        return 0
+    batch = dict(pending)
+    pending.clear()
+    fresh = {
+        key: events for key, events in batch.items() if key not in attempts
+    }
+    retried = sorted(key for key in batch if key in attempts)
+
+    written = 0
+    error = None
+    for groups in [fresh, *({key: batch[key]} for key in retried)]:
+        if not groups:
+            continue
+        try:
+            written += await write_groups(session, groups)
+        except Exception as e:
+            await session.rollback()
+            for key, events in groups.items():
+                requeue(key, events)
+            error = e
+            continue
+        for key in groups:
+            attempts.pop(key, None)
+    NOTIFICATION_ROWS_WRITTEN.inc(written)
+    if error is not None:
+        raise error
+    return written
+
+
+@traced
+async def get_notifications(
+    session: AsyncSession,
+    api_key: str,
+    cursor: Optional[int] = None,
+    limit: int = NOTIFICATIONS_PAGE_SIZE,
+):
+    """
+    The get_notifications function returns a page of the notifications of
+    a user, latest first, and the number of unread ones, which is a column
+    of the user. The cursor is the seq of the last notification of the
+    previous page.
+
+    :param session: AsyncSession: Connect to the database
+    :param api_key: str: Identify the user
+    :param cursor: Optional[int]: next_cursor of the previous page
+    :param limit: int: Number of notifications per page
+    :return: A dictionary with the result, unread_count, notifications and
+        next_cursor keys
+    """
+    user = await get_user_by_api_key(session=session, api_key=api_key)
+    query = (
+        select(Notification)
+        .options(selectinload(Notification.actor))
+        .where(Notification.user_id == user.id)
+        .order_by(Notification.seq.desc())
+        .limit(limit + 1)
+    )
+    if cursor is not None:
+        query = query.where(Notification.seq < cursor)
+    response = await session.execute(query)
+    notifications = response.scalars().all()
+
+    next_cursor = (
+        notifications[limit - 1].seq if len(notifications) > limit else None
+    )
+    return {
+        "result": True,
+        "unread_count": user.unread_notifications,
+        "notifications": notifications[:limit],
+        "next_cursor": next_cursor,
+    }
+
+
+@traced
+async def read_notifications(session: AsyncSession, api_key: str):
+    """
+    The read_notifications function marks every notification of a user as
+    read and takes them off the unread counter. The counter goes down by
+    the rows marked rather than to 0: a flush committed meanwhile has
+    counted rows this update did not see, and they are still unread.
+
+    :param session: AsyncSession: Connect to the database
+    :param api_key: str: Identify the user
+    :return: None
+    """
+    user = await get_user_by_api_key(session=session, api_key=api_key)
+    result = await session.execute(
+        update(Notification)
+        .where(Notification.user_id == user.id, Notification.unread)
+        .values(unread=False)
+        .execution_options(synchronize_session=False)
+    )
+    await change_counters(
+        session, user.id, unread_notifications=-result.rowcount
+    )
+    await session.commit()
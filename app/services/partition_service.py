@@ -0,0 +1,216 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import delete, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import (
+    PARTITION_LOCK_TIMEOUT,
+    PARTITION_MONTHS_AHEAD,
+    PARTITION_PAUSE,
+    PARTITION_RETENTION_MONTHS,
+    PURGE_BATCH_SIZE,
+)
+from core.database import dialect_of
+from core.metrics import DETACHED_PARTITIONS, PURGED_FILES, TABLE_PARTITIONS
+from core.partitions import (
+    PARTITION_KEYS,
+    Partition,
+    create_partitions,
+    detach_partition,
+    expired_partitions,
+    is_partitioned,
+    list_partitions,
+    month_start,
+)
+from core.sharding import on_shard, router_of
+from core.storage import get_storage
+from db.models import Media, TweetHashtag, TweetMention
+
+
+async def run_ddl(session: AsyncSession, shard_id: str, function, *args):
+    """
+    The run_ddl function calls function(connection, *args) with the
+    synchronous connection of the session to shard_id, after capping the
+    wait for locks of the transaction: DDL on a partitioned table waits for
+    the queries reading it, and every query arriving later waits behind the
+    DDL.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard to run on
+    :param function: Function of core.partitions to call
+    :param *args: Arguments after the connection
+    :return: The result of function
+    """
+    connection = await session.connection(bind_arguments=on_shard(shard_id))
+    await connection.execute(
+        text(f"SET LOCAL lock_timeout = '{PARTITION_LOCK_TIMEOUT}s'")
+    )
+    return await connection.run_sync(function, *args)
+
+
+async def delete_tweet_dependents(
+    session: AsyncSession,
+    shard_id: str,
+    partition: Partition,
+    batch_size: int,
+):
+    """
+    The delete_tweet_dependents function deletes, in batches of batch_size,
+    the media files and the media, hashtag and mention rows of the tweets of
+    partition, whose foreign keys would otherwise keep it from being
+    detached.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard holding the partition
+    :param partition: Partition: Partition of tweets about to be detached
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :return: None
+    """
+
+    def in_partition(column):
+        if partition.lower is None:
+            return column < partition.upper
+        return column.between(partition.lower, partition.upper - 1)
+
+    while True:
+        response = await session.execute(
+            select(Media.id, Media.key)
+            .where(in_partition(Media.tweet_id))
+            .limit(batch_size),
+            bind_arguments=on_shard(shard_id),
+        )
+        medias = response.all()
+        if not medias:
+            break
+        for _, key in medias:
+            await get_storage().delete(key)
+            PURGED_FILES.inc()
+        await session.execute(
+            delete(Media).where(
+                Media.id.in_([media_id for media_id, _ in medias])
+            ),
+            bind_arguments=on_shard(shard_id),
+        )
+        await session.commit()
+        await asyncio.sleep(PARTITION_PAUSE)
+
+    for model in (TweetHashtag, TweetMention):
+        while True:
+            result = await session.execute(
+                delete(model).where(
+                    model.tweet_id.in_(
+                        select(model.tweet_id)
+                        .where(in_partition(model.tweet_id))
+                        .limit(batch_size)
+                        .scalar_subquery()
+                    )
+                ),
+                bind_arguments=on_shard(shard_id),
+            )
+            await session.commit()
+            if not result.rowcount:
+                break
+            await asyncio.sleep(PARTITION_PAUSE)
+
+
+async def maintain_shard(
+    session: AsyncSession,
+    shard_id: str,
+    now: datetime,
+    months_ahead: int,
+    retention_months: int,
+    batch_size: int,
+):
+    """
+    The maintain_shard function keeps the partitions of one shard: it
+    creates those of the next months_ahead months, then, with a positive
+    retention_months, detaches the partitions of likes and then of tweets
+    older than retention_months months. Tables and partitions are handled
+    in a transaction each, so a lock timeout only postpones the rest to the
+    next run.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard to maintain
+    :param now: datetime: Current time
+    :param months_ahead: int: Months of partitions created in advance
+    :param retention_months: int: Months of partitions kept attached, 0 to
+        keep them all
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :return: None
+    """
+    for table in PARTITION_KEYS:
+        await run_ddl(
+            session, shard_id, create_partitions, table, now, months_ahead
+        )
+        await session.commit()
+
+    if retention_months > 0:
+        before = month_start(now, -retention_months)
+        # Likes first: they reference the tweets of the same month.
+        for table in reversed(list(PARTITION_KEYS)):
+            expired = await run_ddl(
+                session, shard_id, expired_partitions, table, before
+            )
+            await session.commit()
+            for partition in expired:
+                if table == "tweets":
+                    await delete_tweet_dependents(
+                        session, shard_id, partition, batch_size
+                    )
+                await run_ddl(
+                    session, shard_id, detach_partition, table, partition.name
+                )
+                await session.commit()
+                DETACHED_PARTITIONS.labels(table).inc()
+
+    for table in PARTITION_KEYS:
+        partitions = await run_ddl(session, shard_id, list_partitions, table)
+        TABLE_PARTITIONS.labels(table).set(len(partitions))
+    await session.commit()
+
+
+async def maintain_partitions(
+    session: AsyncSession,
+    months_ahead: int = PARTITION_MONTHS_AHEAD,
+    retention_months: int = PARTITION_RETENTION_MONTHS,
+    batch_size: int = PURGE_BATCH_SIZE,
+    now: Optional[datetime] = None,
+) -> bool:
+    """
+    The maintain_partitions function runs maintain_shard on every shard
+    whose tweets are partitioned, see core.partitions. It does nothing on
+    SQLite or on tables left plain. Tweets of detached partitions leave
+    every read and, on the next repair_counters, the counters of their
+    authors; the detached tables stay in the database for archiving.
+
+    :param session: AsyncSession: Connect to the database
+    :param months_ahead: int: Months of partitions created in advance
+    :param retention_months: int: Months of partitions kept attached, 0 to
+        keep them all
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :param now: Optional[datetime]: Current time, for tests
+    :return: True if a shard was maintained
+    """
+    if dialect_of(session) == "sqlite":
+        return False
+
+    now = now or datetime.now(timezone.utc)
+    maintained = False
+    for shard_id in router_of(session).shard_ids:
+        partitioned = await run_ddl(
+            session, shard_id, is_partitioned, "tweets"
+        )
+        await session.commit()
+        if partitioned:
+            await maintain_shard(
+                session,
+                shard_id,
+                now,
+                months_ahead,
+                retention_months,
+                batch_size,
+            )
+            maintained = True
+    return maintained
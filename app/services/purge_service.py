@@ -0,0 +1,185 @@
+import asyncio
+import logging
+
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import PURGE_BATCH_SIZE, PURGE_PAUSE
+from core.metrics import (
+    PURGE_FAILURES,
+    PURGE_PENDING_TWEETS,
+    PURGED_FILES,
+    PURGED_ROWS,
+)
+from core.sharding import on_shard, router_of
+from core.storage import get_storage
+from db.models import Like, Media, Tweet
+
+logger = logging.getLogger(__name__)
+
+
+async def purge_tweet_likes(
+    session: AsyncSession, shard_id: str, tweet_id: int, batch_size: int
+) -> int:
+    """
+    The purge_tweet_likes function deletes at most batch_size likes of a
+    tweet and commits, so a viral tweet never holds locks on all of its likes
+    at once.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard holding the tweet
+    :param tweet_id: int: Tweet whose likes are removed
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :return: The number of deleted likes
+    """
+    result = await session.execute(
+        delete(Like).where(
+            Like.tweet_id == tweet_id,
+            Like.id.in_(
+                select(Like.id)
+                .where(Like.tweet_id == tweet_id)
+                .limit(batch_size)
+                .scalar_subquery()
+            ),
+        ),
+        bind_arguments=on_shard(shard_id),
+    )
+    await session.commit()
+    PURGED_ROWS.labels("likes").inc(result.rowcount)
+    return result.rowcount
+
+
+async def purge_tweet_media(
+    session: AsyncSession, shard_id: str, tweet_id: int, batch_size: int
+) -> int:
+    """
+    The purge_tweet_media function deletes the files of at most batch_size
+    media of a tweet from the storage, then their rows.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard holding the tweet
+    :param tweet_id: int: Tweet whose media are removed
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :return: The number of deleted media rows
+    """
+    response = await session.execute(
+        select(Media.id, Media.key)
+        .where(Media.tweet_id == tweet_id)
+        .limit(batch_size),
+        bind_arguments=on_shard(shard_id),
+    )
+    medias = response.all()
+    if not medias:
+        return 0
+
+    for _, key in medias:
+        await get_storage().delete(key)
+        PURGED_FILES.inc()
+
+    await session.execute(
+        delete(Media).where(
+            Media.id.in_([media_id for media_id, _ in medias])
+        ),
+        bind_arguments=on_shard(shard_id),
+    )
+    await session.commit()
+    PURGED_ROWS.labels("medias").inc(len(medias))
+    return len(medias)
+
+
+async def purge_tweet(
+    session: AsyncSession, shard_id: str, tweet_id: int, batch_size: int
+):
+    """
+    The purge_tweet function removes a soft-deleted tweet: its likes and
+    media in batches of batch_size with a short pause in between, then the
+    tweet row itself, last, so an interrupted purge can be run again.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard holding the tweet
+    :param tweet_id: int: Tweet to purge
+    :param batch_size: int: Upper bound of rows deleted by one statement
+    :return: None
+    """
+    while await purge_tweet_likes(session, shard_id, tweet_id, batch_size):
+        await asyncio.sleep(PURGE_PAUSE)
+    while await purge_tweet_media(session, shard_id, tweet_id, batch_size):
+        await asyncio.sleep(PURGE_PAUSE)
+
+    await session.execute(
+        delete(Tweet).where(
+            Tweet.id == tweet_id, Tweet.deleted_at.is_not(None)
+        ),
+        bind_arguments=on_shard(shard_id),
+    )
+    await session.commit()
+    PURGED_ROWS.labels("tweets").inc()
+
+
+async def purge_shard(
+    session: AsyncSession, shard_id: str, batch_size: int
+) -> int:
+    """
+    The purge_shard function removes up to batch_size soft-deleted tweets of
+    one shard together with their likes and media. Dependent rows go in
+    batches of batch_size with a short pause in between, and the tweet row
+    itself is deleted last, so an interrupted run is picked up again on the
+    next call. A tweet whose purge fails, e.g. on a storage error, is
+    logged and left for the next run, after the other tweets of the batch.
+
+    :param session: AsyncSession: Connect to the database
+    :param shard_id: str: Shard to purge
+    :param batch_size: int: Number of tweets, and of dependent rows per
+        statement
+    :return: The number of purged tweets
+    """
+    response = await session.execute(
+        select(Tweet.id)
+        .where(Tweet.deleted_at.is_not(None))
+        .order_by(Tweet.deleted_at)
+        .limit(batch_size),
+        bind_arguments=on_shard(shard_id),
+    )
+    tweet_ids = response.scalars().all()
+
+    purged = 0
+    for tweet_id in tweet_ids:
+        try:
+            await purge_tweet(session, shard_id, tweet_id, batch_size)
+        except Exception:
+            await session.rollback()
+            PURGE_FAILURES.inc()
+            logger.exception("Purge of tweet %s failed", tweet_id)
+            continue
+        PURGE_PENDING_TWEETS.dec()
+        purged += 1
+
+    return purged
+
+
+async def purge_deleted_tweets(
+    session: AsyncSession, batch_size: int = PURGE_BATCH_SIZE
+) -> int:
+    """
+    The purge_deleted_tweets function runs purge_shard on every shard in
+    turn.
+
+    :param session: AsyncSession: Connect to the database
+    :param batch_size: int: Number of tweets per shard, and of dependent rows
+        per statement
+    :return: The number of purged tweets
+    """
+    shard_ids = router_of(session).shard_ids
+    pending = 0
+    for shard_id in shard_ids:
+        response = await session.execute(
+            select(func.count()).where(Tweet.deleted_at.is_not(None)),
+            bind_arguments=on_shard(shard_id),
+        )
+        pending += response.scalar()
+    PURGE_PENDING_TWEETS.set(pending)
+
+    purged = 0
+    for shard_id in shard_ids:
+        purged += await purge_shard(session, shard_id, batch_size)
+    return purged
@@ -0,0 +1,133 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import Float, Integer, cast, func, literal, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import (
+    RANK_GRAVITY,
+    RESCORE_BATCH_SIZE,
+    RESCORE_PAUSE,
+    RESCORE_WINDOW,
+)
+from core.sharding import on_shard, router_of
+from core.snowflake import EPOCH_MS, TIMESTAMP_SHIFT, min_id_at
+from db.models import Tweet
+
+MS_PER_HOUR = 3600 * 1000
+
+
+def rank_score(
+    likes: int, created: datetime, now: datetime, gravity: float = RANK_GRAVITY
+) -> float:
+    """
+    The rank_score function is the gravity ranking of a tweet: its likes,
+    divided by its age in hours plus two raised to gravity, so a tweet needs
+    ever more likes to stay on top as it gets older.
+
+    :param likes: int: Number of likes
+    :param created: datetime: When the tweet was posted
+    :param now: datetime: Moment the score is computed for
+    :param gravity: float: How fast scores decay
+    :return: The score
+    """
+    age = max((now - created).total_seconds() / 3600, 0)
+    return likes / (age + 2) ** gravity
+
+
+def score_of(likes, now: datetime):
+    """
+    The score_of function is rank_score as an SQL expression over tweets,
+    with the creation time read from the snowflake id.
+
+    :param likes: Expression giving the number of likes
+    :param now: datetime: Moment the score is computed for
+    :return: The SQL expression of the score
+    """
+    now_ms = int(now.timestamp() * 1000)
+    # Postgres only shifts a bigint by an integer.
+    shift = literal(TIMESTAMP_SHIFT, Integer)
+    created_ms = Tweet.id.op(">>")(shift) + EPOCH_MS
+    age = cast(now_ms - created_ms, Float) / MS_PER_HOUR
+    return likes / func.power(func.greatest(age, 0) + 2, RANK_GRAVITY)
+
+
+async def change_likes(
+    session: AsyncSession,
+    tweet_id: int,
+    shard_id: str,
+    delta: int,
+    now: Optional[datetime] = None,
+):
+    """
+    The change_likes function adds delta to the likes of a tweet and scores
+    it again, in the transaction of the like or unlike it accounts for.
+
+    :param session: AsyncSession: Connect to the database
+    :param tweet_id: int: Tweet that was liked or unliked
+    :param shard_id: str: Shard holding the tweet
+    :param delta: int: 1 for a like, -1 for an unlike
+    :param now: Optional[datetime]: Moment of the change, now by default
+    :return: None
+    """
+    now = now or datetime.now(timezone.utc)
+    await session.execute(
+        update(Tweet)
+        .where(Tweet.id == tweet_id)
+        .values(
+            likes_count=Tweet.likes_count + delta,
+            score=score_of(Tweet.likes_count + delta, now),
+        )
+        .execution_options(synchronize_session=False),
+        bind_arguments=on_shard(shard_id),
+    )
+
+
+async def rescore_recent(
+    session: AsyncSession,
+    window: int = RESCORE_WINDOW,
+    batch_size: int = RESCORE_BATCH_SIZE,
+    now: Optional[datetime] = None,
+) -> int:
+    """
+    The rescore_recent function brings the scores of the tweets posted in
+    the last window seconds up to date, on every shard, in batches of
+    batch_size along the primary key. Scores of older tweets are left as
+    they were when they last changed: by then they are too small to compete
+    with recent tweets.
+
+    :param session: AsyncSession: Connect to the database
+    :param window: int: Age in seconds of the oldest tweet rescored
+    :param batch_size: int: Upper bound of rows updated by one statement
+    :param now: Optional[datetime]: Moment the scores are computed for
+    :return: The number of rescored tweets
+    """
+    now = now or datetime.now(timezone.utc)
+    first_id = min_id_at(now - timedelta(seconds=window))
+    rescored = 0
+    for shard_id in router_of(session).shard_ids:
+        last_id = first_id - 1
+        while True:
+            batch = (
+                select(Tweet.id)
+                .where(Tweet.id > last_id, Tweet.deleted_at.is_(None))
+                .order_by(Tweet.id)
+                .limit(batch_size)
+            )
+            response = await session.execute(
+                update(Tweet)
+                .where(Tweet.id.in_(batch.scalar_subquery()))
+                .values(score=score_of(Tweet.likes_count, now))
+                .returning(Tweet.id)
+                .execution_options(synchronize_session=False),
+                bind_arguments=on_shard(shard_id),
+            )
+            ids = response.scalars().all()
+            await session.commit()
+            rescored += len(ids)
+            if len(ids) < batch_size:
+                break
+            last_id = max(ids)
+            await asyncio.sleep(RESCORE_PAUSE)
+    return rescored
@@ -0,0 +1,173 @@
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.database import insert_for
+from core.sharding import on_shard, router_of
+from db.models import Tweet, TweetHashtag, TweetMention, User
+
+HASHTAG = re.compile(r"(?<![\w#])#(\w+)")
+MENTION = re.compile(r"(?<![\w@])@(\w+)")
+# Longer words are not indexed, so no key outgrows a btree page.
+MAX_TAG_LENGTH = 100
+
+
+def extract_tags(pattern: re.Pattern, text: str) -> List[str]:
+    """Distinct lowercased matches of ``pattern``, in order of appearance."""
+    tags = (match.lower() for match in pattern.findall(text or ""))
+    return list(dict.fromkeys(t for t in tags if len(t) <= MAX_TAG_LENGTH))
+
+
+def extract_hashtags(text: str) -> List[str]:
+    return extract_tags(HASHTAG, text)
+
+
+def extract_mentions(text: str) -> List[str]:
+    return extract_tags(MENTION, text)
+
+
+async def find_mentioned(
+    session: AsyncSession, names: Iterable[str]
+) -> Dict[str, List[int]]:
+    """
+    The find_mentioned function resolves mentioned names, lowercased, to
+    the ids of the live users bearing them, in one query.
+
+    :param session: AsyncSession: Connect to the database
+    :param names: Iterable[str]: Lowercased names
+    :return: The ids of the users of each name found, in id order
+    """
+    names = list(names)
+    if not names:
+        return {}
+    response = await session.execute(
+        select(func.lower(User.name), User.id)
+        .where(func.lower(User.name).in_(names), User.deleted_at.is_(None))
+        .order_by(User.id)
+    )
+    users: Dict[str, List[int]] = defaultdict(list)
+    for name, user_id in response.all():
+        users[name].append(user_id)
+    return users
+
+
+async def insert_tags(
+    session: AsyncSession,
+    hashtags: List[dict],
+    mentions: List[dict],
+    shard_id: str,
+):
+    """
+    The insert_tags function inserts hashtag and mention rows on shard_id,
+    in one statement each, keeping the rows already there.
+
+    :param session: AsyncSession: Connect to the database
+    :param hashtags: List[dict]: Rows of tweet_hashtags
+    :param mentions: List[dict]: Rows of tweet_mentions
+    :param shard_id: str: Shard of the tweets
+    :return: None
+    """
+    for model, rows in ((TweetHashtag, hashtags), (TweetMention, mentions)):
+        if rows:
+            await session.execute(
+                insert_for(session, model.__table__).on_conflict_do_nothing(),
+                rows,
+                bind_arguments=on_shard(shard_id),
+            )
+
+
+async def index_tweet(
+    session: AsyncSession,
+    tweet_id: int,
+    content: str,
+    shard_id: Optional[str] = None,
+) -> Tuple[List[str], List[int]]:
+    """
+    The index_tweet function stores the hashtags and the mentions of
+    existing users of a tweet next to it, so the tag feeds read one range of
+    a primary key instead of scanning the content of every tweet. It runs
+    in the transaction of post_tweet and does not commit; rows already there
+    are kept, so a tweet can be indexed again.
+
+    :param session: AsyncSession: Connect to the database
+    :param tweet_id: int: Tweet to index
+    :param content: str: Text of the tweet
+    :param shard_id: Optional[str]: Shard of the tweet, found from its id
+        when not given
+    :return: The hashtags and the ids of the mentioned users
+    """
+    hashtags = extract_hashtags(content)
+    users = await find_mentioned(session, extract_mentions(content))
+    user_ids = sorted(i for ids in users.values() for i in ids)
+    if not hashtags and not user_ids:
+        return hashtags, user_ids
+
+    await insert_tags(
+        session,
+        [{"tag": tag, "tweet_id": tweet_id} for tag in hashtags],
+        [{"user_id": i, "tweet_id": tweet_id} for i in user_ids],
+        shard_id or router_of(session).for_id(tweet_id),
+    )
+    return hashtags, user_ids
+
+
+async def backfill_tags(session: AsyncSession, batch_size: int) -> int:
+    """
+    The backfill_tags function indexes the tweets written before hashtags
+    and mentions were, see tools/backfill_tags.py. It goes shard by shard, in
+    batches of batch_size tweets read in id order and committed one by one.
+    The names mentioned in a batch are resolved in one query and its rows
+    inserted with one prepared statement per table. Indexing is idempotent,
+    so an interrupted run can simply be started again.
+
+    :param session: AsyncSession: Connect to the database
+    :param batch_size: int: Tweets per transaction
+    :return: The number of tweets read
+    """
+    processed = 0
+    for shard_id in router_of(session).shard_ids:
+        last_id = 0
+        while True:
+            response = await session.execute(
+                select(Tweet.id, Tweet.content)
+                .where(Tweet.id > last_id, Tweet.deleted_at.is_(None))
+                .order_by(Tweet.id)
+                .limit(batch_size),
+                bind_arguments=on_shard(shard_id),
+            )
+            rows = response.all()
+            if not rows:
+                break
+            mentioned = {
+                tweet_id: extract_mentions(content)
+                for tweet_id, content in rows
+            }
+            users = await find_mentioned(
+                session,
+                dict.fromkeys(
+                    n for names in mentioned.values() for n in names
+                ),
+            )
+            await insert_tags(
+                session,
+                [
+                    {"tag": tag, "tweet_id": tweet_id}
+                    for tweet_id, content in rows
+                    for tag in extract_hashtags(content)
+                ],
+                [
+                    {"user_id": user_id, "tweet_id": tweet_id}
+                    for tweet_id, names in mentioned.items()
+                    for user_id in sorted(
+                        i for name in names for i in users.get(name, ())
+                    )
+                ],
+                shard_id,
+            )
+            await session.commit()
+            processed += len(rows)
+            last_id = rows[-1].id
+    return processed
@@ -1,16 +1,89 @@
-from sqlalchemy import delete, insert, select, update, func
+import json
+from datetime import timedelta
+from functools import lru_cache
+from typing import AsyncIterator, Dict, List, Optional
+
+from sqlalchemy import (
+    and_,
+    bindparam,
+    delete,
+    func,
+    insert,
+    select,
+    true,
+    union,
+    update,
+)
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
-
-from db.models import Like, Media, Tweet, User
+from sqlalchemy.orm import aliased, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+
+from core.cache import hashtag_key, mentions_key, purge, tweet_key, user_key
+from core.config import (
+    EXPORT_BATCH_SIZE,
+    LIKE_PREVIEW_SIZE,
+    LIKES_PAGE_SIZE,
+    TAG_PAGE_SIZE,
+    THREAD_PAGE_SIZE,
+)
+from core.database import dialect_of
 from core.exceptions import BackendException
+from core.sharding import bucket_for_user, on_shard, router_of
+from core.singleflight import single_flight
+from core.snowflake import min_id_at, next_id, timestamp_of
+from core.tracing import traced
+from db.models import Like, Media, Tweet, TweetHashtag, TweetMention, User
 from dependencies import get_user_by_api_key
+from services.counter_service import change_counters, change_tweet_counters
+from services.notification_service import notify
+from services.ranking_service import change_likes
+from services.tag_service import index_tweet
+
+# Digits of every id in a reply path, enough for any snowflake id. The
+# character after "9" bounds the paths below a prefix.
+PATH_DIGITS = 19
+PATH_END = ":"
+# Tweets are partitioned by month of their id (see core.partitions): a bound
+# on Tweet.id lets PostgreSQL skip the partitions of the older months. The
+# clocks of the workers minting ids may drift apart by up to ID_CLOCK_SKEW.
+ID_CLOCK_SKEW = timedelta(minutes=1)
+
+
+def path_of(tweet: Tweet) -> str:
+    """Path of a tweet in its conversation; a root stores none."""
+    return tweet.path or f"{tweet.id:0{PATH_DIGITS}d}"
+
+
+# Tweets that are not deleted, of an author whose account is not deleted:
+# the tweets of a deleted account leave the reads at once, before
+# services.account_service gets to hide them one by one.
+IS_LIVE = and_(
+    Tweet.deleted_at.is_(None),
+    select(User.id)
+    .where(User.id == Tweet.user_id, User.deleted_at.is_(None))
+    .exists(),
+)
+
 
+def minted_after(tweet_id: int):
+    """Bound on Tweet.id of the tweets created after the tweet ``tweet_id``."""
+    return Tweet.id >= min_id_at(timestamp_of(tweet_id) - ID_CLOCK_SKEW)
 
-async def get_tweet(session: AsyncSession, tweet_id: int):
+
+def path_ids(path: str) -> List[int]:
+    """Ids of the tweets along a path, the root first."""
+    return [
+        int(path[start:][:PATH_DIGITS])
+        for start in range(0, len(path), PATH_DIGITS)
+    ]
+
+
+async def find_tweet(session: AsyncSession, tweet_id: int) -> Tweet:
     """
-The get_tweet function returns a tweet with the given id.
+The find_tweet function returns the row of a live tweet with the given id,
+without its likes and media, for the writes that only need to know the tweet
+exists.
 
 :param session: AsyncSession: Get the session object from the database
 :param tweet_id: int: Specify the id of the tweet we want to get
@@ -18,11 +91,7 @@ The get_tweet function returns a tweet with the given id.
 :doc-author: Trelent
 """
     response = await session.execute(
-        select(Tweet)
-        .options(selectinload(Tweet.author))
-        .options(selectinload(Tweet.likes).options(selectinload(Like.user)))
-        .options(selectinload(Tweet.media))
-        .where(Tweet.id == tweet_id)
+        select(Tweet).where(Tweet.id == tweet_id, IS_LIVE)
     )
     tweet = response.scalars().one_or_none()
     if not tweet:
@@ -32,68 +101,756 @@ The get_tweet function returns a tweet with the given id.
     return tweet
 
 
-async def get_tweets(session: AsyncSession, api_key: str):
+async def find_original(session: AsyncSession, tweet_id: int) -> Tweet:
+    """
+The find_original function is find_tweet, except that a retweet stands for the
+tweet it retweets: likes, retweets and quotes of a retweet all go to the
+original.
+
+:param session: AsyncSession: Connect to the database
+:param tweet_id: int: Id of a tweet or of a retweet
+:return: A tweet object
+:doc-author: Trelent
+"""
+    tweet = await find_tweet(session=session, tweet_id=tweet_id)
+    if tweet.retweet_of_id is not None:
+        tweet = await find_tweet(session=session, tweet_id=tweet.retweet_of_id)
+    return tweet
+
+
+# The hot reads execute statements built once, with their values bound at
+# execution: no select is rebuilt per request, SQLAlchemy finds the compiled
+# SQL in its cache and asyncpg reuses the statement it prepared.
+TWEET_BY_ID = (
+    select(Tweet)
+    .options(selectinload(Tweet.author))
+    .options(selectinload(Tweet.media))
+    .where(Tweet.id == bindparam("tweet_id"), IS_LIVE)
+)
+
+
+@traced
+@single_flight
+async def get_tweet(
+    session: AsyncSession, tweet_id: int, api_key: Optional[str] = None
+):
+    """
+The get_tweet function returns a tweet with the given id, with a summary of its
+likes. When the api_key of a reader is given, liked_by_me tells whether the
+reader likes it. Concurrent calls with the same arguments share one read, see
+core.singleflight.
+
+:param session: AsyncSession: Get the session object from the database
+:param tweet_id: int: Specify the id of the tweet we want to get
+:param api_key: Optional[str]: Identify the reader of the tweet
+:return: A tweet object
+:doc-author: Trelent
+"""
+    reader = None
+    if api_key is not None:
+        reader = await get_user_by_api_key(session=session, api_key=api_key)
+    response = await session.execute(TWEET_BY_ID, {"tweet_id": tweet_id})
+    tweet = response.scalars().one_or_none()
+    if not tweet:
+        raise BackendException(
+            error_type="NO TWEET", error_message="No tweet with such id"
+        )
+    await hydrate_tweets(
+        session=session, tweets=[tweet], reader_id=reader and reader.id
+    )
+    return tweet
+
+
+async def hydrate_tweets(
+    session: AsyncSession, tweets: List[Tweet], reader_id: Optional[int] = None
+):
+    """
+The hydrate_tweets function completes tweets loaded with their author and
+media: it summarizes their likes and sets the original of every retweet and
+quote. Originals are loaded in one batch, each once however many tweets of the
+page point to it; an original that was deleted stays None.
+
+:param session: AsyncSession: Connect to the database
+:param tweets: List[Tweet]: Tweets loaded by the caller
+:param reader_id: Optional[int]: User reading the tweets
+:return: None
+:doc-author: Trelent
+"""
+    original_ids = {tweet.original_id for tweet in tweets} - {None}
+    originals = []
+    if original_ids:
+        response = await session.execute(
+            select(Tweet)
+            .options(selectinload(Tweet.author))
+            .options(selectinload(Tweet.media))
+            .where(Tweet.id.in_(original_ids), IS_LIVE)
+        )
+        originals = response.scalars().all()
+    await summarize_likes(
+        session=session, tweets=[*tweets, *originals], reader_id=reader_id
+    )
+
+    by_id = {original.id: original for original in originals}
+    for tweet in tweets:
+        tweet.original = by_id.get(tweet.original_id)
+
+
+@lru_cache()
+def like_previews(dialect: str, with_reader: bool):
+    """
+The like_previews function builds the query of summarize_likes once per dialect
+and kind of reader, the tweet ids and the reader bound at execution.
+
+:param dialect: str: Name of the dialect of the session
+:param with_reader: bool: Whether the likes of the reader are added
+:return: A select of the likes
+:doc-author: Trelent
+"""
+    tweet_ids = bindparam("tweet_ids", expanding=True)
+    if dialect == "sqlite":
+        # No LATERAL: rank the likes of the tweets instead.
+        ranked = (
+            select(
+                Like,
+                func.row_number()
+                .over(partition_by=Like.tweet_id, order_by=Like.id.desc())
+                .label("rank"),
+            )
+            .where(Like.tweet_id.in_(tweet_ids))
+            .subquery()
+        )
+        likes = select(
+            *(ranked.c[column.name] for column in Like.__table__.columns)
+        ).where(ranked.c.rank <= LIKE_PREVIEW_SIZE)
+    else:
+        newest = (
+            select(Like)
+            .where(Like.tweet_id == Tweet.id)
+            .order_by(Like.id.desc())
+            .limit(LIKE_PREVIEW_SIZE)
+            .lateral()
+        )
+        likes = (
+            select(*newest.c)
+            .select_from(Tweet)
+            .join(newest, true())
+            .where(Tweet.id.in_(tweet_ids))
+        )
+    if with_reader:
+        likes = union(
+            likes,
+            select(Like).where(
+                Like.user_id == bindparam("reader_id"),
+                Like.tweet_id.in_(tweet_ids),
+            ),
+        )
+    like = aliased(Like, likes.subquery())
+    return (
+        select(like).options(selectinload(like.user)).order_by(like.id.desc())
+    )
+
+
+async def summarize_likes(
+    session: AsyncSession, tweets: List[Tweet], reader_id: Optional[int] = None
+):
+    """
+The summarize_likes function loads the LIKE_PREVIEW_SIZE newest likes of every
+tweet into its likes collection, in two queries whatever the number of likes:
+like_count comes with the tweet row, and the rest of the likes are paged by
+get_tweet_likes. A reader who likes the tweet gets liked_by_me set and their
+own like at the head of the preview.
+
+:param session: AsyncSession: Connect to the database
+:param tweets: List[Tweet]: Tweets loaded by the caller
+:param reader_id: Optional[int]: User reading the tweets
+:return: None
+:doc-author: Trelent
+"""
+    if not tweets:
+        return
+    tweet_ids = list({tweet.id for tweet in tweets})
+    parameters = {"tweet_ids": tweet_ids, "reader_id": reader_id}
+    response = await session.execute(
+        like_previews(dialect_of(session), reader_id is not None), parameters
+    )
+
+    previews: Dict[int, List[Like]] = {tweet_id: [] for tweet_id in tweet_ids}
+    for like in response.scalars():
+        if like.user_id == reader_id:
+            previews[like.tweet_id].insert(0, like)
+        else:
+            previews[like.tweet_id].append(like)
+    for tweet in tweets:
+        preview = previews[tweet.id]
+        tweet.liked_by_me = bool(preview) and preview[0].user_id == reader_id
+        set_committed_value(tweet, "likes", preview[:LIKE_PREVIEW_SIZE])
+
+
+@traced
+async def get_tweet_likes(
+    session: AsyncSession,
+    tweet_id: int,
+    cursor: Optional[int] = None,
+    limit: int = LIKES_PAGE_SIZE,
+):
+    """
+The get_tweet_likes function returns a page of the likes of a tweet, newest
+first. The cursor is the id of the last like of the previous page: every page
+is one range scan of the likes index, however deep it is.
+
+:param session: AsyncSession: Connect to the database
+:param tweet_id: int: Get the likes of this tweet
+:param cursor: Optional[int]: next_cursor of the previous page, None for the
+    first one
+:param limit: int: Number of likes per page
+:return: A dictionary with the result, likes and next_cursor keys
+:doc-author: Trelent
+"""
+    tweet = await find_original(session=session, tweet_id=tweet_id)
+    query = (
+        select(Like)
+        .options(selectinload(Like.user))
+        .where(Like.tweet_id == tweet.id)
+        .order_by(Like.id.desc())
+        .limit(limit + 1)
+    )
+    if cursor is not None:
+        query = query.where(Like.id < cursor)
+    response = await session.execute(query)
+    likes = response.scalars().all()
+
+    next_cursor = likes[limit - 1].id if len(likes) > limit else None
+    return {"result": True, "likes": likes[:limit], "next_cursor": next_cursor}
+
+
+# Sort keys of the tweet lists, each matching an index on (user_id, ...).
+TWEET_ORDERS = {
+    "ranked": (Tweet.score.desc(), Tweet.id.desc()),
+    "recent": (Tweet.id.desc(),),
+    "top": (Tweet.likes_count.desc(), Tweet.id.desc()),
+}
+USER_TWEETS = {
+    (order, limited): (
+        select(Tweet)
+        .options(selectinload(Tweet.author))
+        .options(selectinload(Tweet.media))
+        .where(Tweet.user_id == bindparam("user_id"), IS_LIVE)
+        .order_by(*columns)
+        .limit(bindparam("limit") if limited else None)
+    )
+    for order, columns in TWEET_ORDERS.items()
+    for limited in (False, True)
+}
+
+
+@traced
+async def get_thread(
+    session: AsyncSession,
+    tweet_id: int,
+    api_key: Optional[str] = None,
+    depth: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = THREAD_PAGE_SIZE,
+):
+    """
+The get_thread function returns a tweet with its ancestors, read from its path,
+and a page of the replies below it in thread order: depth first, older replies
+first. The tweet of a root brings the whole conversation. With depth, only
+replies at most depth levels below the tweet come back. The replies are one
+range of the (root_id, path, depth) index on each shard holding some; the
+cursor is the path of the last reply of the previous page.
+
+:param session: AsyncSession: Connect to the database
+:param tweet_id: int: Tweet at the top of the subtree
+:param api_key: Optional[str]: Identify the reader of the tweets
+:param depth: Optional[int]: Levels of replies returned
+:param cursor: Optional[str]: next_cursor of the previous page
+:param limit: int: Number of replies per page
+:return: A dictionary with the result, tweet, ancestors, replies and
+    next_cursor keys
+:doc-author: Trelent
+"""
+    reader = None
+    if api_key is not None:
+        reader = await get_user_by_api_key(session=session, api_key=api_key)
+    tweet = await find_original(session=session, tweet_id=tweet_id)
+    tweet_path = path_of(tweet)
+    ancestor_ids = path_ids(tweet_path)[:-1]
+    response = await session.execute(
+        select(Tweet)
+        .options(selectinload(Tweet.author))
+        .options(selectinload(Tweet.media))
+        .where(
+            Tweet.id.in_([*ancestor_ids, tweet.id]),
+            IS_LIVE,
+        )
+    )
+    loaded = {row.id: row for row in response.scalars()}
+    ancestors = [loaded[i] for i in ancestor_ids if i in loaded]
+
+    query = (
+        select(Tweet)
+        .options(selectinload(Tweet.author))
+        .options(selectinload(Tweet.media))
+        .where(
+            Tweet.root_id == (tweet.root_id or tweet.id),
+            minted_after(tweet.id),
+            Tweet.path > max(cursor or "", tweet_path),
+            Tweet.path < tweet_path + PATH_END,
+            IS_LIVE,
+        )
+        .order_by(Tweet.path)
+        .limit(limit + 1)
+    )
+    if depth is not None:
+        query = query.where(Tweet.depth <= tweet.depth + depth)
+    response = await session.execute(query)
+    # Each shard returns its own first replies; merged here into one page.
+    replies = sorted(response.scalars().all(), key=path_of)[: limit + 1]
+    next_cursor = replies[limit - 1].path if len(replies) > limit else None
+    replies = replies[:limit]
+
+    await hydrate_tweets(
+        session=session,
+        tweets=[*ancestors, tweet, *replies],
+        reader_id=reader and reader.id,
+    )
+    return {
+        "result": True,
+        "tweet": tweet,
+        "ancestors": ancestors,
+        "replies": replies,
+        "next_cursor": next_cursor,
+    }
+
+
+async def page_tagged_tweets(
+    session: AsyncSession,
+    link,
+    criterion,
+    reader_id: Optional[int],
+    cursor: Optional[int],
+    limit: int,
+):
+    """
+The page_tagged_tweets function returns a page of the tweets with a row of link
+(TweetHashtag or TweetMention) matching criterion, newest first. The page is
+read from the primary key of link alone, one range from the cursor down on
+every shard, and only then are its tweets loaded by id; tweets deleted but not
+purged yet are left out, so such a page may come short.
+
+:param session: AsyncSession: Connect to the database
+:param link: Association table of the tag, TweetHashtag or TweetMention
+:param criterion: Condition on link naming the tag
+:param reader_id: Optional[int]: User reading the tweets
+:param cursor: Optional[int]: next_cursor of the previous page
+:param limit: int: Number of tweets per page
+:return: A dictionary with the result, tweets and next_cursor keys
+:doc-author: Trelent
+"""
+    query = (
+        select(link.tweet_id)
+        .where(criterion)
+        .order_by(link.tweet_id.desc())
+        .limit(limit + 1)
+    )
+    if cursor is not None:
+        query = query.where(link.tweet_id < cursor)
+    response = await session.execute(query)
+    # Each shard returns its own newest ids; merged here into one page.
+    tweet_ids = sorted(response.scalars().all(), reverse=True)[: limit + 1]
+    next_cursor = tweet_ids[limit - 1] if len(tweet_ids) > limit else None
+    tweet_ids = tweet_ids[:limit]
+
+    tweets = []
+    if tweet_ids:
+        response = await session.execute(
+            select(Tweet)
+            .options(selectinload(Tweet.author))
+            .options(selectinload(Tweet.media))
+            .where(Tweet.id.in_(tweet_ids), IS_LIVE)
+        )
+        tweets = sorted(
+            response.scalars().all(), key=lambda tweet: tweet.id, reverse=True
+        )
+    await hydrate_tweets(session=session, tweets=tweets, reader_id=reader_id)
+    return {"result": True, "tweets": tweets, "next_cursor": next_cursor}
+
+
+@traced
+async def get_hashtag_tweets(
+    session: AsyncSession,
+    tag: str,
+    api_key: Optional[str] = None,
+    cursor: Optional[int] = None,
+    limit: int = TAG_PAGE_SIZE,
+):
+    """
+The get_hashtag_tweets function returns a page of the tweets with a hashtag,
+newest first. The tag is matched without its # and whatever its case. The
+cursor is the id of the last tweet of the previous page.
+
+:param session: AsyncSession: Connect to the database
+:param tag: str: Hashtag of the tweets
+:param api_key: Optional[str]: Identify the reader of the tweets
+:param cursor: Optional[int]: next_cursor of the previous page
+:param limit: int: Number of tweets per page
+:return: A dictionary with the result, tweets and next_cursor keys
+:doc-author: Trelent
+"""
+    reader = None
+    if api_key is not None:
+        reader = await get_user_by_api_key(session=session, api_key=api_key)
+    return await page_tagged_tweets(
+        session=session,
+        link=TweetHashtag,
+        criterion=TweetHashtag.tag == tag.lstrip("#").lower(),
+        reader_id=reader and reader.id,
+        cursor=cursor,
+        limit=limit,
+    )
+
+
+@traced
+async def get_mentions(
+    session: AsyncSession,
+    user_id: int,
+    api_key: Optional[str] = None,
+    cursor: Optional[int] = None,
+    limit: int = TAG_PAGE_SIZE,
+):
+    """
+The get_mentions function returns a page of the tweets mentioning a user,
+newest first. The cursor is the id of the last tweet of the previous page.
+
+:param session: AsyncSession: Connect to the database
+:param user_id: int: Mentioned user
+:param api_key: Optional[str]: Identify the reader of the tweets
+:param cursor: Optional[int]: next_cursor of the previous page
+:param limit: int: Number of tweets per page
+:return: A dictionary with the result, tweets and next_cursor keys
+:doc-author: Trelent
+"""
+    reader = None
+    if api_key is not None:
+        reader = await get_user_by_api_key(session=session, api_key=api_key)
+    user = await session.get(User, user_id)
+    if user is None or user.deleted_at is not None:
+        raise BackendException(
+            error_type="NO USER", error_message="No user with such id"
+        )
+    return await page_tagged_tweets(
+        session=session,
+        link=TweetMention,
+        criterion=TweetMention.user_id == user_id,
+        reader_id=reader and reader.id,
+        cursor=cursor,
+        limit=limit,
+    )
+
+
+@traced
+@single_flight
+async def get_tweets(
+    session: AsyncSession,
+    api_key: str,
+    order: str = "top",
+    limit: Optional[int] = None,
+):
     """
-The get_tweets function returns all tweets for a given user.
+The get_tweets function returns all tweets for a given user. They come sorted
+by order: "top" by likes, "recent" newest first, or "ranked" by the like count
+decayed with age of services.ranking_service. Each order reads its index, so
+the first limit tweets cost a range scan. Tweets come completed by
+hydrate_tweets. Concurrent calls with the same arguments share one read, see
+core.singleflight.
 
 :param session: AsyncSession: Create a connection to the database
 :param api_key: str: Get the user by api_key
+:param order: str: Sort key, one of TWEET_ORDERS
+:param limit: Optional[int]: Return only the first tweets
 :return: A dictionary with the result and tweets keys
 :doc-author: Trelent
 """
-    await get_user_by_api_key(session=session, api_key=api_key)
+    if order not in TWEET_ORDERS:
+        raise BackendException(
+            error_type="BAD ORDER", error_message="No such tweet order"
+        )
+    user = await get_user_by_api_key(session=session, api_key=api_key)
 
     response = await session.execute(
-        select(Tweet, func.count(Like.id).label('like_count'))
-        .options(selectinload(Tweet.author))
-        .options(selectinload(Tweet.likes).options(selectinload(Like.user)))
-        .options(selectinload(Tweet.media))
-        .join(User, User.id == Tweet.user_id)
-        .outerjoin(Like, Like.tweet_id == Tweet.id)
-        .where(User.api_key == api_key)
-        .group_by(Tweet.id)
-        .order_by(func.count(Like.id).desc())
+        USER_TWEETS[order, limit is not None],
+        {"user_id": user.id, "limit": limit},
     )
 
     tweets = response.scalars().all()
+    await hydrate_tweets(session=session, tweets=tweets, reader_id=user.id)
 
     return {"result": True, "tweets": tweets}
 
 
-async def post_tweet(session: AsyncSession, api_key: str, tweet_data: str) -> int:
+@traced
+async def export_tweets(
+    session: AsyncSession, user_id: int
+) -> AsyncIterator[str]:
     """
-The post_tweet function takes in a session, api_key, and tweet_data.
-It then uses the get_user_by_api function to find the user associated with that api key.
-Then it inserts a new row into the Tweet table using that user's id and the tweet data provided.
-Finally it returns an int of what was inserted as primary key.
+The export_tweets function checks that the user exists and returns an async
+iterator over all of the user's tweets as NDJSON, oldest first, one JSON object
+per line. The rows come through a server-side cursor EXPORT_BATCH_SIZE at a
+time, and the next batch is only fetched once the previous one has been
+consumed, so memory does not grow with the number of tweets and a slow reader
+holds the query back instead of piling up output.
+
+:param session: AsyncSession: Connect to the database, must stay open while
+    iterating
+:param user_id: int: Get the tweets of this user
+:return: An async iterator of NDJSON chunks
+:doc-author: Trelent
+"""
+    response = await session.execute(
+        select(User.id).where(User.id == user_id, User.deleted_at.is_(None))
+    )
+    if response.scalar_one_or_none() is None:
+        raise BackendException(
+            error_type="NO USER", error_message="No user with such id"
+        )
+
+    return iter_tweets_ndjson(session=session, user_id=user_id)
+
+
+async def iter_tweets_ndjson(
+    session: AsyncSession, user_id: int
+) -> AsyncIterator[str]:
+    """
+The iter_tweets_ndjson function streams the tweets of a user joined with their
+media. Rows of one tweet are adjacent, so they are folded into one object
+without buffering more than the current batch.
+
+:param session: AsyncSession: Connect to the database
+:param user_id: int: Get the tweets of this user
+:return: An async iterator of NDJSON chunks, one per fetched batch
+:doc-author: Trelent
+"""
+    result = await session.stream(
+        select(Tweet.id, Tweet.content, Media.name)
+        .outerjoin(Media, Media.tweet_id == Tweet.id)
+        .where(Tweet.user_id == user_id, Tweet.deleted_at.is_(None))
+        .order_by(Tweet.id, Media.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+    tweet = None
+    async for rows in result.partitions():
+        lines = []
+        for tweet_id, content, media_name in rows:
+            if tweet is None or tweet["id"] != tweet_id:
+                if tweet is not None:
+                    lines.append(json.dumps(tweet, ensure_ascii=False) + "\n")
+                tweet = {"id": tweet_id, "content": content, "attachments": []}
+            if media_name is not None:
+                tweet["attachments"].append(media_name)
+        if lines:
+            yield "".join(lines)
+
+    if tweet is not None:
+        yield json.dumps(tweet, ensure_ascii=False) + "\n"
+
+
+@traced
+async def post_tweet(
+    session: AsyncSession,
+    api_key: str,
+    tweet_data: str,
+    quote_tweet_id: Optional[int] = None,
+    reply_to_id: Optional[int] = None,
+) -> int:
+    """
+The post_tweet function takes in a session, api_key, and tweet_data. It then
+uses the get_user_by_api function to find the user associated with that api
+key. Then it inserts a new row into the Tweet table using that user's id and
+the tweet data provided. The id is generated by core.snowflake before the
+insert, so no RETURNING round trip is needed. It carries the author's shard
+bucket, which places the tweet next to the rest of the author's tweets. The
+author's tweets_count is incremented in the same transaction. With
+quote_tweet_id the tweet quotes that tweet: it only keeps its id, and the
+quotes_count of the quoted tweet is incremented. With reply_to_id the tweet
+replies to that tweet: it takes the root and path of its parent, and the
+replies_count of the parent is incremented. Its #hashtags and @mentions are
+indexed by services.tag_service in the same transaction, and the mentioned
+users are notified.
 
 :param session: AsyncSession: Create a connection to the database
 :param api_key: str: Get the user_id from the database
 :param tweet_data: str: Pass in the tweet content
+:param quote_tweet_id: Optional[int]: Tweet quoted by the new tweet
+:param reply_to_id: Optional[int]: Tweet the new tweet replies to
 :return: The id of the new tweet
 :doc-author: Trelent
 """
     user = await get_user_by_api_key(session=session, api_key=api_key)
-
-    insert_tweet_query = await session.execute(
+    quoted = None
+    if quote_tweet_id is not None:
+        quoted = await find_original(session=session, tweet_id=quote_tweet_id)
+
+    parent = None
+    if reply_to_id is not None:
+        parent = await find_original(session=session, tweet_id=reply_to_id)
+
+    new_tweet_id = next_id(bucket_for_user(user.id))
+    thread = {}
+    if parent is not None:
+        thread = dict(
+            parent_id=parent.id,
+            root_id=parent.root_id or parent.id,
+            path=path_of(parent) + f"{new_tweet_id:0{PATH_DIGITS}d}",
+            depth=parent.depth + 1,
+        )
+    await session.execute(
         insert(Tweet).values(
+            id=new_tweet_id,
             content=tweet_data,
             user_id=user.id,
+            quote_of_id=quoted and quoted.id,
+            **thread,
         )
     )
-    new_tweet_id = insert_tweet_query.inserted_primary_key[0]
+    hashtags, mentioned_ids = await index_tweet(
+        session, new_tweet_id, tweet_data
+    )
+    await change_counters(session, user.id, tweets_count=1)
+    if quoted is not None:
+        await change_tweet_counters(session, quoted.id, quotes_count=1)
+    if parent is not None:
+        await change_tweet_counters(session, parent.id, replies_count=1)
+    await session.commit()
+    await purge(
+        [
+            user_key(user.id),
+            *map(hashtag_key, hashtags),
+            *map(mentions_key, mentioned_ids),
+        ]
+    )
+    for mentioned_id in mentioned_ids:
+        notify(mentioned_id, "mention", user.id, new_tweet_id)
+    if quoted is not None:
+        await purge([tweet_key(quoted.id)])
+        notify(quoted.user_id, "quote", user.id, quoted.id)
+    if parent is not None:
+        # The cached threads of every ancestor show the new reply.
+        ancestor_ids = path_ids(thread["path"])[:-1]
+        await purge([tweet_key(ancestor_id) for ancestor_id in ancestor_ids])
+        notify(parent.user_id, "reply", user.id, parent.id)
+
+    return new_tweet_id
+
+
+async def find_retweet(
+    session: AsyncSession, user_id: int, original_id: int
+) -> Optional[int]:
+    """
+The find_retweet function returns the id of the live retweet of a tweet by a
+user, if any. A retweet is newer than its original, so only the partitions from
+the month of the original on are searched.
+
+:param session: AsyncSession: Connect to the database
+:param user_id: int: Author of the retweet
+:param original_id: int: Tweet retweeted
+:return: The id of the retweet or None
+:doc-author: Trelent
+"""
+    response = await session.execute(
+        select(Tweet.id).where(
+            Tweet.user_id == user_id,
+            Tweet.retweet_of_id == original_id,
+            minted_after(original_id),
+            Tweet.deleted_at.is_(None),
+        )
+    )
+    return response.scalar_one_or_none()
+
+
+@traced
+async def post_retweet(
+    session: AsyncSession, api_key: str, tweet_id: int
+) -> int:
+    """
+The post_retweet function retweets a tweet: the retweet is a tweet of the user
+without content of its own, pointing to the original. Retweeting a retweet
+retweets its original. A user has at most one live retweet of a tweet, and the
+retweets_count of the original is incremented.
+
+:param session: AsyncSession: Connect to the database
+:param api_key: str: Get the user who retweets
+:param tweet_id: int: Tweet to retweet
+:return: The id of the retweet
+:doc-author: Trelent
+"""
+    user = await get_user_by_api_key(session=session, api_key=api_key)
+    original = await find_original(session=session, tweet_id=tweet_id)
+    # The unique index only holds within a partition of tweets.
+    if await find_retweet(session, user.id, original.id) is not None:
+        raise BackendException(
+            error_type="BAD RETWEET",
+            error_message="Such retweet already exists",
+        )
+
+    new_tweet_id = next_id(bucket_for_user(user.id))
+    try:
+        await session.execute(
+            insert(Tweet).values(
+                id=new_tweet_id,
+                content="",
+                user_id=user.id,
+                retweet_of_id=original.id,
+            )
+        )
+    except IntegrityError:
+        raise BackendException(
+            error_type="BAD RETWEET",
+            error_message="Such retweet already exists",
+        )
+    await change_counters(session, user.id, tweets_count=1)
+    await change_tweet_counters(session, original.id, retweets_count=1)
     await session.commit()
+    await purge([tweet_key(original.id), user_key(user.id)])
+    notify(original.user_id, "retweet", user.id, original.id)
 
     return new_tweet_id
 
 
+@traced
+async def delete_retweet(session: AsyncSession, api_key: str, tweet_id: int):
+    """
+The delete_retweet function undoes the retweet of a tweet by the user, deleting
+the retweet as delete_tweet does.
+
+:param session: AsyncSession: Connect to the database
+:param api_key: str: Get the user who retweeted
+:param tweet_id: int: Tweet that was retweeted
+:return: None
+:doc-author: Trelent
+"""
+    user = await get_user_by_api_key(session=session, api_key=api_key)
+    original = await find_original(session=session, tweet_id=tweet_id)
+    retweet_id = await find_retweet(session, user.id, original.id)
+    if retweet_id is None:
+        raise BackendException(
+            error_type="BAD RETWEET DELETE",
+            error_message="No retweet of tweet from user",
+        )
+    await delete_tweet(session=session, api_key=api_key, tweet_id=retweet_id)
+
+
+@traced
 async def insert_media_to_tweet(
     session: AsyncSession, tweet_id: int, tweet_medias: list
 ):
 
     """
 The insert_media_to_tweet function takes in a tweet_id and a list of media ids.
-It then updates the Media table with the tweet_id for each media id in the list.
+It then updates the Media table with the tweet_id for each media id in the
+list. The updates go to the tweet's shard only: media ids minted before
+sharding would match on every shard.
 
 :param session: AsyncSession: Create an async session with the database
 :param tweet_id: int: Identify the tweet that we want to add media to
@@ -101,16 +858,25 @@ It then updates the Media table with the tweet_id for each media id in the list.
 :return: Nothing
 :doc-author: Trelent
 """
+    shard_id = router_of(session).for_id(tweet_id)
     for media_id in tweet_medias:
         await session.execute(
-            update(Media).where(Media.id == media_id).values(tweet_id=tweet_id)
+            update(Media)
+            .where(Media.id == media_id)
+            .values(tweet_id=tweet_id),
+            bind_arguments=on_shard(shard_id),
         )
         await session.commit()
+    await purge([tweet_key(tweet_id)])
 
 
+@traced
 async def delete_tweet(session: AsyncSession, api_key: str, tweet_id: int):
     """
-The delete_tweet function deletes a tweet from the database.
+The delete_tweet function marks a tweet as deleted. It disappears from all
+reads at once, and leaves the author's tweets_count and, for a retweet, quote
+or reply, the counter of the original or parent, while the row itself, its
+likes and media are removed later by services.purge_service.
 
 :param session: AsyncSession: Connect to the database
 :param api_key: str: Get the user id of the person who is deleting a tweet
@@ -119,29 +885,56 @@ The delete_tweet function deletes a tweet from the database.
 :doc-author: Trelent
 """
     user = await get_user_by_api_key(session=session, api_key=api_key)
-    await get_tweet(session=session, tweet_id=tweet_id)
+    tweet = await find_tweet(session=session, tweet_id=tweet_id)
 
-    user_id = await session.execute(select(Tweet.user_id).where(Tweet.id == tweet_id))
-    author_id = user_id.scalars().one_or_none()
-    if author_id != user.id:
+    if tweet.user_id != user.id:
         raise BackendException(
             error_type="NO ACCSESS",
             error_message="Tweet belongs to other user",
         )
 
-    await session.execute(
-        delete(Tweet).where(Tweet.id == tweet_id, Tweet.user_id == user.id)
+    result = await session.execute(
+        update(Tweet)
+        .where(
+            Tweet.id == tweet_id,
+            Tweet.user_id == user.id,
+            Tweet.deleted_at.is_(None),
+        )
+        .values(deleted_at=func.now())
     )
+    # Only the request that marked the tweet takes it off the counts.
+    keys = [tweet_key(tweet_id), user_key(user.id)]
+    if result.rowcount:
+        await change_counters(session, user.id, tweets_count=-1)
+        if tweet.retweet_of_id is not None:
+            await change_tweet_counters(
+                session, tweet.retweet_of_id, retweets_count=-1
+            )
+            keys.append(tweet_key(tweet.retweet_of_id))
+        elif tweet.quote_of_id is not None:
+            await change_tweet_counters(
+                session, tweet.quote_of_id, quotes_count=-1
+            )
+            keys.append(tweet_key(tweet.quote_of_id))
+        if tweet.parent_id is not None:
+            await change_tweet_counters(
+                session, tweet.parent_id, replies_count=-1
+            )
+            keys.append(tweet_key(tweet.parent_id))
 
     await session.commit()
+    await purge(keys)
 
 
+@traced
 async def post_like_to_tweet(session: AsyncSession, api_key: str, tweet_id: int):
     """
-The post_like_to_tweet function takes in a session, api_key, and tweet_id.
-It then gets the user by their api key and gets the tweet by its id. It then inserts a new like into the database with
-the given tweet id and user id. If there is an integrity error (meaning that such a like already exists), it raises an
-exception saying so.
+The post_like_to_tweet function takes in a session, api_key, and tweet_id. It
+then gets the user by their api key and gets the tweet by its id. It then
+inserts a new like into the database with the given tweet id and user id. If
+there is an integrity error (meaning that such a like already exists), it
+raises an exception saying so. The author of the tweet gets a notification.
+Liking a retweet likes its original.
 
 :param session: AsyncSession: Pass the session object to the function
 :param api_key: str: Get the user_id of the user who liked a tweet
@@ -150,25 +943,34 @@ exception saying so.
 :doc-author: Trelent
 """
     user = await get_user_by_api_key(session=session, api_key=api_key)
-    await get_tweet(session=session, tweet_id=tweet_id)
+    tweet = await find_original(session=session, tweet_id=tweet_id)
+    tweet_id = tweet.id
 
+    # Likes live with the tweet, which lives with its author.
+    new_like_id = next_id(bucket_for_user(tweet.user_id))
+    shard_id = router_of(session).for_user(tweet.user_id)
     try:
-        insert_like_query = await session.execute(
+        await session.execute(
             insert(Like).values(
+                id=new_like_id,
                 tweet_id=tweet_id,
                 user_id=user.id,
-            )
+            ),
+            bind_arguments=on_shard(shard_id),
         )
-        new_like_id = insert_like_query.inserted_primary_key[0]
+        await change_likes(session, tweet_id, shard_id, 1)
         await session.commit()
     except IntegrityError:
         raise BackendException(
             error_type="BAD LIKE", error_message="Such like already exists"
         )
+    await purge([tweet_key(tweet_id)])
+    notify(tweet.user_id, "like", user.id, tweet_id)
 
     return new_like_id
 
 
+@traced
 async def delete_like_to_tweet(session: AsyncSession, api_key: str, tweet_id: int):
     """
 The delete_like_to_tweet function deletes a like from the database.
@@ -180,7 +982,8 @@ The delete_like_to_tweet function deletes a like from the database.
 :doc-author: Trelent
 """
     user = await get_user_by_api_key(session=session, api_key=api_key)
-    tweet = await get_tweet(session=session, tweet_id=tweet_id)
+    tweet = await find_original(session=session, tweet_id=tweet_id)
+    tweet_id = tweet.id
     response = await session.execute(
         select(Like).where(Like.user_id == user.id).where(Like.tweet_id == tweet.id)
     )
@@ -191,7 +994,12 @@ The delete_like_to_tweet function deletes a like from the database.
             error_message="No like for tweet from user",
         )
 
-    await session.execute(
+    result = await session.execute(
         delete(Like).where(Like.tweet_id == tweet_id, Like.user_id == user.id)
     )
+    if result.rowcount:
+        await change_likes(
+            session, tweet_id, router_of(session).for_user(tweet.user_id), -1
+        )
     await session.commit()
+    await purge([tweet_key(tweet_id)])
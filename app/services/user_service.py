@@ -1,18 +1,34 @@
-from sqlalchemy import select, delete, insert
+from typing import List, Optional
+
+from sqlalchemy import delete, insert, literal, select
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
+from core.cache import purge, user_key
+from core.config import FOLLOW_BULK_MAX, FOLLOWS_PAGE_SIZE
+from core.database import insert_for
 from core.exceptions import BackendException
-from db.models import followers, User
+from core.sharding import PRIMARY_SHARD, on_shard, router_of
+from core.singleflight import single_flight
+from core.tracing import traced
+from db.models import User, followers
 from dependencies import get_user_by_api_key
+from services.counter_service import (
+    change_bulk_follow_counters,
+    change_follow_counters,
+)
+from services.notification_service import notify
 
 
+@traced
 async def add_follow_to_user(session: AsyncSession, api_key: str, user_id: int):
     """
-The add_follow_to_user function adds a follow relationship between the user with api_key and the user with
-user_id. If there is no such user, it raises an exception. If the users are already following each other, it also
-raises an exception.
+The add_follow_to_user function adds a follow relationship between the user
+with api_key and the user with user_id. If there is no such user, it raises an
+exception. If the users are already following each other, it also raises an
+exception. The follow counters of both users change in the same transaction,
+and the followed user gets a notification.
 
 :param session: AsyncSession: Pass the session object to the function
 :param api_key: str: Get the user who is following
@@ -26,7 +42,9 @@ raises an exception.
             error_type="BAD FOLLOW", error_message="User can't follow himself"
         )
 
-    response = await session.execute(select(User).where(User.id == user_id))
+    response = await session.execute(
+        select(User).where(User.id == user_id, User.deleted_at.is_(None))
+    )
     user_followed = response.scalars().one_or_none()
     if not user_followed:
         raise BackendException(
@@ -44,12 +62,17 @@ raises an exception.
         raise BackendException(
             error_type="BAD FOLLOW", error_message="Such follow already exists"
         )
+    await change_follow_counters(session, following_user.id, user_id, 1)
     await session.commit()
+    await purge([user_key(following_user.id), user_key(user_id)])
+    notify(user_id, "follow", following_user.id)
 
 
+@traced
 async def delete_follow_from_user(session: AsyncSession, api_key: str, user_id: int):
     """
-The delete_follow_from_user function deletes a follow from the database.
+The delete_follow_from_user function deletes a follow from the database
+and decrements the follow counters of both users in the same transaction.
 
 :param session: AsyncSession: Create a session with the database
 :param api_key: str: Get the user's id
@@ -70,38 +93,139 @@ The delete_follow_from_user function deletes a follow from the database.
             error_type="BAD FOLLOW DELETE", error_message="No such follow"
         )
 
-    await session.execute(
+    result = await session.execute(
         delete(followers).where(
             followers.c.following_user_id == following_user.id,
             followers.c.followed_user_id == user_id,
         )
     )
+    # A concurrent unfollow may have removed the row first.
+    if result.rowcount:
+        await change_follow_counters(session, following_user.id, user_id, -1)
     await session.commit()
+    await purge([user_key(following_user.id), user_key(user_id)])
 
 
-async def get_user_me(session: AsyncSession, api_key: str):
+def check_bulk_size(user_ids: List[int]):
+    if len(user_ids) > FOLLOW_BULK_MAX:
+        raise BackendException(
+            error_type="BAD FOLLOW",
+            error_message=f"At most {FOLLOW_BULK_MAX} users at a time",
+        )
+
+
+@traced
+async def add_follows_to_user(
+    session: AsyncSession, api_key: str, user_ids: List[int]
+) -> List[int]:
     """
-The get_user_me function is used to get the user's information.
+The add_follows_to_user function makes the user with api_key follow all the
+users of user_ids at once, as onboarding does with suggested accounts. One
+INSERT ... SELECT keeps the ids of existing users, skips the follows that
+already exist and returns the others, so ids that are unknown, already followed
+or the follower's own are ignored. Counters, cache purges and notifications are
+those of add_follow_to_user, in one transaction.
 
-:param session: AsyncSession: Pass in the session object
-:param api_key: str: Identify the user who is making the request
-:return: A dictionary with the result of the operation and a user object
+:param session: AsyncSession: Pass the session object to the function
+:param api_key: str: Get the user who is following
+:param user_ids: List[int]: Users to follow, at most FOLLOW_BULK_MAX
+:return: The ids of the newly followed users, in id order
 :doc-author: Trelent
 """
-    user = await get_user_by_api_key(session=session, api_key=api_key)
+    check_bulk_size(user_ids)
+    following_user = await get_user_by_api_key(
+        session=session, api_key=api_key
+    )
+    targets = select(literal(following_user.id), User.id).where(
+        User.id.in_(set(user_ids)),
+        User.id != following_user.id,
+        User.deleted_at.is_(None),
+    )
+    response = await session.execute(
+        insert_for(session, followers)
+        .from_select(["following_user_id", "followed_user_id"], targets)
+        .on_conflict_do_nothing()
+        .returning(followers.c.followed_user_id)
+    )
+    followed_ids = sorted(response.scalars().all())
+    if followed_ids:
+        await change_bulk_follow_counters(
+            session, following_user.id, followed_ids, 1
+        )
+    await session.commit()
+    if followed_ids:
+        user_ids = [following_user.id, *followed_ids]
+        await purge([user_key(user_id) for user_id in user_ids])
+    for user_id in followed_ids:
+        notify(user_id, "follow", following_user.id)
+    return followed_ids
+
 
+@traced
+async def delete_follows_from_user(
+    session: AsyncSession, api_key: str, user_ids: List[int]
+) -> List[int]:
+    """
+The delete_follows_from_user function is the bulk unfollow: one DELETE removes
+the follows of user_ids that exist and returns them, and the follow counters
+change in the same transaction. Ids that are not followed are ignored.
+
+:param session: AsyncSession: Create a session with the database
+:param api_key: str: Get the user's id
+:param user_ids: List[int]: Users to unfollow, at most FOLLOW_BULK_MAX
+:return: The ids of the unfollowed users, in id order
+:doc-author: Trelent
+"""
+    check_bulk_size(user_ids)
+    following_user = await get_user_by_api_key(
+        session=session, api_key=api_key
+    )
     response = await session.execute(
-        select(User)
-        .options(selectinload(User.following))
-        .options(selectinload(User.followers))
-        .where(User.api_key == api_key)
+        delete(followers)
+        .where(
+            followers.c.following_user_id == following_user.id,
+            followers.c.followed_user_id.in_(set(user_ids)),
+        )
+        .returning(followers.c.followed_user_id)
     )
+    unfollowed_ids = sorted(response.scalars().all())
+    if unfollowed_ids:
+        await change_bulk_follow_counters(
+            session, following_user.id, unfollowed_ids, -1
+        )
+    await session.commit()
+    if unfollowed_ids:
+        user_ids = [following_user.id, *unfollowed_ids]
+        await purge([user_key(user_id) for user_id in user_ids])
+    return unfollowed_ids
 
-    user = response.scalars().one_or_none()
 
-    return {"result": True, "user": user}
+# Profile with the live users on both sides of its follows.
+USER_PROFILE = select(User).options(
+    selectinload(User.followers.and_(User.deleted_at.is_(None))),
+    selectinload(User.following.and_(User.deleted_at.is_(None))),
+)
+
 
+@traced
+async def get_user_me(session: AsyncSession, api_key: str):
+    """
+The get_user_me function is used to get the user's information: the users row
+with its counters and, for existing clients, the live followers and followed
+users.
 
+:param session: AsyncSession: Pass in the session object
+:param api_key: str: Identify the user who is making the request
+:return: A dictionary with the result of the operation and a user object
+:doc-author: Trelent
+"""
+    user = await get_user_by_api_key(session=session, api_key=api_key)
+    response = await session.execute(USER_PROFILE.where(User.id == user.id))
+    return {"result": True, "user": response.scalars().one()}
+
+
+@traced
+@single_flight
 async def get_user(session: AsyncSession, user_id: int):
     """
 The get_user function returns a user object with the following fields:
@@ -109,16 +233,18 @@ The get_user function returns a user object with the following fields:
     - username (str)
     - email (str)
 
+The counters are columns of the users row. The live followers and followed
+users are kept in the response for existing clients, one index range read each;
+get_follows pages them. Concurrent calls for the same user share one read, see
+core.singleflight.
+
 :param session: AsyncSession: Pass the session object to the function
 :param user_id: int: Get the user with that id
 :return: A dictionary with the result and user keys
 :doc-author: Trelent
 """
     response = await session.execute(
-        select(User)
-        .options(selectinload(User.following))
-        .options(selectinload(User.followers))
-        .where(User.id == user_id)
+        USER_PROFILE.where(User.id == user_id, User.deleted_at.is_(None))
     )
 
     user = response.scalars().one_or_none()
@@ -130,9 +256,12 @@ The get_user function returns a user object with the following fields:
     return {"result": True, "user": user}
 
 
+@traced
 async def post_user(session: AsyncSession, user) -> User:
     """
 The post_user function takes a user object and adds it to the database.
+The other shards get a reference copy (id and name) for their foreign keys and
+author joins.
     Args:
         session (AsyncSession): The current SQLAlchemy session.
         user (User): A User object containing all of the information for a new user.
@@ -145,5 +274,69 @@ The post_user function takes a user object and adds it to the database.
     new_user = User(**user.dict())
     async with session.begin():
         session.add(new_user)
+        await session.flush()
+        for shard_id in router_of(session).shard_ids:
+            if shard_id != PRIMARY_SHARD:
+                await session.execute(
+                    insert(User).values(id=new_user.id, name=new_user.name),
+                    bind_arguments=on_shard(shard_id),
+                )
         await session.commit()
+    # A cached "no such user" answer may exist for the new id.
+    await purge([user_key(new_user.id)])
     return new_user
+
+
+# Column of the user and column of the listed users, per follow list; each
+# pair leads an index of followers, so a page is one range scan.
+FOLLOW_LISTS = {
+    "followers": (followers.c.followed_user_id, followers.c.following_user_id),
+    "following": (followers.c.following_user_id, followers.c.followed_user_id),
+}
+
+
+@traced
+async def get_follows(
+    session: AsyncSession,
+    user_id: int,
+    side: str,
+    cursor: Optional[int] = None,
+    limit: int = FOLLOWS_PAGE_SIZE,
+):
+    """
+The get_follows function returns a page of the followers of a user, or of the
+users it follows, by increasing id. The cursor is the id of the last user of
+the previous page.
+
+:param session: AsyncSession: Connect to the database
+:param user_id: int: Get the follows of this user
+:param side: str: "followers" or "following", a key of FOLLOW_LISTS
+:param cursor: Optional[int]: next_cursor of the previous page, None for the
+    first one
+:param limit: int: Number of users per page
+:return: A dictionary with the result, users and next_cursor keys
+:doc-author: Trelent
+"""
+    response = await session.execute(
+        select(User.id).where(User.id == user_id, User.deleted_at.is_(None))
+    )
+    if response.scalar_one_or_none() is None:
+        raise BackendException(
+            error_type="NO USER", error_message="No user with such id"
+        )
+
+    user_column, listed_column = FOLLOW_LISTS[side]
+    query = (
+        select(User)
+        .join(followers, listed_column == User.id)
+        .where(user_column == user_id, User.deleted_at.is_(None))
+        .order_by(listed_column)
+        .limit(limit + 1)
+    )
+    if cursor is not None:
+        query = query.where(listed_column > cursor)
+    response = await session.execute(query)
+    users = response.scalars().all()
+
+    next_cursor = users[limit - 1].id if len(users) > limit else None
+    return {"result": True, "users": users[:limit], "next_cursor": next_cursor}
@@ -0,0 +1,80 @@
+import httpx
+from prometheus_client import REGISTRY
+
+from core import cache
+from core.cache import HttpPurger, NginxPurger, purge
+
+
+def purge_failures() -> float:
+    return REGISTRY.get_sample_value("cache_purge_failures_total") or 0
+
+
+async def test_http_purger_sends_surrogate_keys():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200)
+
+    purger = HttpPurger(
+        "http://cdn/purge", "secret", transport=httpx.MockTransport(handler)
+    )
+    await purger.purge(["tweet:1", "user:2"])
+
+    assert [request.method for request in requests] == ["POST"]
+    assert requests[0].headers["Surrogate-Key"] == "tweet:1 user:2"
+    assert requests[0].headers["Authorization"] == "Bearer secret"
+
+
+async def test_nginx_purger_refetches_urls():
+    paths = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        paths.append(request.url.path)
+        return httpx.Response(404)
+
+    purger = NginxPurger(
+        "http://nginx:8080/", transport=httpx.MockTransport(handler)
+    )
+    await purger.purge(["tweet:1", "user:2"])
+
+    assert paths == ["/api/tweets/1", "/api/users/2"]
+
+
+async def test_purge_deduplicates_and_survives_failures(local_purger):
+    await purge(["tweet:1", "tweet:1", "user:2"])
+    assert list(local_purger.purged) == ["tweet:1", "user:2"]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(503)
+
+    failures = purge_failures()
+    previous = cache.set_purger(
+        HttpPurger("http://cdn/purge", transport=httpx.MockTransport(handler))
+    )
+    try:
+        await purge(["tweet:1"])
+    finally:
+        cache.set_purger(previous)
+    assert purge_failures() == failures + 1
+
+    paths = []
+
+    def refetch(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/api/tweets/1":
+            raise httpx.ConnectError("nginx is down", request=request)
+        paths.append(request.url.path)
+        return httpx.Response(200)
+
+    previous = cache.set_purger(
+        NginxPurger(
+            "http://nginx:8080", transport=httpx.MockTransport(refetch)
+        )
+    )
+    try:
+        await purge(["tweet:1", "user:2", "hashtag:cats"])
+    finally:
+        cache.set_purger(previous)
+    assert purge_failures() == failures + 2
+    # The keys after the failing one are purged all the same.
+    assert paths == ["/api/users/2", "/api/hashtags/cats/tweets"]
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+from sqlalchemy import func, insert, select, text
+
+from core.config import SQLITE_PRAGMAS
+from core.database import create_schema, insert_for, is_sqlite, make_engine
+from core.sharding import make_session_maker
+from db.models import Tweet, TweetHashtag, User
+from services.tweet_service import get_tweet, get_tweets
+from tests.conftest import async_session_maker
+
+
+@pytest.fixture
+async def sqlite_engine(tmp_path):
+    engine = make_engine(
+        f"sqlite+aiosqlite:///{tmp_path / 'twitter.db'}",
+        SQLITE_PRAGMAS,
+        writer_timeout=5,
+    )
+    await create_schema(engine)
+    yield engine
+    await engine.dispose()
+
+
+def test_is_sqlite():
+    assert is_sqlite("sqlite+aiosqlite:///twitter.db")
+    assert not is_sqlite("postgresql+asyncpg://admin:admin@db/twitter")
+
+
+async def test_sqlite_connection_setup(sqlite_engine):
+    async with sqlite_engine.connect() as conn:
+        result = await conn.execute(text("PRAGMA journal_mode"))
+        assert result.scalar() == "wal"
+        result = await conn.execute(text("PRAGMA foreign_keys"))
+        assert result.scalar() == 1
+        result = await conn.execute(
+            select(func.greatest(1, 3, 2), func.power(2, 10))
+        )
+        assert result.one() == (3, 1024)
+
+
+async def test_sqlite_writers_wait_in_line(sqlite_engine):
+    session_maker = make_session_maker({"0": sqlite_engine})
+    async with session_maker() as session:
+        await session.execute(insert(User).values(id=1, name="writer"))
+        await session.commit()
+
+    async def write(tweet_id: int):
+        async with session_maker() as session:
+            await session.execute(
+                insert(Tweet).values(id=tweet_id, user_id=1, content="")
+            )
+            # Holds the write transaction open across a round trip.
+            await asyncio.sleep(0.01)
+            await session.execute(
+                insert_for(session, TweetHashtag)
+                .values(tag="queue", tweet_id=tweet_id)
+                .on_conflict_do_nothing()
+            )
+            await session.commit()
+
+    await asyncio.gather(*(write(tweet_id) for tweet_id in range(1, 21)))
+    async with session_maker() as session:
+        count = await session.scalar(select(func.count(TweetHashtag.tweet_id)))
+    assert count == 20
+
+
+def cache_lookups(result: str) -> float:
+    return (
+        REGISTRY.get_sample_value(
+            "sqlalchemy_compiled_cache_total", {"result": result}
+        )
+        or 0
+    )
+
+
+async def test_hot_reads_hit_compiled_cache(insert_data):
+    async def read():
+        async with async_session_maker() as session:
+            await get_tweet(session=session, tweet_id=1, api_key="oleg")
+            await get_tweets(session=session, api_key="oleg", limit=10)
+
+    await read()
+    results = ("cache_hit", "cache_miss", "no_cache_key")
+    before = {result: cache_lookups(result) for result in results}
+    for _ in range(10):
+        await read()
+    lookups = {r: cache_lookups(r) - before[r] for r in results}
+
+    assert lookups["cache_hit"] / sum(lookups.values()) >= 0.95
@@ -0,0 +1,79 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from prometheus_client import REGISTRY
+from sqlalchemy import insert, select
+
+from core.snowflake import min_id_at, next_id
+from db.models import Media
+from services.gc_service import collect_orphaned_media, reconcile_storage
+from tests.conftest import async_session_maker
+
+
+def reclaimed(source: str) -> float:
+    return (
+        REGISTRY.get_sample_value(
+            "media_gc_reclaimed_bytes_total", {"source": source}
+        )
+        or 0
+    )
+
+
+async def test_collect_orphaned_media(insert_data, local_storage):
+    old_id = min_id_at(datetime.now(timezone.utc) - timedelta(days=2))
+    medias = {
+        "old.png": {"id": old_id + 1, "size": 3},
+        "pending.png": {"id": old_id + 2, "size": None},
+        "fresh.png": {"id": next_id(), "size": 5},
+        "attached.png": {"id": old_id + 3, "size": 8, "tweet_id": 1},
+    }
+    async with async_session_maker() as session:
+        for key, values in medias.items():
+            await local_storage.save(key, b"x" * (values["size"] or 4), "")
+            await session.execute(
+                insert(Media).values(
+                    name=local_storage.url(key), key=key, user_id=1, **values
+                )
+            )
+        await session.commit()
+        before = reclaimed("unattached")
+
+        assert await collect_orphaned_media(session, batch_size=1) == 2
+
+        response = await session.execute(
+            select(Media.key).where(Media.key.in_(medias))
+        )
+        assert set(response.scalars()) == {"fresh.png", "attached.png"}
+    assert sorted(path.name for path in local_storage.root.iterdir()) == [
+        "attached.png",
+        "fresh.png",
+    ]
+    assert reclaimed("unattached") - before == 7
+
+
+async def test_reconcile_storage(insert_data, local_storage):
+    old = time.time() - 2 * 86400
+    for key in ("stray.png", "kept.png", "new.png"):
+        await local_storage.save(key, b"png", "")
+    for key in ("stray.png", "kept.png"):
+        os.utime(local_storage.path(key), (old, old))
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(Media).values(
+                name=local_storage.url("kept.png"),
+                key="kept.png",
+                user_id=1,
+                tweet_id=1,
+            )
+        )
+        await session.commit()
+        before = reclaimed("unreferenced")
+
+        assert await reconcile_storage(session) == 1
+
+    assert sorted(path.name for path in local_storage.root.iterdir()) == [
+        "kept.png",
+        "new.png",
+    ]
+    assert reclaimed("unreferenced") - before == 3
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+import pytest
+from httpx import AsyncClient
+from prometheus_client import REGISTRY
+
+from api import users
+from core.loop_monitor import SlowCallbackDetector, monitor_lag
+
+
+def lag_sample(name: str) -> float:
+    return REGISTRY.get_sample_value(f"event_loop_lag_seconds_{name}") or 0
+
+
+async def test_monitor_lag():
+    count, total = lag_sample("count"), lag_sample("sum")
+    task = asyncio.create_task(monitor_lag(0.01))
+    await asyncio.sleep(0.02)
+    time.sleep(0.1)
+    await asyncio.sleep(0.03)
+    task.cancel()
+
+    assert lag_sample("count") - count >= 2
+    assert lag_sample("sum") - total >= 0.05
+
+
+@pytest.fixture
+def detector():
+    detector = SlowCallbackDetector(0.05)
+    detector.install()
+    yield detector
+    detector.uninstall()
+
+
+async def test_slow_callback_names_the_route(
+    ac: AsyncClient, insert_data, detector, monkeypatch
+):
+    get_user = users.get_user
+
+    async def blocking_get_user(**kwargs):
+        time.sleep(0.15)
+        return await get_user(**kwargs)
+
+    monkeypatch.setattr(users, "get_user", blocking_get_user)
+    response = await ac.get("api/users/1")
+    assert response.status_code == 200
+
+    # Other slow callbacks of the request, a first compile of its
+    # statements say, are reported too.
+    [report] = [
+        report
+        for report in detector.reports
+        if "blocking_get_user" in report.stack
+    ]
+    assert report.route == "GET get_user_by_id"
+    assert report.duration >= 0.15
+    assert "time.sleep" in report.stack
@@ -0,0 +1,221 @@
+import asyncio
+
+import pytest
+from httpx import AsyncClient
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from core.database import is_sqlite
+from db.models import Notification, User
+from services import notification_service
+from tests.conftest import DATABASE_URL_TEST, async_session_maker
+
+AUTHOR = {"api-key": "author_300"}
+
+
+async def flush():
+    async with async_session_maker() as session:
+        return await notification_service.flush_notifications(session)
+
+
+async def test_notifications(ac: AsyncClient, insert_data):
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {
+                        "id": user_id,
+                        "name": f"fan {user_id}",
+                        "api_key": f"author_{user_id}",
+                    }
+                    for user_id in range(300, 306)
+                ]
+            )
+        )
+        await session.commit()
+    response = await ac.post(
+        "api/tweets/", headers=AUTHOR, json={"tweet_data": "like me"}
+    )
+    tweet_id = response.json()["tweet_id"]
+    await flush()
+
+    for user_id in range(301, 305):
+        await ac.post(
+            f"api/tweets/{tweet_id}/likes",
+            headers={"api-key": f"author_{user_id}"},
+        )
+    await ac.post(f"api/tweets/{tweet_id}/likes", headers=AUTHOR)
+    await ac.post("api/users/300/follow", headers={"api-key": "author_305"})
+    # Four likes and a follow, coalesced into two rows; self-likes are not
+    # notified.
+    assert await flush() == 2
+
+    response = await ac.get("api/notifications/", headers=AUTHOR)
+    page = response.json()
+    assert response.headers["cache-control"] == "private, no-store"
+    assert page["unread_count"] == 2
+    follow, like = page["notifications"]
+    assert follow["text"] == "fan 305 followed you"
+    assert like["tweet_id"] == tweet_id
+    assert like["text"] == "fan 304 and 3 others liked your tweet"
+
+    response = await ac.post("api/notifications/read", headers=AUTHOR)
+    assert response.status_code == 200
+    response = await ac.get("api/notifications/", headers=AUTHOR)
+    assert response.json()["unread_count"] == 0
+
+    await ac.delete(
+        f"api/tweets/{tweet_id}/likes", headers={"api-key": "author_301"}
+    )
+    await ac.post(
+        f"api/tweets/{tweet_id}/likes", headers={"api-key": "author_301"}
+    )
+    await flush()
+
+    response = await ac.get(
+        "api/notifications/", headers=AUTHOR, params={"limit": 1}
+    )
+    page = response.json()
+    assert page["unread_count"] == 1
+    [like] = page["notifications"]
+    assert like["unread"] is True
+    assert like["text"] == "fan 301 and 4 others liked your tweet"
+
+    response = await ac.get(
+        "api/notifications/",
+        headers=AUTHOR,
+        params={"limit": 1, "cursor": page["next_cursor"]},
+    )
+    page = response.json()
+    [follow] = page["notifications"]
+    assert follow["kind"] == "follow" and follow["unread"] is False
+    assert page["next_cursor"] is None
+
+    response = await ac.get("api/notifications/", headers={"api-key": "x"})
+    assert response.status_code == 404
+
+
+async def test_failed_flush_requeues(insert_data, monkeypatch):
+    notification_service.pending.clear()
+    notification_service.notify(1, "follow", 2)
+
+    async def fail(*args, **kwargs):
+        raise RuntimeError("database is down")
+
+    monkeypatch.setattr(notification_service, "change_counters", fail)
+    async with async_session_maker() as session:
+        try:
+            await notification_service.flush_notifications(session)
+        except RuntimeError:
+            pass
+    [(key, (actor_id, count, _))] = notification_service.pending.items()
+    assert (key, actor_id, count) == ((1, "follow", 0), 2, 1)
+    assert notification_service.attempts == {(1, "follow", 0): 1}
+    notification_service.pending.clear()
+    notification_service.attempts.clear()
+
+
+async def test_failing_group_dropped(insert_data, monkeypatch):
+    monkeypatch.setattr(notification_service, "NOTIFY_FLUSH_ATTEMPTS", 2)
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {"id": user_id, "name": "fan", "api_key": f"fan_{user_id}"}
+                    for user_id in (710, 711)
+                ]
+            )
+        )
+        await session.commit()
+    notification_service.pending.clear()
+    notification_service.notify(710, "follow", 711)
+    # Its actor is gone: the foreign key fails the write.
+    notification_service.notify(711, "follow", 719)
+
+    with pytest.raises(IntegrityError):
+        await flush()
+    assert len(notification_service.pending) == 2
+
+    # Written one by one now: the good group goes through.
+    with pytest.raises(IntegrityError):
+        await flush()
+    assert notification_service.pending == {}
+    assert notification_service.attempts == {}
+    async with async_session_maker() as session:
+        response = await session.execute(
+            select(Notification.user_id, User.unread_notifications)
+            .join(User, User.id == Notification.user_id)
+            .where(Notification.user_id.in_([710, 711]))
+        )
+        assert response.all() == [(710, 1)]
+
+
+async def test_concurrent_flushes_count_once(insert_data):
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {"id": user_id, "name": "fan", "api_key": f"fan_{user_id}"}
+                    for user_id in (712, 713)
+                ]
+            )
+        )
+        await session.commit()
+
+    async def write(seq):
+        async with async_session_maker() as session:
+            await notification_service.write_groups(
+                session, {(712, "follow", 0): (713, 1, seq)}
+            )
+
+    # Two workers creating the same group: only one of them inserts it.
+    await asyncio.gather(write(1), write(2))
+    async with async_session_maker() as session:
+        user = await session.get(User, 712)
+        assert user.unread_notifications == 1
+
+
+async def test_read_keeps_concurrent_flush(insert_data, monkeypatch):
+    if is_sqlite(DATABASE_URL_TEST):
+        pytest.skip("SQLite runs one writer at a time")
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {"id": user_id, "name": "fan", "api_key": f"fan_{user_id}"}
+                    for user_id in (714, 715, 716)
+                ]
+            )
+        )
+        await session.commit()
+        await notification_service.write_groups(
+            session, {(714, "follow", 0): (715, 1, 1)}
+        )
+
+    change_counters = notification_service.change_counters
+    flushed = []
+
+    async def flush_meanwhile(session, user_id, **deltas):
+        # Another worker flushes between the two updates of the read.
+        if not flushed:
+            flushed.append(user_id)
+            async with async_session_maker() as other:
+                await notification_service.write_groups(
+                    other, {(714, "like", 5): (716, 1, 2)}
+                )
+        await change_counters(session, user_id, **deltas)
+
+    monkeypatch.setattr(
+        notification_service, "change_counters", flush_meanwhile
+    )
+    async with async_session_maker() as session:
+        await notification_service.read_notifications(
+            session, api_key="fan_714"
+        )
+        user = await session.get(User, 714)
+        unread = await session.scalar(
+            select(func.count()).where(
+                Notification.user_id == 714, Notification.unread
+            )
+        )
+    assert user.unread_notifications == unread == 1
@@ -0,0 +1,219 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from core.database import is_sqlite
+from core.partitions import PARTITION_KEYS, month_start, partition_table
+from core.sharding import make_session_maker
+from core.snowflake import make_id, min_id_at
+from db.models import Base, Tweet
+from services.partition_service import maintain_partitions
+from services.tweet_service import minted_after
+from tests.conftest import DATABASE_URL_TEST
+
+SCHEMA = "partitions"
+NOW = datetime(2026, 6, 10, tzinfo=timezone.utc)
+
+
+def id_at(year: int, month: int) -> int:
+    moment = datetime(year, month, 15, tzinfo=timezone.utc)
+    return make_id(int(moment.timestamp() * 1000))
+
+
+OLD_TWEET = id_at(2026, 1)
+TWEET = id_at(2026, 6)
+NEXT_TWEET = id_at(2026, 7)
+
+engine_partitions = create_async_engine(
+    DATABASE_URL_TEST,
+    connect_args={"server_settings": {"search_path": SCHEMA}},
+)
+session_maker = make_session_maker({"0": engine_partitions})
+
+
+@pytest.fixture(scope="module")
+async def partitioned_schema():
+    if is_sqlite(DATABASE_URL_TEST):
+        pytest.skip("partitions are PostgreSQL only")
+    async with engine_partitions.begin() as conn:
+        await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        await conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(
+            text(
+                "INSERT INTO users (id, name, api_key) "
+                "VALUES (1, 'author', 'key_1')"
+            )
+        )
+        for tweet_id in (OLD_TWEET, TWEET):
+            await conn.execute(
+                text(
+                    "INSERT INTO tweets (id, user_id, content) "
+                    "VALUES (:id, 1, 'tweet')"
+                ),
+                {"id": tweet_id},
+            )
+            await conn.execute(
+                text(
+                    "INSERT INTO likes (id, user_id, tweet_id) "
+                    "VALUES (:id, 1, :id)"
+                ),
+                {"id": tweet_id},
+            )
+        await conn.execute(
+            text(
+                "INSERT INTO medias (id, name, key, user_id, tweet_id) "
+                "VALUES (1, '/static/media_files/1.png', '1.png', 1, :id)"
+            ),
+            {"id": OLD_TWEET},
+        )
+        await conn.execute(
+            text(
+                "INSERT INTO tweet_hashtags (tag, tweet_id) VALUES ('a', :id)"
+            ),
+            {"id": OLD_TWEET},
+        )
+        await conn.execute(
+            text(
+                "INSERT INTO tweet_mentions (user_id, tweet_id) "
+                "VALUES (1, :id)"
+            ),
+            {"id": OLD_TWEET},
+        )
+        for table in PARTITION_KEYS:
+            await conn.run_sync(
+                partition_table, table, min_id_at(month_start(NOW, 1))
+            )
+    yield
+    async with engine_partitions.begin() as conn:
+        await conn.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+    await engine_partitions.dispose()
+
+
+async def partition_names(conn, table: str):
+    result = await conn.execute(
+        text(
+            "SELECT relname FROM pg_inherits "
+            "JOIN pg_class ON pg_class.oid = inhrelid "
+            "WHERE inhparent = CAST(:table AS regclass) ORDER BY relname"
+        ),
+        {"table": table},
+    )
+    return result.scalars().all()
+
+
+async def scanned_partitions(conn, statement):
+    sql = str(
+        statement.compile(
+            dialect=postgresql.dialect(),
+            compile_kwargs={"literal_binds": True},
+        )
+    )
+    result = await conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}"))
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return sorted(
+        {
+            node["Relation Name"]
+            for node in iter_nodes(plan[0]["Plan"])
+            if "Relation Name" in node
+        }
+    )
+
+
+def iter_nodes(node):
+    yield node
+    for child in node.get("Plans", ()):
+        yield from iter_nodes(child)
+
+
+async def test_partitions(partitioned_schema, local_storage):
+    async with session_maker() as session:
+        assert await maintain_partitions(
+            session, months_ahead=2, retention_months=0, now=NOW
+        )
+
+    async with engine_partitions.begin() as conn:
+        for table in PARTITION_KEYS:
+            assert await partition_names(conn, table) == [
+                f"{table}_legacy",
+                f"{table}_p202607",
+                f"{table}_p202608",
+            ]
+
+        await conn.execute(
+            text(
+                "INSERT INTO tweets (id, user_id, content, retweet_of_id) "
+                "VALUES (:id, 1, '', :original)"
+            ),
+            {"id": NEXT_TWEET, "original": TWEET},
+        )
+        await conn.execute(
+            text(
+                "INSERT INTO likes (id, user_id, tweet_id) "
+                "VALUES (:id, 1, :id)"
+            ),
+            {"id": NEXT_TWEET},
+        )
+        stored_in = await conn.execute(
+            text(
+                "SELECT CAST(tableoid AS regclass) FROM tweets WHERE id = :id"
+            ),
+            {"id": NEXT_TWEET},
+        )
+        assert stored_in.scalar() == "tweets_p202607"
+
+        # A read by id only touches the partition of its month...
+        assert await scanned_partitions(
+            conn, select(Tweet.id).where(Tweet.id == NEXT_TWEET)
+        ) == ["tweets_p202607"]
+        # ... and a retweet lookup those from the month of the original on.
+        assert await scanned_partitions(
+            conn,
+            select(Tweet.id).where(
+                Tweet.user_id == 1,
+                Tweet.retweet_of_id == NEXT_TWEET,
+                minted_after(NEXT_TWEET),
+            ),
+        ) == ["tweets_p202607", "tweets_p202608"]
+
+        local_unique = await conn.execute(
+            text(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE tablename = 'tweets_p202607' "
+                "AND indexdef LIKE 'CREATE UNIQUE INDEX%retweet_of_id%'"
+            )
+        )
+        assert (
+            local_unique.scalar() == "ix_tweets_p202607_user_id_retweet_of_id"
+        )
+
+    async with session_maker() as session:
+        assert await maintain_partitions(
+            session,
+            months_ahead=0,
+            retention_months=1,
+            now=datetime(2026, 8, 20, tzinfo=timezone.utc),
+        )
+
+    async with engine_partitions.begin() as conn:
+        for table in PARTITION_KEYS:
+            assert await partition_names(conn, table) == [
+                f"{table}_p202607",
+                f"{table}_p202608",
+            ]
+        tweets = await conn.execute(text("SELECT id FROM tweets"))
+        assert tweets.scalars().all() == [NEXT_TWEET]
+        for table in ("medias", "tweet_hashtags", "tweet_mentions"):
+            rows = await conn.execute(text(f"SELECT count(*) FROM {table}"))
+            assert rows.scalar() == 0
+        # Detached partitions are kept for archiving.
+        archived = await conn.execute(
+            text("SELECT id FROM tweets_legacy ORDER BY id")
+        )
+        assert archived.scalars().all() == [OLD_TWEET, TWEET]
@@ -0,0 +1,91 @@
+import asyncio
+import sys
+import time
+
+import pytest
+from httpx import AsyncClient
+
+from core import profiling
+from core.profiling import Sampler
+
+TOKEN = "admin-secret"
+
+
+@pytest.fixture
+def admin_token(monkeypatch):
+    monkeypatch.setattr(profiling, "ADMIN_TOKEN", TOKEN)
+    return {"x-admin-token": TOKEN}
+
+
+def spin(seconds: float):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+async def spin_marked(sampler: Sampler, seconds: float):
+    profile = sampler.start(marker=sys._getframe())
+    for _ in range(10):
+        spin(seconds / 10)
+        await asyncio.sleep(0)
+    return sampler.stop(profile)
+
+
+async def spin_other(seconds: float):
+    for _ in range(10):
+        spin(seconds / 10)
+        await asyncio.sleep(0)
+
+
+async def test_request_profile_keeps_own_samples():
+    sampler = Sampler(0.001)
+    profile, _ = await asyncio.gather(
+        spin_marked(sampler, 0.2), spin_other(0.2)
+    )
+
+    assert profile.samples
+    assert all("spin_marked" in stack for stack in profile.stacks)
+    assert "tests.test_profiling:spin" in profile.collapsed()
+    assert profile.flamegraph().startswith("<svg")
+
+
+async def test_profile_worker(ac: AsyncClient, admin_token):
+    response = await ac.get("/debug/profile", params={"seconds": 0.1})
+    assert response.status_code == 403
+
+    async def busy():
+        await asyncio.sleep(0.01)
+        spin(0.05)
+
+    response, _ = await asyncio.gather(
+        ac.get(
+            "/debug/profile",
+            params={"seconds": 0.2, "format": "svg"},
+            headers=admin_token,
+        ),
+        busy(),
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/svg+xml"
+    assert "tests.test_profiling:spin" in response.text
+
+
+async def test_profile_single_request(
+    ac: AsyncClient, insert_data, admin_token
+):
+    response = await ac.get("api/users/1", headers={"x-profile": "1"})
+    assert "x-profile-id" not in response.headers
+
+    response = await ac.get(
+        "api/users/1", headers={"x-profile": "1", **admin_token}
+    )
+    assert response.status_code == 200
+    profile_id = response.headers["x-profile-id"]
+
+    response = await ac.get(
+        f"/debug/profile/{profile_id}", headers=admin_token
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    response = await ac.get("/debug/profile/unknown", headers=admin_token)
+    assert response.status_code == 404
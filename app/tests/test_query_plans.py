@@ -0,0 +1,387 @@
+import json
+import re
+
+import pytest
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from core.database import is_sqlite
+from core.sharding import make_session_maker
+from db.models import Base
+from db.schemas import UserIn
+from dependencies import get_user_by_api_key
+from services import account_service, notification_service
+from services.media_service import (
+    complete_image_upload,
+    post_image,
+    presign_image_upload,
+)
+from services.purge_service import purge_deleted_tweets
+from services.ranking_service import rescore_recent
+from services.tweet_service import (
+    delete_like_to_tweet,
+    delete_retweet,
+    delete_tweet,
+    export_tweets,
+    get_hashtag_tweets,
+    get_mentions,
+    get_thread,
+    get_tweet,
+    get_tweet_likes,
+    get_tweets,
+    insert_media_to_tweet,
+    post_like_to_tweet,
+    post_retweet,
+    post_tweet,
+)
+from services.user_service import (
+    add_follow_to_user,
+    add_follows_to_user,
+    delete_follow_from_user,
+    delete_follows_from_user,
+    get_follows,
+    get_user,
+    get_user_me,
+    post_user,
+)
+from tests.conftest import DATABASE_URL_TEST
+
+SCHEMA = "query_plans"
+
+SEED_SQL = (
+    """
+    INSERT INTO users (id, name, api_key, password)
+    SELECT g, 'user ' || g, 'key_' || g, 'secret'
+    FROM generate_series(1, 2000) AS g
+    """,
+    """
+    INSERT INTO tweets (id, user_id, content)
+    SELECT g, 1 + g % 2000, 'tweet ' || g
+    FROM generate_series(1, 20000) AS g
+    """,
+    """
+    INSERT INTO likes (id, user_id, tweet_id)
+    SELECT g, 1 + g % 2000, 1 + (g * 7) % 20000
+    FROM generate_series(1, 50000) AS g
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO followers (following_user_id, followed_user_id)
+    SELECT 1 + g % 2000, 1 + (g * 13) % 2000
+    FROM generate_series(1, 20000) AS g
+    WHERE 1 + g % 2000 <> 1 + (g * 13) % 2000
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO medias (id, name, key, user_id, tweet_id)
+    SELECT g, '/static/media_files/' || g || '.png', g || '.png',
+        1 + g % 2000, 1 + g % 20000
+    FROM generate_series(1, 5000) AS g
+    """,
+    """
+    INSERT INTO tweet_hashtags (tag, tweet_id)
+    SELECT 'tag' || g % 50, g
+    FROM generate_series(1, 20000) AS g
+    """,
+    """
+    INSERT INTO tweet_mentions (user_id, tweet_id)
+    SELECT 1 + (g * 3) % 2000, g
+    FROM generate_series(1, 20000) AS g
+    """,
+    """
+    INSERT INTO notifications (user_id, kind, tweet_id, actor_id, seq)
+    SELECT 1 + g % 2000, 'like', g, 1 + (g * 7) % 2000, g
+    FROM generate_series(1, 20000) AS g
+    """,
+)
+
+LEADING_COLUMNS_SQL = """
+    SELECT
+        index_class.relname,
+        CASE WHEN pg_index.indpred IS NULL THEN attribute.attname END
+    FROM pg_index
+    JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid
+    JOIN pg_namespace ON pg_namespace.oid = index_class.relnamespace
+    LEFT JOIN pg_attribute AS attribute
+        ON attribute.attrelid = pg_index.indrelid
+        AND attribute.attnum = pg_index.indkey[0]
+    WHERE pg_namespace.nspname = current_schema()
+"""
+
+engine_plans = create_async_engine(
+    DATABASE_URL_TEST,
+    connect_args={"server_settings": {"search_path": SCHEMA}},
+)
+session_maker = make_session_maker({"0": engine_plans})
+
+
+@pytest.fixture(scope="module")
+async def seeded_schema():
+    if is_sqlite(DATABASE_URL_TEST):
+        pytest.skip("reads PostgreSQL query plans")
+    async with engine_plans.begin() as conn:
+        await conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        await conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        await conn.run_sync(Base.metadata.create_all)
+        for statement in SEED_SQL:
+            await conn.execute(text(statement))
+        await conn.execute(
+            text(
+                "SELECT setval(pg_get_serial_sequence('users', 'id'), "
+                "(SELECT max(id) FROM users))"
+            )
+        )
+        await conn.execute(text("ANALYZE"))
+    yield
+    async with engine_plans.begin() as conn:
+        await conn.execute(text(f"DROP SCHEMA {SCHEMA} CASCADE"))
+    await engine_plans.dispose()
+
+
+class StatementRecorder:
+    """Collect every statement sent to the database while active."""
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(
+            engine_plans.sync_engine, "before_cursor_execute", self.record
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(
+            engine_plans.sync_engine, "before_cursor_execute", self.record
+        )
+
+    def record(self, conn, cursor, statement, parameters, context, many):
+        if statement.lstrip().split(" ", 1)[0].upper() in (
+            "SELECT",
+            "INSERT",
+            "UPDATE",
+            "DELETE",
+        ):
+            self.statements.append((statement, parameters))
+
+
+def iter_plan_nodes(node):
+    yield node
+    for child in node.get("Plans", ()):
+        yield from iter_plan_nodes(child)
+
+
+def is_full_scan(node, leading_columns):
+    """
+    With enable_seqscan off the planner still falls back to walking a whole
+    index when no index matches the predicate: either with a Filter only, or
+    with an Index Cond that does not touch the leading column. Walking a
+    partial index is fine, it only holds the rows the query asks for.
+    """
+    if node["Node Type"] == "Seq Scan":
+        return True
+    if node["Node Type"] not in (
+        "Index Scan",
+        "Index Only Scan",
+        "Bitmap Index Scan",
+    ):
+        return False
+    leading_column = leading_columns[node["Index Name"]]
+    if leading_column is None:
+        return False
+    return not re.search(rf"\b{leading_column}\b", node.get("Index Cond", ""))
+
+
+async def assert_no_seq_scans(statements):
+    assert statements, "service did not run any query"
+    async with engine_plans.connect() as conn:
+        await conn.execute(text("SET enable_seqscan = off"))
+        result = await conn.execute(text(LEADING_COLUMNS_SQL))
+        leading_columns = dict(result.all())
+        for statement, parameters in statements:
+            result = await conn.exec_driver_sql(
+                "EXPLAIN (FORMAT JSON) " + statement, parameters
+            )
+            plan = result.scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            scans = [
+                node.get("Relation Name", node.get("Index Name"))
+                for node in iter_plan_nodes(plan[0]["Plan"])
+                if is_full_scan(node, leading_columns)
+            ]
+            assert not scans, f"Full scan of {scans} for: {statement}"
+
+
+async def run_recorded(service, **kwargs):
+    async with session_maker() as session:
+        with StatementRecorder() as recorder:
+            await service(session=session, **kwargs)
+    await assert_no_seq_scans(recorder.statements)
+
+
+async def assert_depth_in_index(tweet_id: int):
+    """Replies below the depth asked for are skipped in the index."""
+    async with session_maker() as session:
+        with StatementRecorder() as recorder:
+            await get_thread(
+                session=session, tweet_id=tweet_id, depth=1, limit=5
+            )
+    [(statement, parameters)] = [
+        (statement, parameters)
+        for statement, parameters in recorder.statements
+        if "tweets.depth <=" in statement
+    ]
+    async with engine_plans.connect() as conn:
+        await conn.execute(text("SET enable_seqscan = off"))
+        result = await conn.exec_driver_sql(
+            "EXPLAIN (FORMAT JSON) " + statement, parameters
+        )
+        plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    [scan] = [
+        node
+        for node in iter_plan_nodes(plan[0]["Plan"])
+        if node.get("Relation Name") == "tweets"
+        and node.get("Index Name") == "ix_tweets_root_id_path_depth"
+    ]
+    assert "depth" in scan["Index Cond"]
+
+
+async def test_get_user_by_api_key_plan(seeded_schema):
+    await run_recorded(get_user_by_api_key, api_key="key_10")
+
+
+async def test_get_user_plans(seeded_schema):
+    await run_recorded(get_user, user_id=10)
+    await run_recorded(get_user_me, api_key="key_10")
+    for side in ("followers", "following"):
+        await run_recorded(get_follows, user_id=10, side=side, cursor=100)
+
+
+async def test_post_user_plan(seeded_schema):
+    user = UserIn(name="planner", api_key="planner", password="secret")
+    await run_recorded(post_user, user=user)
+
+
+async def test_follow_plans(seeded_schema):
+    await run_recorded(add_follow_to_user, api_key="key_10", user_id=1999)
+    await run_recorded(delete_follow_from_user, api_key="key_10", user_id=1999)
+    user_ids = list(range(1950, 2000))
+    await run_recorded(
+        add_follows_to_user, api_key="key_10", user_ids=user_ids
+    )
+    await run_recorded(
+        delete_follows_from_user, api_key="key_10", user_ids=user_ids
+    )
+
+
+async def test_get_tweet_plans(seeded_schema):
+    await run_recorded(get_tweet, tweet_id=10)
+    await run_recorded(get_tweet, tweet_id=10, api_key="key_10")
+    await run_recorded(get_tweet_likes, tweet_id=7, limit=2)
+    await run_recorded(get_tweet_likes, tweet_id=7, cursor=30000, limit=2)
+    for order in ("ranked", "recent", "top"):
+        await run_recorded(get_tweets, api_key="key_10", order=order, limit=5)
+
+
+async def test_tag_feed_plans(seeded_schema):
+    await run_recorded(get_hashtag_tweets, tag="tag7", limit=5)
+    await run_recorded(
+        get_hashtag_tweets, tag="tag7", api_key="key_10", cursor=10000
+    )
+    await run_recorded(get_mentions, user_id=10, limit=5)
+    await run_recorded(get_mentions, user_id=10, cursor=10000, limit=5)
+    await run_recorded(
+        post_tweet, api_key="key_10", tweet_data="#plan for @nobody"
+    )
+
+
+async def test_rescore_plan(seeded_schema):
+    await run_recorded(rescore_recent, batch_size=100)
+
+
+async def test_export_tweets_plan(seeded_schema):
+    async with session_maker() as session:
+        with StatementRecorder() as recorder:
+            tweets = await export_tweets(session=session, user_id=10)
+            assert [line async for line in tweets]
+    await assert_no_seq_scans(recorder.statements)
+
+
+async def test_media_plans(seeded_schema, local_storage):
+    upload = dict(filename="plan.png", content_type="image/png")
+    await run_recorded(presign_image_upload, api_key="key_10", **upload)
+    await run_recorded(post_image, api_key="key_10", data=b"png", **upload)
+    async with session_maker() as session:
+        media = await post_image(
+            session=session, api_key="key_10", data=b"png", **upload
+        )
+    await run_recorded(
+        complete_image_upload, api_key="key_10", media_id=media["media_id"]
+    )
+
+
+async def test_tweet_write_plans(seeded_schema, local_storage):
+    async with session_maker() as session:
+        media = await post_image(
+            session=session,
+            api_key="key_10",
+            filename="plan.png",
+            data=b"png",
+            content_type="image/png",
+        )
+        tweet_id = await post_tweet(
+            session=session, api_key="key_10", tweet_data="plan"
+        )
+    await run_recorded(post_tweet, api_key="key_10", tweet_data="plan")
+    await run_recorded(
+        insert_media_to_tweet,
+        tweet_id=tweet_id,
+        tweet_medias=[media["media_id"]],
+    )
+    await run_recorded(post_like_to_tweet, api_key="key_11", tweet_id=tweet_id)
+    await run_recorded(
+        delete_like_to_tweet, api_key="key_11", tweet_id=tweet_id
+    )
+    await run_recorded(post_retweet, api_key="key_12", tweet_id=tweet_id)
+    await run_recorded(
+        post_tweet, api_key="key_12", tweet_data="plan", quote_tweet_id=10
+    )
+    await run_recorded(get_tweets, api_key="key_12", order="recent")
+    await run_recorded(
+        post_tweet, api_key="key_13", tweet_data="plan", reply_to_id=tweet_id
+    )
+    await run_recorded(get_thread, tweet_id=tweet_id, depth=2, limit=5)
+    await assert_depth_in_index(tweet_id)
+    await run_recorded(
+        get_thread, tweet_id=tweet_id, api_key="key_13", cursor="0", limit=5
+    )
+    await run_recorded(delete_retweet, api_key="key_12", tweet_id=tweet_id)
+    await run_recorded(delete_tweet, api_key="key_10", tweet_id=tweet_id)
+
+
+async def test_purge_plans(seeded_schema):
+    async with session_maker() as session:
+        await delete_tweet(session=session, api_key="key_8", tweet_id=7)
+    await run_recorded(purge_deleted_tweets, batch_size=10)
+
+
+async def test_account_deletion_plans(seeded_schema, monkeypatch):
+    monkeypatch.setattr(account_service, "ACCOUNT_DELETION_PAUSE", 0)
+    await run_recorded(account_service.delete_account, api_key="key_1500")
+    await run_recorded(account_service.delete_accounts, batch_size=5)
+
+
+async def test_notification_plans(seeded_schema):
+    notification_service.pending.clear()
+    notification_service.notify(10, "follow", 11)
+    notification_service.notify(10, "like", 11, tweet_id=10)
+    await run_recorded(notification_service.flush_notifications)
+    await run_recorded(
+        notification_service.get_notifications, api_key="key_10", limit=1
+    )
+    await run_recorded(
+        notification_service.read_notifications, api_key="key_10"
+    )
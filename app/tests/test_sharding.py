@@ -0,0 +1,272 @@
+import pytest
+from sqlalchemy import func, insert, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from core.database import is_sqlite
+from core.sharding import make_session_maker, router_of, scatter_gather
+from db.models import Base, Like, Media, Tweet, User
+from db.schemas import UserIn
+from services.counter_service import repair_counters
+from services.media_service import post_image
+from services.tweet_service import (
+    get_tweet,
+    get_tweets,
+    post_like_to_tweet,
+    post_tweet,
+)
+from services.user_service import post_user
+from tests.conftest import DATABASE_URL_TEST
+from tools.reshard import reshard
+from tools.seed import GraphShape, chunk_count, generate_tweets, seed
+
+SHARD_DATABASES = ("test_shard_0", "test_shard_1", "test_shard_2")
+SOURCE_DATABASE = "test_shard_source"
+
+
+def url_for(database: str) -> str:
+    return (
+        make_url(DATABASE_URL_TEST)
+        .set(database=database)
+        .render_as_string(hide_password=False)
+    )
+
+
+@pytest.fixture
+async def shard_engines():
+    if is_sqlite(DATABASE_URL_TEST):
+        pytest.skip("creates PostgreSQL databases")
+    admin = create_async_engine(
+        DATABASE_URL_TEST, isolation_level="AUTOCOMMIT"
+    )
+    async with admin.connect() as conn:
+        for database in (*SHARD_DATABASES, SOURCE_DATABASE):
+            await conn.execute(text(f"DROP DATABASE IF EXISTS {database}"))
+            await conn.execute(text(f"CREATE DATABASE {database}"))
+
+    engines = {}
+    for database in (*SHARD_DATABASES, SOURCE_DATABASE):
+        engines[database] = create_async_engine(url_for(database))
+        async with engines[database].begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    yield engines
+
+    for engine in engines.values():
+        await engine.dispose()
+    async with admin.connect() as conn:
+        for database in (*SHARD_DATABASES, SOURCE_DATABASE):
+            await conn.execute(text(f"DROP DATABASE {database}"))
+    await admin.dispose()
+
+
+def sharded_session_maker(shard_engines, id_floor=0):
+    return make_session_maker(
+        {
+            str(number): shard_engines[database]
+            for number, database in enumerate(SHARD_DATABASES)
+        },
+        id_floor=id_floor,
+    )
+
+
+async def count_rows(engine, model) -> int:
+    async with engine.connect() as conn:
+        result = await conn.execute(select(func.count()).select_from(model))
+        return result.scalar()
+
+
+async def create_users(session, count: int):
+    for number in range(1, count + 1):
+        user = UserIn(
+            name=f"user {number}", api_key=f"key_{number}", password="secret"
+        )
+        await post_user(session=session, user=user)
+
+
+async def test_rows_follow_their_author(shard_engines, local_storage):
+    async with sharded_session_maker(shard_engines)() as session:
+        await create_users(session, 3)
+        tweet_id = await post_tweet(
+            session=session, api_key="key_1", tweet_data="sharded"
+        )
+        await post_like_to_tweet(
+            session=session, api_key="key_2", tweet_id=tweet_id
+        )
+        media = await post_image(
+            session=session,
+            api_key="key_2",
+            filename="sharded.png",
+            data=b"png",
+            content_type="image/png",
+        )
+        assert router_of(session).for_id(tweet_id) == "1"
+        assert router_of(session).for_id(media["media_id"]) == "2"
+
+    counts = {
+        database: (
+            await count_rows(shard_engines[database], User),
+            await count_rows(shard_engines[database], Tweet),
+            await count_rows(shard_engines[database], Like),
+            await count_rows(shard_engines[database], Media),
+        )
+        for database in SHARD_DATABASES
+    }
+    assert counts == {
+        "test_shard_0": (3, 0, 0, 0),
+        "test_shard_1": (3, 1, 1, 0),
+        "test_shard_2": (3, 0, 0, 1),
+    }
+
+    async with shard_engines["test_shard_1"].connect() as conn:
+        result = await conn.execute(select(User.api_key))
+        assert result.scalars().all() == [None, None, None]
+
+    async with sharded_session_maker(shard_engines)() as session:
+        tweet = await get_tweet(session=session, tweet_id=tweet_id)
+        assert tweet.author.name == "user 1"
+        assert [like.user.api_key for like in tweet.likes] == ["key_2"]
+
+        tweets = await get_tweets(session=session, api_key="key_1")
+        assert [tweet.id for tweet in tweets["tweets"]] == [tweet_id]
+
+
+async def test_scatter_gather_merges_shards(shard_engines):
+    async with sharded_session_maker(shard_engines)() as session:
+        await create_users(session, 3)
+        tweet_ids = [
+            await post_tweet(
+                session=session, api_key=f"key_{number % 3 + 1}", tweet_data=""
+            )
+            for number in range(9)
+        ]
+
+        latest = await scatter_gather(
+            session,
+            select(Tweet).order_by(Tweet.id.desc()).limit(4),
+            key=lambda tweet: tweet.id,
+            reverse=True,
+            limit=4,
+        )
+
+    assert [tweet.id for tweet in latest] == sorted(tweet_ids)[::-1][:4]
+
+
+async def test_reshard_moves_rows_by_author(shard_engines):
+    source = shard_engines[SOURCE_DATABASE]
+    async with source.begin() as conn:
+        await conn.execute(
+            insert(User),
+            [
+                {
+                    "id": number,
+                    "name": f"user {number}",
+                    "api_key": f"key_{number}",
+                }
+                for number in range(1, 5)
+            ],
+        )
+        # Serial ids from before sharding: their bits are not a bucket.
+        await conn.execute(
+            insert(Tweet),
+            [
+                {"id": number, "user_id": number, "content": "legacy"}
+                for number in range(1, 5)
+            ],
+        )
+        await conn.execute(insert(Like).values(id=1, user_id=1, tweet_id=4))
+        await conn.execute(
+            insert(Media).values(
+                id=1, name="legacy.png", key="legacy.png", tweet_id=4
+            )
+        )
+    async with make_session_maker({"0": source})() as session:
+        tweet_id = await post_tweet(
+            session=session, api_key="key_2", tweet_data="new"
+        )
+
+    stats = await reshard(
+        [url_for(SOURCE_DATABASE)],
+        [url_for(database) for database in SHARD_DATABASES],
+        batch_size=2,
+        delete_source=True,
+    )
+
+    assert stats["users"] == 4
+    assert stats["rows"] == {"tweets": 5, "likes": 1, "medias": 1}
+    assert stats["id_floor"] == 5
+    assert await count_rows(source, Tweet) == 0
+    assert [
+        await count_rows(shard_engines[database], Tweet)
+        for database in SHARD_DATABASES
+    ] == [1, 2, 2]
+
+    async with sharded_session_maker(
+        shard_engines, stats["id_floor"]
+    )() as session:
+        for legacy_id in range(1, 5):
+            tweet = await get_tweet(session=session, tweet_id=legacy_id)
+            assert tweet.user_id == legacy_id
+        tweet = await get_tweet(session=session, tweet_id=4)
+        assert len(tweet.likes) == 1 and len(tweet.media) == 1
+        tweet = await get_tweet(session=session, tweet_id=tweet_id)
+        assert tweet.content == "new"
+
+
+async def test_seed_is_deterministic(shard_engines):
+    urls = [url_for(database) for database in SHARD_DATABASES]
+    shape = GraphShape(users=60, seed=7, chunk_size=16, tweets_mean=4)
+
+    stats = await seed(urls, shape, processes=2)
+    assert stats["users"] == 60
+    generated = [
+        generate_tweets(shape, chunk) for chunk in range(chunk_count(shape))
+    ]
+    for table, rows in zip(("tweets", "likes", "medias"), zip(*generated)):
+        assert stats[table] == sum(map(len, rows))
+    assert stats["followers"] and stats["likes"] and stats["medias"]
+    assert stats["tweets"] == sum(
+        [
+            await count_rows(shard_engines[database], Tweet)
+            for database in SHARD_DATABASES
+        ]
+    )
+
+    for database in SHARD_DATABASES:
+        async with shard_engines[database].connect() as conn:
+            likes = (
+                select(func.count())
+                .where(Like.tweet_id == Tweet.id)
+                .scalar_subquery()
+            )
+            result = await conn.execute(
+                select(func.count()).where(
+                    (Tweet.likes_count != likes)
+                    | ((Tweet.likes_count > 0) != (Tweet.score > 0))
+                )
+            )
+            assert result.scalar() == 0
+
+    # The same rows again: nothing new to insert.
+    again = await seed(urls, shape, processes=1)
+    assert not any(again.values())
+
+    async with sharded_session_maker(shard_engines)() as session:
+        assert await repair_counters(session) == 0
+        followed = await session.execute(
+            select(User.followers_count).order_by(User.id)
+        )
+        counts = followed.scalars().all()
+    # Popularity skew: the first users gather most of the follows.
+    assert sum(counts[:10]) > 3 * sum(counts[-10:])
+
+
+def test_seed_ids_are_unique():
+    # More chunks than ids per millisecond and bucket.
+    shape = GraphShape(users=600, chunk_size=1, tweets_mean=3, days=0.001)
+    ids = [
+        row[0]
+        for chunk in range(chunk_count(shape))
+        for rows in generate_tweets(shape, chunk)
+        for row in rows
+    ]
+    assert len(ids) == len(set(ids))
@@ -0,0 +1,113 @@
+import asyncio
+from contextlib import contextmanager
+from typing import Iterator, List
+
+import pytest
+from sqlalchemy import event
+
+from core.singleflight import FlightTimeout, SingleFlight
+from services.tweet_service import get_tweet
+from tests.conftest import async_session_maker, engine_test
+
+
+async def test_concurrent_callers_share_one_flight():
+    group = SingleFlight(timeout=1)
+    calls = []
+    release = asyncio.Event()
+
+    async def compute():
+        calls.append(1)
+        await release.wait()
+        return "tweet"
+
+    waiters = [
+        asyncio.ensure_future(group.do("key", compute, "test"))
+        for _ in range(5)
+    ]
+    await asyncio.sleep(0)
+    release.set()
+    assert await asyncio.gather(*waiters) == ["tweet"] * 5
+    assert len(calls) == 1
+    assert group.flights == {}
+
+    # The next call after landing starts a new flight.
+    assert await group.do("key", compute, "test") == "tweet"
+    assert len(calls) == 2
+
+
+async def test_flight_shares_exceptions():
+    group = SingleFlight(timeout=1)
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        raise LookupError("no tweet")
+
+    results = await asyncio.gather(
+        group.do("key", compute, "test"),
+        group.do("key", compute, "test"),
+        return_exceptions=True,
+    )
+    assert [type(result) for result in results] == [LookupError] * 2
+
+
+async def test_cancelled_caller_does_not_cancel_flight():
+    group = SingleFlight(timeout=1)
+    release = asyncio.Event()
+
+    async def compute():
+        await release.wait()
+        return "tweet"
+
+    leader = asyncio.ensure_future(group.do("key", compute, "test"))
+    follower = asyncio.ensure_future(group.do("key", compute, "test"))
+    await asyncio.sleep(0)
+    leader.cancel()
+    release.set()
+    assert await follower == "tweet"
+    assert leader.cancelled()
+
+
+async def test_timeout_releases_key():
+    group = SingleFlight(timeout=0.01)
+    release = asyncio.Event()
+
+    async def stuck():
+        await release.wait()
+        return "late"
+
+    with pytest.raises(FlightTimeout):
+        await group.do("key", stuck, "test")
+    assert group.flights == {}
+
+    async def fresh():
+        return "fresh"
+
+    assert await group.do("key", fresh, "test") == "fresh"
+    release.set()
+
+
+@contextmanager
+def recording() -> Iterator[List[str]]:
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, many):
+        statements.append(statement)
+
+    event.listen(engine_test.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine_test.sync_engine, "before_cursor_execute", record)
+
+
+async def test_concurrent_get_tweet_queries_once(insert_data):
+    async with async_session_maker() as session:
+        with recording() as alone:
+            await get_tweet(session=session, tweet_id=1)
+        with recording() as together:
+            tweets = await asyncio.gather(
+                *(get_tweet(session=session, tweet_id=1) for _ in range(10))
+            )
+
+    assert {tweet.id for tweet in tweets} == {1}
+    assert len(together) == len(alone)
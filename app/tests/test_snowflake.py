@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta, timezone
+
+from core import snowflake
+from core.snowflake import (
+    SnowflakeGenerator,
+    bucket_of,
+    min_id_at,
+    timestamp_of,
+)
+
+
+def test_ids_are_unique_and_increasing():
+    generator = SnowflakeGenerator(worker_id=3)
+    ids = [generator.next_id() for _ in range(10000)]
+
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+    assert all(i < 2**53 for i in ids)
+    assert {
+        (i >> snowflake.WORKER_SHIFT) & snowflake.MAX_WORKER_ID for i in ids
+    } == {3}
+
+
+def test_sequence_overflow_waits_for_next_millisecond(monkeypatch):
+    generator = SnowflakeGenerator(worker_id=0)
+    clock = iter([5] * (snowflake.MAX_SEQUENCE + 2) + [6])
+    monkeypatch.setattr(generator, "now", lambda: next(clock))
+
+    ids = [generator.next_id() for _ in range(snowflake.MAX_SEQUENCE + 2)]
+
+    assert ids[-2] >> snowflake.TIMESTAMP_SHIFT == 5
+    assert ids[-1] >> snowflake.TIMESTAMP_SHIFT == 6
+
+
+def test_workers_never_collide():
+    first = SnowflakeGenerator(worker_id=1)
+    second = SnowflakeGenerator(worker_id=2)
+
+    ids = [g.next_id() for _ in range(1000) for g in (first, second)]
+
+    assert len(set(ids)) == len(ids)
+
+
+def test_bucket_is_encoded():
+    generator = SnowflakeGenerator(worker_id=7)
+
+    assert [bucket_of(generator.next_id(b)) for b in range(16)] == list(
+        range(16)
+    )
+
+
+def test_timestamp_round_trip():
+    moment = datetime.now(timezone.utc) - timedelta(days=3)
+    lower_bound = min_id_at(moment)
+    new_id = SnowflakeGenerator(worker_id=0).next_id()
+
+    assert abs(timestamp_of(lower_bound) - moment) < timedelta(seconds=1)
+    assert new_id > lower_bound
@@ -0,0 +1,253 @@
+import socket
+import time
+from datetime import datetime, timezone
+
+import boto3
+import botocore.auth
+import httpx
+import pytest
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+from httpx import AsyncClient
+from moto.server import ThreadedMotoServer
+
+import services.media_service
+from core.storage import LocalStorage, S3Storage, check_storage, set_storage
+
+BUCKET = "media"
+
+
+@pytest.fixture(scope="module")
+def s3_endpoint():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+    server.start()
+    endpoint = f"http://127.0.0.1:{port}"
+    boto3.client(
+        "s3",
+        endpoint_url=endpoint,
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+        region_name="us-east-1",
+    ).create_bucket(Bucket=BUCKET)
+    yield endpoint
+    server.stop()
+
+
+@pytest.fixture
+def s3_client(s3_endpoint):
+    return boto3.client(
+        "s3",
+        endpoint_url=s3_endpoint,
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+        region_name="us-east-1",
+    )
+
+
+@pytest.fixture
+def s3_storage(s3_endpoint):
+    return S3Storage(s3_endpoint, BUCKET, "test", "test")
+
+
+async def test_s3_storage_objects(s3_storage, s3_client):
+    await s3_storage.save("cat.png", b"meow", "image/png")
+    stored = s3_client.get_object(Bucket=BUCKET, Key="cat.png")
+    assert stored["Body"].read() == b"meow"
+    assert stored["ContentType"] == "image/png"
+    assert await s3_storage.size("cat.png") == 4
+
+    await s3_storage.delete("cat.png")
+    await s3_storage.delete("cat.png")
+    assert await s3_storage.size("cat.png") is None
+    assert s3_storage.url("cat.png").endswith(f"/{BUCKET}/cat.png")
+
+
+async def test_s3_list_objects(s3_storage, monkeypatch):
+    monkeypatch.setattr("core.storage.LIST_PAGE_SIZE", 2)
+    keys = ["list/a.png", "list/b.png", "list/c.png"]
+    for key in keys:
+        await s3_storage.save(key, b"png", "image/png")
+
+    pages = [page async for page in s3_storage.list_objects()]
+    listed = [item for page in pages for item in page]
+    assert all(len(page) <= 2 for page in pages)
+    assert [item.key for item in listed if item.key in keys] == keys
+    assert {item.size for item in listed if item.key in keys} == {3}
+    for key in keys:
+        await s3_storage.delete(key)
+
+
+async def test_s3_presigned_upload(s3_storage, s3_client):
+    upload = s3_storage.presign_upload("dog.png", "image/png", expires=60)
+    async with httpx.AsyncClient() as client:
+        response = await client.request(
+            upload["method"],
+            upload["url"],
+            content=b"woof",
+            headers=upload["headers"],
+        )
+
+    assert response.status_code == 200
+    stored = s3_client.get_object(Bucket=BUCKET, Key="dog.png")
+    assert stored["Body"].read() == b"woof"
+
+
+def test_s3_presign_matches_botocore(monkeypatch):
+    now = datetime(2026, 10, 19, 12, 30, tzinfo=timezone.utc)
+    monkeypatch.setattr(botocore.auth, "get_current_datetime", lambda: now)
+    storage = S3Storage("http://minio:9000", BUCKET, "AKID", "secret")
+
+    request = AWSRequest(
+        method="PUT",
+        url=storage.object_url("a1.png"),
+        headers={"Content-Type": "image/png"},
+    )
+    botocore.auth.S3SigV4QueryAuth(
+        Credentials("AKID", "secret"), "s3", "us-east-1", expires=600
+    ).add_auth(request)
+
+    upload = storage.presign_upload("a1.png", "image/png", 600, now=now)
+    expected = dict(httpx.URL(request.url).params)
+    assert dict(httpx.URL(upload["url"]).params) == expected
+
+
+def test_s3_authorization_matches_botocore(monkeypatch):
+    now = datetime(2026, 10, 19, 12, 30, tzinfo=timezone.utc)
+    monkeypatch.setattr(botocore.auth, "get_current_datetime", lambda: now)
+    storage = S3Storage("http://minio:9000", BUCKET, "AKID", "secret")
+    url = storage.object_url("a1.png")
+
+    request = AWSRequest(
+        method="PUT",
+        url=url,
+        data=b"png",
+        headers={"Content-Type": "image/png"},
+    )
+    botocore.auth.S3SigV4Auth(
+        Credentials("AKID", "secret"), "s3", "us-east-1"
+    ).add_auth(request)
+
+    headers = storage.authorize(
+        "PUT", url, b"png", {"content-type": "image/png"}, {}, now
+    )
+    assert headers["Authorization"] == request.headers["Authorization"]
+
+
+async def test_local_presigned_upload(
+    ac: AsyncClient, insert_data, local_storage
+):
+    response = await ac.post(
+        "api/medias/uploads",
+        headers={"api-key": "oleg"},
+        json={"filename": "Cat.PNG", "content_type": "image/png"},
+    )
+    assert response.status_code == 200
+    upload = response.json()
+    media_id = upload["media_id"]
+    assert upload["upload_url"].startswith("/api/medias/uploads/")
+
+    response = await ac.post(
+        f"api/medias/{media_id}/complete", headers={"api-key": "oleg"}
+    )
+    assert response.status_code == 400
+    assert response.json()["error_type"] == "NO UPLOAD"
+
+    response = await ac.request(
+        upload["method"],
+        upload["upload_url"].replace("signature=", "signature=0"),
+        content=b"png",
+        headers=upload["headers"],
+    )
+    assert response.status_code == 403
+
+    response = await ac.request(
+        upload["method"],
+        upload["upload_url"],
+        content=b"png",
+        headers=upload["headers"],
+    )
+    assert response.status_code == 200
+
+    response = await ac.post(
+        f"api/medias/{media_id}/complete", headers={"api-key": "oleg"}
+    )
+    assert response.status_code == 200
+    key = upload["upload_url"].split("/")[-1].split("?")[0]
+    assert key.endswith(".png")
+    assert await local_storage.size(key) == 3
+
+
+async def test_local_upload_expires(local_storage):
+    upload = local_storage.presign_upload("a.png", "image/png", expires=60)
+    query = httpx.URL(upload["url"]).params
+    expires, signature = int(query["expires"]), query["signature"]
+
+    assert local_storage.check_upload("a.png", "image/png", expires, signature)
+    assert not local_storage.check_upload(
+        "a.png", "image/jpeg", expires, signature
+    )
+    assert not local_storage.check_upload(
+        "a.png", "image/png", int(time.time()) - 1, signature
+    )
+
+
+async def test_upload_size_capped(
+    ac: AsyncClient, insert_data, local_storage, monkeypatch
+):
+    monkeypatch.setattr(services.media_service, "MEDIA_MAX_SIZE", 2)
+    response = await ac.post(
+        "api/medias/uploads",
+        headers={"api-key": "oleg"},
+        json={"filename": "cat.png", "content_type": "image/png"},
+    )
+    upload = response.json()
+    key = upload["upload_url"].split("/")[-1].split("?")[0]
+
+    response = await ac.request(
+        upload["method"],
+        upload["upload_url"],
+        content=b"png",
+        headers=upload["headers"],
+    )
+    assert response.status_code == 403
+    assert response.json()["error_type"] == "BAD FILE"
+    assert await local_storage.size(key) is None
+
+    # As if sent straight to an object store.
+    await local_storage.save(key, b"png", "image/png")
+    response = await ac.post(
+        f"api/medias/{upload['media_id']}/complete",
+        headers={"api-key": "oleg"},
+    )
+    assert response.status_code == 400
+    assert response.json()["error_type"] == "BAD FILE"
+    assert await local_storage.size(key) is None
+
+
+def test_check_storage_requires_secret(tmp_path):
+    previous = set_storage(LocalStorage(tmp_path, "/media/", ""))
+    try:
+        with pytest.raises(RuntimeError):
+            check_storage()
+    finally:
+        set_storage(previous)
+
+
+async def test_post_image(ac: AsyncClient, insert_data, local_storage):
+    response = await ac.post(
+        "api/medias/",
+        headers={"api-key": "oleg"},
+        files={"file": ("cat.png", b"png", "image/png")},
+    )
+    response_2 = await ac.post(
+        "api/medias/",
+        headers={"api-key": "oleg"},
+        files={"file": ("cat.gif", b"gif", "image/gif")},
+    )
+    assert response.status_code == 200
+    assert response.json()["media_id"]
+    assert len(list(local_storage.root.iterdir())) == 1
+    assert response_2.status_code == 400
@@ -0,0 +1,122 @@
+import json
+
+import httpx
+import pytest
+from httpx import AsyncClient
+
+from core import tracing
+from core.tracing import (
+    SPAN_CLIENT,
+    SPAN_SERVER,
+    FileExporter,
+    MemoryExporter,
+    OtlpExporter,
+    Span,
+    Trace,
+    set_exporter,
+)
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+@pytest.fixture
+async def memory_exporter():
+    await tracing.flush()
+    exporter = MemoryExporter()
+    previous = set_exporter(exporter)
+    yield exporter
+    set_exporter(previous)
+
+
+async def test_request_trace(ac: AsyncClient, insert_data, memory_exporter):
+    await ac.post("api/tweets/1/likes", headers={"api-key": "serega"})
+    response = await ac.delete(
+        "api/tweets/1/likes",
+        headers={
+            "api-key": "serega",
+            "traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01",
+            "x-request-id": "req-42",
+        },
+    )
+    assert response.status_code == 200
+    assert response.headers["x-request-id"] == "req-42"
+    assert response.headers["traceparent"].startswith(f"00-{TRACE_ID}-")
+    await tracing.flush()
+
+    [trace] = [
+        trace for trace in memory_exporter.traces if trace.trace_id == TRACE_ID
+    ]
+    spans = {span.name: span for span in trace.spans}
+    root = spans["DELETE delete_like_to_tweet_handler"]
+    assert root.kind == SPAN_SERVER and root.parent_id == PARENT_ID
+    assert root.attributes["request.id"] == "req-42"
+    assert root.attributes["http.status_code"] == 200
+
+    service = spans["tweet_service.delete_like_to_tweet"]
+    assert service.parent_id == root.span_id
+    queries = [span for span in trace.spans if span.name == "db.query"]
+    assert queries and all(span.kind == SPAN_CLIENT for span in queries)
+    assert any(
+        span.attributes["db.statement"].startswith("DELETE FROM likes")
+        and span.parent_id == service.span_id
+        for span in queries
+    )
+
+
+async def test_tail_sampling(
+    ac: AsyncClient, insert_data, memory_exporter, monkeypatch
+):
+    headers = {"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-00"}
+    response = await ac.get("api/users/1", headers=headers)
+    assert response.headers["traceparent"].endswith("-00")
+    await tracing.flush()
+    assert not memory_exporter.traces
+
+    monkeypatch.setattr(tracing, "TRACE_SLOW_THRESHOLD", 0)
+    await ac.get("api/users/1", headers=headers)
+    await tracing.flush()
+    [trace] = memory_exporter.traces
+    assert any(span.name.startswith("user_service.") for span in trace.spans)
+
+
+def finished_trace() -> Trace:
+    trace = Trace(TRACE_ID, sampled=True)
+    root = Span(trace, "GET get_user_by_id", None, {"http.status_code": 200})
+    root.finish()
+    return trace
+
+
+async def test_file_exporter(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    exporter = FileExporter(str(path))
+    await exporter.export([finished_trace()])
+    await exporter.export([finished_trace()])
+
+    lines = path.read_text().splitlines()
+    assert len(lines) == 2
+    [span] = json.loads(lines[0])["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert span["traceId"] == TRACE_ID
+    assert span["attributes"] == [
+        {"key": "http.status_code", "value": {"intValue": "200"}}
+    ]
+
+
+async def test_otlp_exporter():
+    received = []
+
+    def collector(request: httpx.Request) -> httpx.Response:
+        received.append((request.url.path, json.loads(request.content)))
+        return httpx.Response(200, json={})
+
+    exporter = OtlpExporter(
+        "http://collector:4318", transport=httpx.MockTransport(collector)
+    )
+    await exporter.export([finished_trace()])
+
+    [(path, payload)] = received
+    assert path == "/v1/traces"
+    resource = payload["resourceSpans"][0]
+    assert resource["resource"]["attributes"][0]["value"] == {
+        "stringValue": "twitter-clone"
+    }
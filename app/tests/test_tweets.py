@@ -1,4 +1,18 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
 from httpx import AsyncClient
+from prometheus_client import REGISTRY
+from sqlalchemy import func, insert, select, update
+
+from core.config import MEDIA_PATH
+from core.sharding import bucket_for_user
+from core.snowflake import make_id, next_id, timestamp_of
+from db.models import Like, Media, Tweet, User
+from services import notification_service, purge_service
+from services.ranking_service import rank_score, rescore_recent
+from services.tag_service import backfill_tags, extract_hashtags
+from tests.conftest import async_session_maker
 
 
 async def test_get_tweet(ac: AsyncClient, insert_data):
@@ -9,6 +23,18 @@ async def test_get_tweet(ac: AsyncClient, insert_data):
     assert response_2.status_code == 404
 
 
+async def test_get_tweet_cache_headers(ac: AsyncClient, insert_data):
+    response = await ac.get("api/tweets/1")
+    response_2 = await ac.get("api/tweets/4")
+    response_3 = await ac.get("api/tweets/", headers={"api-key": "oleg"})
+    assert response.headers["cache-control"].startswith("public")
+    assert response.headers["surrogate-key"] == "tweet:1 user:1"
+    assert response_2.headers["cache-control"] == "no-store"
+    assert "surrogate-key" not in response_2.headers
+    assert response_3.headers["cache-control"] == "private, no-store"
+    assert "api-key" in response_3.headers["vary"]
+
+
 async def test_get_tweets(ac: AsyncClient, insert_data):
     response = await ac.get("api/tweets/", headers={"api-key": "oleg"})
     response_2 = await ac.get("api/tweets/", headers={"api-key": "some"})
@@ -27,14 +53,19 @@ async def test_post_tweets(ac: AsyncClient, insert_data):
     response_2 = await ac.post("api/tweets/", headers={"api-key": "oleg"})
 
     assert response.status_code == 200
-    assert response.json()["tweet_id"] == 2
+    created = timestamp_of(response.json()["tweet_id"])
+    assert abs(datetime.now(timezone.utc) - created) < timedelta(minutes=1)
     assert response_2.status_code == 422
 
 
 async def test_post_like_to_tweet(ac: AsyncClient, insert_data):
     response = await ac.post("api/tweets/1/likes", headers={"api-key": "oleg"})
-    response_2 = await ac.post("api/tweets/1/likes", headers={"api-key": "oleg"})
-    response_3 = await ac.post("api/tweets/3/likes", headers={"api-key": "oleg"})
+    response_2 = await ac.post(
+        "api/tweets/1/likes", headers={"api-key": "oleg"}
+    )
+    response_3 = await ac.post(
+        "api/tweets/3/likes", headers={"api-key": "oleg"}
+    )
     assert response.status_code == 200
     assert response.json()["result"] is True
     assert response_2.status_code == 404
@@ -42,15 +73,27 @@ async def test_post_like_to_tweet(ac: AsyncClient, insert_data):
 
 
 async def test_delete_like_to_tweet(ac: AsyncClient, insert_data):
-    response = await ac.delete("api/tweets/1/likes", headers={"api-key": "oleg"})
-    response_2 = await ac.delete("api/tweets/1/likes", headers={"api-key": "oleg"})
-    response_3 = await ac.delete("api/tweets/3/likes", headers={"api-key": "oleg"})
+    response = await ac.delete(
+        "api/tweets/1/likes", headers={"api-key": "oleg"}
+    )
+    response_2 = await ac.delete(
+        "api/tweets/1/likes", headers={"api-key": "oleg"}
+    )
+    response_3 = await ac.delete(
+        "api/tweets/3/likes", headers={"api-key": "oleg"}
+    )
     assert response.status_code == 200
     assert response.json()["result"] is True
     assert response_2.status_code == 404
     assert response_3.status_code == 404
 
 
+async def test_likes_purge_tweet(ac: AsyncClient, insert_data, local_purger):
+    await ac.post("api/tweets/1/likes", headers={"api-key": "serega"})
+    await ac.delete("api/tweets/1/likes", headers={"api-key": "serega"})
+    assert list(local_purger.purged) == ["tweet:1", "tweet:1"]
+
+
 async def test_delete_tweet(ac: AsyncClient, insert_data):
     response = await ac.delete("api/tweets/1", headers={"api-key": "oleg"})
     response_2 = await ac.delete("api/tweets/1", headers={"api-key": "some"})
@@ -59,3 +102,445 @@ async def test_delete_tweet(ac: AsyncClient, insert_data):
     assert response.json()["result"] is True
     assert response_2.status_code == 404
     assert response_3.status_code == 404
+
+
+async def test_purge_deleted_tweet(insert_data, local_storage):
+    await local_storage.save("purged.png", b"png", "image/png")
+    tweet_id = next_id(bucket_for_user(1))
+
+    async with async_session_maker() as session:
+        # Deleted before any other tweet, so purged first.
+        await session.execute(
+            insert(Tweet).values(
+                id=tweet_id,
+                user_id=1,
+                content="purged",
+                deleted_at=datetime(2000, 1, 1, tzinfo=timezone.utc),
+            )
+        )
+        await session.execute(
+            insert(Media).values(
+                name=MEDIA_PATH + "purged.png",
+                key="purged.png",
+                tweet_id=tweet_id,
+            )
+        )
+        await session.execute(
+            insert(Like).values(user_id=1, tweet_id=tweet_id)
+        )
+        await session.execute(
+            insert(Like).values(user_id=2, tweet_id=tweet_id)
+        )
+        await session.commit()
+
+        purged = await purge_service.purge_deleted_tweets(
+            session, batch_size=1
+        )
+        likes = await session.execute(
+            select(func.count()).where(Like.tweet_id == tweet_id)
+        )
+
+        assert purged == 1
+        assert await session.get(Tweet, tweet_id) is None
+        assert likes.scalar() == 0
+        assert await local_storage.size("purged.png") is None
+
+
+async def test_purge_skips_failing_tweet(
+    insert_data, local_storage, monkeypatch
+):
+    stuck, next_one = (next_id(bucket_for_user(1)) for _ in range(2))
+    async with async_session_maker() as session:
+        for tweet_id in (stuck, next_one):
+            await session.execute(
+                insert(Tweet).values(
+                    id=tweet_id,
+                    user_id=1,
+                    content="purged",
+                    deleted_at=datetime(2000, 1, 1, tzinfo=timezone.utc),
+                )
+            )
+        await session.execute(
+            insert(Media).values(
+                name=MEDIA_PATH + "stuck.png", key="stuck.png", tweet_id=stuck
+            )
+        )
+        await session.commit()
+
+    delete = local_storage.delete
+
+    async def broken_delete(key):
+        if key == "stuck.png":
+            raise OSError("storage is down")
+        await delete(key)
+
+    monkeypatch.setattr(local_storage, "delete", broken_delete)
+    failures = REGISTRY.get_sample_value("purge_failures_total") or 0
+    async with async_session_maker() as session:
+        await purge_service.purge_deleted_tweets(session, batch_size=10)
+        # The tweet after the failing one is purged all the same.
+        assert await session.get(Tweet, next_one) is None
+        assert await session.get(Tweet, stuck) is not None
+    assert REGISTRY.get_sample_value("purge_failures_total") == failures + 1
+
+    monkeypatch.undo()
+    async with async_session_maker() as session:
+        await purge_service.purge_deleted_tweets(session, batch_size=10)
+        assert await session.get(Tweet, stuck) is None
+
+
+async def test_tweet_orders(ac: AsyncClient, insert_data):
+    three_days_ago = datetime.now(timezone.utc) - timedelta(days=3)
+    async with async_session_maker() as session:
+        # Far from the ids the other tests expect to be free.
+        await session.execute(
+            insert(User).values(id=100, name="Ranker", api_key="ranker")
+        )
+        old_id = make_id(
+            int(three_days_ago.timestamp() * 1000), bucket_for_user(100)
+        )
+        await session.execute(
+            insert(Tweet).values(id=old_id, user_id=100, content="old")
+        )
+        await session.commit()
+    headers = {"api-key": "ranker"}
+    new_ids = [
+        (
+            await ac.post(
+                "api/tweets/", headers=headers, json={"tweet_data": text}
+            )
+        ).json()["tweet_id"]
+        for text in ("new", "newest")
+    ]
+    for api_key in ("oleg", "serega"):
+        await ac.post(
+            f"api/tweets/{old_id}/likes", headers={"api-key": api_key}
+        )
+    await ac.post(
+        f"api/tweets/{new_ids[0]}/likes", headers={"api-key": "oleg"}
+    )
+
+    async def listed(order: str):
+        response = await ac.get(
+            "api/tweets/", headers=headers, params={"order": order}
+        )
+        return [tweet["id"] for tweet in response.json()["tweets"]]
+
+    assert await listed("top") == [old_id, new_ids[0], new_ids[1]]
+    assert await listed("recent") == [new_ids[1], new_ids[0], old_id]
+    assert await listed("ranked") == [new_ids[0], old_id, new_ids[1]]
+    response = await ac.get(
+        "api/tweets/", headers=headers, params={"order": "ranked", "limit": 1}
+    )
+    assert [tweet["id"] for tweet in response.json()["tweets"]] == new_ids[:1]
+    response = await ac.get(
+        "api/tweets/", headers=headers, params={"order": "x"}
+    )
+    assert response.status_code == 422
+
+    await ac.delete(f"api/tweets/{old_id}/likes", headers={"api-key": "oleg"})
+    async with async_session_maker() as session:
+        tweet = await session.get(Tweet, old_id)
+        assert tweet.likes_count == 1
+        assert tweet.score == pytest.approx(
+            rank_score(1, timestamp_of(old_id), datetime.now(timezone.utc)),
+            rel=1e-3,
+        )
+
+
+async def test_rescore_recent(insert_data):
+    now = datetime.now(timezone.utc)
+    recent_id = make_id(int((now - timedelta(hours=5)).timestamp() * 1000))
+    stale_id = make_id(int((now - timedelta(days=30)).timestamp() * 1000))
+    async with async_session_maker() as session:
+        session.add_all(
+            Tweet(id=tweet_id, user_id=1, content="", likes_count=10, score=5)
+            for tweet_id in (recent_id, stale_id)
+        )
+        await session.commit()
+
+        assert await rescore_recent(session, batch_size=1, now=now) >= 1
+        recent = await session.get(Tweet, recent_id)
+        stale = await session.get(Tweet, stale_id)
+        assert recent.score == pytest.approx(
+            rank_score(10, timestamp_of(recent_id), now), rel=1e-6
+        )
+        assert stale.score == 5
+
+
+async def test_like_summaries(ac: AsyncClient, insert_data):
+    response = await ac.post(
+        "api/tweets/", headers={"api-key": "oleg"}, json={"tweet_data": "hi"}
+    )
+    tweet_id = response.json()["tweet_id"]
+    liker_ids = list(range(200, 210))
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {
+                        "id": user_id,
+                        "name": f"fan {user_id}",
+                        "api_key": f"fan_{user_id}",
+                    }
+                    for user_id in liker_ids
+                ]
+            )
+        )
+        for user_id in liker_ids:
+            await session.execute(
+                insert(Like).values(
+                    id=next_id(bucket_for_user(1)),
+                    user_id=user_id,
+                    tweet_id=tweet_id,
+                )
+            )
+        await session.execute(
+            update(Tweet)
+            .where(Tweet.id == tweet_id)
+            .values(likes_count=len(liker_ids))
+        )
+        await session.commit()
+    await ac.post(
+        f"api/tweets/{tweet_id}/likes", headers={"api-key": "serega"}
+    )
+
+    response = await ac.get(f"api/tweets/{tweet_id}")
+    tweet = response.json()
+    assert tweet["like_count"] == 11
+    assert tweet["liked_by_me"] is False
+    assert [like["user_id"] for like in tweet["likes"]] == [2, 209, 208]
+    assert response.headers["cache-control"].startswith("public")
+    assert "api-key" in response.headers["vary"]
+
+    response = await ac.get(
+        f"api/tweets/{tweet_id}", headers={"api-key": "fan_200"}
+    )
+    tweet = response.json()
+    assert tweet["liked_by_me"] is True
+    assert [like["user_id"] for like in tweet["likes"]] == [200, 2, 209]
+    assert response.headers["cache-control"] == "private, no-store"
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 4, **({"cursor": cursor} if cursor else {})}
+        response = await ac.get(f"api/tweets/{tweet_id}/likes", params=params)
+        page = response.json()
+        pages.append([like["user_id"] for like in page["likes"]])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert [len(page) for page in pages] == [4, 4, 3]
+    assert sum(pages, []) == [2, *reversed(liker_ids)]
+
+    response = await ac.get("api/tweets/4/likes")
+    assert response.status_code == 404
+
+
+async def test_retweets_and_quotes(ac: AsyncClient, insert_data):
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {
+                        "id": user_id,
+                        "name": f"rt {user_id}",
+                        "api_key": f"rt_{user_id}",
+                    }
+                    for user_id in (400, 401, 402)
+                ]
+            )
+        )
+        await session.commit()
+    author, first, second = (
+        {"api-key": f"rt_{user_id}"} for user_id in (400, 401, 402)
+    )
+    response = await ac.post(
+        "api/tweets/", headers=author, json={"tweet_data": "original"}
+    )
+    tweet_id = response.json()["tweet_id"]
+
+    response = await ac.post(f"api/tweets/{tweet_id}/retweet", headers=first)
+    retweet_id = response.json()["tweet_id"]
+    response = await ac.post(f"api/tweets/{tweet_id}/retweet", headers=first)
+    assert response.json()["error_type"] == "BAD RETWEET"
+    # Retweeting a retweet retweets the original.
+    await ac.post(f"api/tweets/{retweet_id}/retweet", headers=second)
+    response = await ac.post(
+        "api/tweets/",
+        headers=second,
+        json={"tweet_data": "so true", "quote_tweet_id": retweet_id},
+    )
+    quote_id = response.json()["tweet_id"]
+    await ac.post(f"api/tweets/{retweet_id}/likes", headers=second)
+
+    tweet = (await ac.get(f"api/tweets/{tweet_id}")).json()
+    assert (tweet["retweets_count"], tweet["quotes_count"]) == (2, 1)
+    assert tweet["like_count"] == 1
+
+    response = await ac.get(
+        "api/tweets/", headers=second, params={"order": "recent"}
+    )
+    quote, retweet = response.json()["tweets"]
+    assert quote["id"] == quote_id and quote["quote_of_id"] == tweet_id
+    assert retweet["retweet_of_id"] == tweet_id and retweet["content"] == ""
+    for shared in (quote, retweet):
+        assert shared["original"]["content"] == "original"
+        assert shared["original"]["liked_by_me"] is True
+
+    response = await ac.delete(f"api/tweets/{tweet_id}/retweet", headers=first)
+    assert response.status_code == 200
+    response = await ac.delete(f"api/tweets/{tweet_id}/retweet", headers=first)
+    assert response.status_code == 404
+    await ac.delete(f"api/tweets/{quote_id}", headers=second)
+    tweet = (await ac.get(f"api/tweets/{tweet_id}")).json()
+    assert (tweet["retweets_count"], tweet["quotes_count"]) == (1, 0)
+
+    await ac.delete(f"api/tweets/{tweet_id}", headers=author)
+    response = await ac.get("api/tweets/", headers=second)
+    [retweet] = response.json()["tweets"]
+    assert retweet["original"] is None
+
+
+async def test_reply_threads(ac: AsyncClient, insert_data):
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {
+                        "id": user_id,
+                        "name": f"talker {user_id}",
+                        "api_key": f"talker_{user_id}",
+                    }
+                    for user_id in (500, 501, 502)
+                ]
+            )
+        )
+        await session.commit()
+
+    async def post(user_id: int, text: str, reply_to_id=None) -> int:
+        response = await ac.post(
+            "api/tweets/",
+            headers={"api-key": f"talker_{user_id}"},
+            json={"tweet_data": text, "reply_to_id": reply_to_id},
+        )
+        return response.json()["tweet_id"]
+
+    async def thread(tweet_id: int, **params):
+        response = await ac.get(f"api/tweets/{tweet_id}/thread", params=params)
+        return response.json()
+
+    root = await post(500, "root")
+    first = await post(501, "first", root)
+    nested = await post(502, "nested", first)
+    second = await post(502, "second", root)
+    deepest = await post(500, "deepest", nested)
+
+    conversation = await thread(root)
+    assert conversation["tweet"]["id"] == root
+    assert conversation["tweet"]["replies_count"] == 2
+    assert conversation["ancestors"] == []
+    replies = conversation["replies"]
+    assert [reply["id"] for reply in replies] == [
+        first,
+        nested,
+        deepest,
+        second,
+    ]
+    assert [reply["depth"] for reply in replies] == [1, 2, 3, 1]
+    assert replies[0]["replies_count"] == 1
+    assert replies[1]["parent_id"] == first
+
+    subtree = await thread(nested)
+    assert [tweet["id"] for tweet in subtree["ancestors"]] == [root, first]
+    assert [reply["id"] for reply in subtree["replies"]] == [deepest]
+
+    top_level = await thread(root, depth=1)
+    assert [reply["id"] for reply in top_level["replies"]] == [first, second]
+
+    page = await thread(root, limit=3)
+    assert [reply["id"] for reply in page["replies"]] == [
+        first,
+        nested,
+        deepest,
+    ]
+    page = await thread(root, limit=3, cursor=page["next_cursor"])
+    assert [reply["id"] for reply in page["replies"]] == [second]
+    assert page["next_cursor"] is None
+
+    await ac.delete(f"api/tweets/{second}", headers={"api-key": "talker_502"})
+    conversation = await thread(root)
+    assert conversation["tweet"]["replies_count"] == 1
+    assert second not in [reply["id"] for reply in conversation["replies"]]
+
+    response = await ac.get("api/tweets/4/thread")
+    assert response.status_code == 404
+
+
+async def test_hashtags_and_mentions(ac: AsyncClient, insert_data):
+    assert extract_hashtags("#Py #py a#b ##c #d.") == ["py", "d"]
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {
+                        "id": user_id,
+                        "name": f"Tagger_{user_id}",
+                        "api_key": f"tagger_{user_id}",
+                    }
+                    for user_id in (600, 601)
+                ]
+            )
+        )
+        await session.commit()
+
+    async def post(user_id: int, text: str) -> int:
+        response = await ac.post(
+            "api/tweets/",
+            headers={"api-key": f"tagger_{user_id}"},
+            json={"tweet_data": text},
+        )
+        return response.json()["tweet_id"]
+
+    first = await post(600, "Hi @tagger_601 and @nobody, #Python #FastAPI")
+    second = await post(601, "more #python")
+    assert (601, "mention", first) in notification_service.pending
+
+    response = await ac.get("api/hashtags/PYTHON/tweets", params={"limit": 1})
+    assert response.headers["surrogate-key"] == "hashtag:python"
+    page = response.json()
+    assert [tweet["id"] for tweet in page["tweets"]] == [second]
+    response = await ac.get(
+        "api/hashtags/python/tweets",
+        params={"limit": 1, "cursor": page["next_cursor"]},
+    )
+    page = response.json()
+    assert [tweet["id"] for tweet in page["tweets"]] == [first]
+    assert page["next_cursor"] is None
+
+    response = await ac.get("api/users/601/mentions")
+    assert [tweet["id"] for tweet in response.json()["tweets"]] == [first]
+    response = await ac.get("api/users/3/mentions")
+    assert response.status_code == 404
+
+    # Tweets written before indexing are found once backfilled.
+    legacy = next_id(bucket_for_user(600))
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(Tweet).values(
+                id=legacy, content="#legacy @Tagger_601", user_id=600
+            )
+        )
+        await session.commit()
+        assert await backfill_tags(session, batch_size=2) >= 3
+    response = await ac.get("api/hashtags/legacy/tweets")
+    assert [tweet["id"] for tweet in response.json()["tweets"]] == [legacy]
+    response = await ac.get("api/users/601/mentions")
+    assert [tweet["id"] for tweet in response.json()["tweets"]] == [
+        legacy,
+        first,
+    ]
+
+    await ac.delete(f"api/tweets/{second}", headers={"api-key": "tagger_601"})
+    response = await ac.get("api/hashtags/python/tweets")
+    assert [tweet["id"] for tweet in response.json()["tweets"]] == [first]
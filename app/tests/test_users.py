@@ -1,4 +1,27 @@
+import json
+from datetime import datetime, timezone
+
 from httpx import AsyncClient
+from prometheus_client import REGISTRY
+from sqlalchemy import func, insert, select, update
+
+from db.models import (
+    Like,
+    Media,
+    Notification,
+    Tweet,
+    TweetMention,
+    User,
+    followers,
+)
+from services import (
+    account_service,
+    counter_service,
+    notification_service,
+    tweet_service,
+    user_service,
+)
+from tests.conftest import async_session_maker
 
 
 async def test_get_user_by_id(ac: AsyncClient, insert_data):
@@ -12,8 +35,12 @@ async def test_get_user_by_id(ac: AsyncClient, insert_data):
 
 async def test_post_follow_to_user(ac: AsyncClient, insert_data):
     response = await ac.post("api/users/2/follow", headers={"api-key": "oleg"})
-    response_2 = await ac.post("api/users/2/follow", headers={"api-key": "111"})
-    response_3 = await ac.post("api/users/4/follow", headers={"api-key": "oleg"})
+    response_2 = await ac.post(
+        "api/users/2/follow", headers={"api-key": "111"}
+    )
+    response_3 = await ac.post(
+        "api/users/4/follow", headers={"api-key": "oleg"}
+    )
     assert response.status_code == 200
     assert response.json()["result"] is True
     assert response_2.status_code == 404
@@ -21,18 +48,348 @@ async def test_post_follow_to_user(ac: AsyncClient, insert_data):
 
 
 async def test_delete_follow_to_user(ac: AsyncClient, insert_data):
-    response = await ac.delete("api/users/2/follow", headers={"api-key": "oleg"})
-    response_2 = await ac.delete("api/users/2/follow", headers={"api-key": "oleg"})
-    response_3 = await ac.delete("api/users/4/follow", headers={"api-key": "oleg"})
+    response = await ac.delete(
+        "api/users/2/follow", headers={"api-key": "oleg"}
+    )
+    response_2 = await ac.delete(
+        "api/users/2/follow", headers={"api-key": "oleg"}
+    )
+    response_3 = await ac.delete(
+        "api/users/4/follow", headers={"api-key": "oleg"}
+    )
     assert response.status_code == 200
     assert response.json()["result"] is True
     assert response_2.status_code == 404
     assert response_3.status_code == 404
 
 
+async def test_follows_purge_both_users(
+    ac: AsyncClient, insert_data, local_purger
+):
+    response = await ac.get("api/users/1")
+    assert response.headers["surrogate-key"] == "user:1"
+    # A missing user is not cached: it may be created right after.
+    for path in ("api/users/4", "api/users/4/followers"):
+        response = await ac.get(path)
+        assert response.status_code == 404
+        assert response.headers["cache-control"] == "no-store"
+
+    await ac.post("api/users/1/follow", headers={"api-key": "serega"})
+    await ac.delete("api/users/1/follow", headers={"api-key": "serega"})
+    assert list(local_purger.purged) == ["user:2", "user:1"] * 2
+
+
+async def test_follow_pages(ac: AsyncClient, insert_data):
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {"id": user_id, "name": f"Page {user_id}"}
+                    for user_id in (900, 901, 902, 903)
+                ]
+            )
+        )
+        await session.execute(
+            insert(followers).values(
+                [
+                    {"following_user_id": user_id, "followed_user_id": 900}
+                    for user_id in (901, 902, 903)
+                ]
+                + [{"following_user_id": 900, "followed_user_id": 903}]
+            )
+        )
+        await session.commit()
+
+    response = await ac.get("api/users/900")
+    user = response.json()["user"]
+    assert sorted(follower["id"] for follower in user["followers"]) == [
+        901,
+        902,
+        903,
+    ]
+    assert [followed["id"] for followed in user["following"]] == [903]
+
+    response = await ac.get("api/users/900/followers", params={"limit": 2})
+    page = response.json()
+    assert [user["id"] for user in page["users"]] == [901, 902]
+    assert page["next_cursor"] == 902
+    response = await ac.get(
+        "api/users/900/followers",
+        params={"limit": 2, "cursor": page["next_cursor"]},
+    )
+    page = response.json()
+    assert [user["id"] for user in page["users"]] == [903]
+    assert page["next_cursor"] is None
+
+    response = await ac.get("api/users/900/following")
+    assert response.json()["users"] == [{"id": 903, "name": "Page 903"}]
+    response = await ac.get("api/users/3/following")
+    assert response.status_code == 404
+
+
+async def test_bulk_follows(ac: AsyncClient, insert_data, monkeypatch):
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {"id": user_id, "name": f"Bulk {user_id}"}
+                    for user_id in (700, 701, 702, 703)
+                ]
+            )
+        )
+        await session.execute(
+            update(User).where(User.id == 700).values(api_key="bulk_700")
+        )
+        await session.commit()
+
+    async def bulk(method: str, user_ids):
+        return await ac.request(
+            method,
+            "api/users/follow/bulk",
+            headers={"api-key": "bulk_700"},
+            json={"user_ids": user_ids},
+        )
+
+    async def counts(user_id: int):
+        response = await ac.get(f"api/users/{user_id}")
+        user = response.json()["user"]
+        return user["followers_count"], user["following_count"]
+
+    await ac.post("api/users/701/follow", headers={"api-key": "bulk_700"})
+    # Itself, an unknown user and an existing follow are skipped.
+    response = await bulk("POST", [703, 701, 702, 700, 799, 702])
+    assert response.status_code == 200
+    assert response.json() == {"result": True, "user_ids": [702, 703]}
+    assert await counts(700) == (0, 3)
+    assert [await counts(i) for i in (701, 702, 703)] == [(1, 0)] * 3
+
+    response = await bulk("DELETE", [701, 703, 799])
+    assert response.json() == {"result": True, "user_ids": [701, 703]}
+    assert await counts(700) == (0, 1)
+    assert [await counts(i) for i in (701, 702, 703)] == [
+        (0, 0),
+        (1, 0),
+        (0, 0),
+    ]
+    response = await bulk("DELETE", [701])
+    assert response.json()["user_ids"] == []
+
+    monkeypatch.setattr(user_service, "FOLLOW_BULK_MAX", 2)
+    response = await bulk("POST", [701, 702, 703])
+    assert response.status_code == 404
+    assert response.json()["error_type"] == "BAD FOLLOW"
+
+
+async def test_account_deletion(
+    ac: AsyncClient, insert_data, local_storage, monkeypatch
+):
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {"id": i, "name": f"Eraser_{i}", "api_key": f"eraser_{i}"}
+                    for i in (800, 801)
+                ]
+            )
+        )
+        await session.commit()
+
+    async def post(user_id: int, text: str) -> int:
+        response = await ac.post(
+            "api/tweets/",
+            headers={"api-key": f"eraser_{user_id}"},
+            json={"tweet_data": text},
+        )
+        return response.json()["tweet_id"]
+
+    other_tweet = await post(801, "Hi @eraser_800")
+    own_tweet = await post(800, "Bye")
+    for user_id, path in (
+        (800, "api/users/801/follow"),
+        (801, "api/users/800/follow"),
+        (800, f"api/tweets/{other_tweet}/likes"),
+        (800, f"api/tweets/{other_tweet}/retweet"),
+        (801, f"api/tweets/{own_tweet}/likes"),
+    ):
+        await ac.post(path, headers={"api-key": f"eraser_{user_id}"})
+    await local_storage.save("upload.png", b"png", "")
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(Media).values(
+                name=local_storage.url("upload.png"),
+                key="upload.png",
+                user_id=800,
+            )
+        )
+        await session.commit()
+        await notification_service.flush_notifications(session)
+
+    response = await ac.delete(
+        "api/users/me", headers={"api-key": "eraser_800"}
+    )
+    assert response.json() == {"result": True}
+    # Hidden at once.
+    assert (await ac.get("api/users/800")).status_code == 404
+    response = await ac.get("api/users/me", headers={"api-key": "eraser_800"})
+    assert response.status_code == 404
+    assert (await ac.get(f"api/tweets/{own_tweet}")).status_code == 404
+    response = await ac.post(
+        f"api/tweets/{own_tweet}/retweet", headers={"api-key": "eraser_801"}
+    )
+    assert response.status_code == 404
+    for side in ("followers", "following"):
+        response = await ac.get(f"api/users/801/{side}")
+        assert response.json()["users"] == []
+    user = (await ac.get("api/users/801")).json()["user"]
+    assert user["followers"] == user["following"] == []
+
+    monkeypatch.setattr(account_service, "ACCOUNT_DELETION_PAUSE", 0)
+    async with async_session_maker() as session:
+        assert await account_service.delete_accounts(session, batch_size=1)
+        for column in (
+            User.id,
+            Tweet.user_id,
+            Like.user_id,
+            followers.c.following_user_id,
+            followers.c.followed_user_id,
+            TweetMention.user_id,
+            Notification.user_id,
+            Notification.actor_id,
+            Media.user_id,
+        ):
+            count = await session.scalar(
+                select(func.count()).where(column == 800)
+            )
+            assert count == 0, column
+        response = await session.execute(
+            select(Tweet.likes_count, Tweet.retweets_count).where(
+                Tweet.id == other_tweet
+            )
+        )
+        assert response.one() == (0, 0)
+        other = await session.get(User, 801)
+        assert (other.followers_count, other.following_count) == (0, 0)
+        assert other.unread_notifications == 0
+    assert not local_storage.path("upload.png").exists()
+
+
+async def test_delete_accounts_skips_failing_account(insert_data, monkeypatch):
+    async with async_session_maker() as session:
+        await session.execute(
+            insert(User).values(
+                [
+                    {
+                        "id": user_id,
+                        "name": f"Stuck {user_id}",
+                        "deleted_at": datetime(
+                            2000, 1, day, tzinfo=timezone.utc
+                        ),
+                    }
+                    for day, user_id in ((1, 820), (2, 821))
+                ]
+            )
+        )
+        await session.commit()
+
+    erase_account = account_service.erase_account
+
+    async def broken_erase(session, user_id, batch_size):
+        if user_id == 820:
+            raise OSError("storage is down")
+        await erase_account(session, user_id, batch_size)
+
+    monkeypatch.setattr(account_service, "erase_account", broken_erase)
+    monkeypatch.setattr(account_service, "ACCOUNT_DELETION_PAUSE", 0)
+    failures = (
+        REGISTRY.get_sample_value("account_deletion_failures_total") or 0
+    )
+    async with async_session_maker() as session:
+        await account_service.delete_accounts(session, batch_size=10)
+        # The account after the failing one is erased all the same.
+        assert await session.get(User, 821) is None
+        assert await session.get(User, 820) is not None
+    assert (
+        REGISTRY.get_sample_value("account_deletion_failures_total")
+        == failures + 1
+    )
+
+    monkeypatch.setattr(account_service, "erase_account", erase_account)
+    async with async_session_maker() as session:
+        await account_service.delete_accounts(session, batch_size=10)
+        assert await session.get(User, 820) is None
+
+
 async def test_get_user_me(ac: AsyncClient, insert_data):
     response = await ac.get("api/users/me", headers={"api-key": "oleg"})
     response_2 = await ac.get("api/users/me", headers={"api-key": "some"})
     assert response.status_code == 200
     assert response.json()["result"] is True
     assert response_2.status_code == 404
+
+
+async def test_export_user_tweets(ac: AsyncClient, insert_data, monkeypatch):
+    monkeypatch.setattr(tweet_service, "EXPORT_BATCH_SIZE", 1)
+    for content in ("first", "second"):
+        await ac.post(
+            "api/tweets/",
+            headers={"api-key": "serega"},
+            json={"tweet_data": content},
+        )
+
+    response = await ac.get("api/users/2/tweets/export")
+    response_2 = await ac.get("api/users/99/tweets/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    tweets = [json.loads(line) for line in response.text.splitlines()]
+    assert [tweet["content"] for tweet in tweets] == ["first", "second"]
+    assert tweets[0]["id"] < tweets[1]["id"]
+    assert tweets[0]["attachments"] == []
+    assert response_2.status_code == 404
+
+    async with async_session_maker() as session:
+        chunks = await tweet_service.export_tweets(session=session, user_id=2)
+        assert len([chunk async for chunk in chunks]) == 2
+
+
+async def test_user_counters(ac: AsyncClient, insert_data):
+    async def counts(user_id: int):
+        response = await ac.get(f"api/users/{user_id}")
+        user = response.json()["user"]
+        return (
+            user["followers_count"],
+            user["following_count"],
+            user["tweets_count"],
+        )
+
+    oleg, serega = await counts(1), await counts(2)
+    await ac.post("api/users/1/follow", headers={"api-key": "serega"})
+    await ac.post("api/users/1/follow", headers={"api-key": "serega"})
+    response = await ac.post(
+        "api/tweets/", headers={"api-key": "serega"}, json={"tweet_data": "x"}
+    )
+    assert await counts(1) == (oleg[0] + 1, oleg[1], oleg[2])
+    assert await counts(2) == (serega[0], serega[1] + 1, serega[2] + 1)
+
+    tweet_id = response.json()["tweet_id"]
+    await ac.delete("api/users/1/follow", headers={"api-key": "serega"})
+    await ac.delete(f"api/tweets/{tweet_id}", headers={"api-key": "serega"})
+    await ac.delete(f"api/tweets/{tweet_id}", headers={"api-key": "serega"})
+    assert await counts(1) == oleg
+    assert await counts(2) == serega
+
+
+async def test_repair_counters(ac: AsyncClient, insert_data):
+    async with async_session_maker() as session:
+        await session.execute(
+            update(User).where(User.id == 1).values(followers_count=42)
+        )
+        await session.commit()
+
+        assert await counter_service.repair_counters(session, batch_size=1)
+        actual = await counter_service.count_rows(session, [1, 2])
+        assert await counter_service.repair_counters(session) == 0
+
+    response = await ac.get("api/users/1")
+    assert response.json()["user"]["followers_count"] == (
+        actual["followers_count"][1]
+    )
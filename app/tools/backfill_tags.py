@@ -0,0 +1,53 @@
+"""
+Index the hashtags and mentions of tweets written before they were indexed.
+
+    python -m tools.backfill_tags --url URL [URL ...] --batch-size 1000
+
+The first URL is the primary shard, as for tools.reshard, and the databases
+must already be migrated. Every shard is walked in tweet id order, one
+transaction per --batch-size tweets. Rows already indexed are kept, so an
+interrupted run can simply be started again, and running it while the
+application writes new tweets is safe.
+"""
+import argparse
+import asyncio
+from typing import List
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from core.sharding import make_session_maker
+from services.tag_service import backfill_tags
+
+
+async def backfill(urls: List[str], batch_size: int = 1000) -> int:
+    """
+    Index every live tweet of the layout.
+
+    :param urls: List[str]: Databases, primary first
+    :param batch_size: int: Tweets per transaction
+    :return: The number of tweets read
+    """
+    engines = {
+        str(number): create_async_engine(url)
+        for number, url in enumerate(urls)
+    }
+    try:
+        async with make_session_maker(engines)() as session:
+            return await backfill_tags(session, batch_size)
+    finally:
+        for engine in engines.values():
+            await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--url", nargs="+", required=True)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    processed = asyncio.run(backfill(args.url, args.batch_size))
+    print(f"tweets: {processed} indexed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Measure the Python CPU time of the hot reads, per call.
+
+    python -m tools.bench_queries --url URL --api-key KEY --iterations 2000
+
+The database must hold the user of --api-key with at least one tweet, as
+after tools.seed. Every hot read runs twice: "rebuilt" builds its select on
+each call, as every request did before the statements were built once, and
+"cached" executes the statement of the service. The report gives the
+process time per call, which counts the CPU of this process and not the
+wait for the database, and the share of the cached calls that found their
+SQL in the compiled cache of SQLAlchemy.
+"""
+import argparse
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Tuple
+
+from prometheus_client import REGISTRY
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from core.config import ENGINE_OPTIONS, SQLITE_PRAGMAS, SQLITE_WRITER_TIMEOUT
+from core.database import make_engine
+from core.sharding import make_session_maker
+from db.models import Tweet, User
+from dependencies import USER_BY_API_KEY
+from services.tweet_service import TWEET_BY_ID, USER_TWEETS
+
+CACHE_RESULTS = ("cache_hit", "cache_miss", "no_cache_key")
+
+
+def cache_lookups() -> Dict[str, float]:
+    return {
+        result: REGISTRY.get_sample_value(
+            "sqlalchemy_compiled_cache_total", {"result": result}
+        )
+        or 0
+        for result in CACHE_RESULTS
+    }
+
+
+async def measure(
+    call: Callable[[], Awaitable], iterations: int
+) -> Tuple[float, float]:
+    """
+    Time ``call``.
+
+    :param call: Callable[[], Awaitable]: Read to run
+    :param iterations: int: Number of calls
+    :return: The process time per call in microseconds and the compiled
+        cache hit ratio
+    """
+    await call()
+    before = cache_lookups()
+    started = time.process_time()
+    for _ in range(iterations):
+        await call()
+    elapsed = time.process_time() - started
+    after = cache_lookups()
+    lookups = {result: after[result] - before[result] for result in after}
+    ratio = lookups["cache_hit"] / (sum(lookups.values()) or 1)
+    return elapsed / iterations * 1e6, ratio
+
+
+async def bench(url: str, api_key: str, iterations: int):
+    engine = make_engine(
+        url, SQLITE_PRAGMAS, SQLITE_WRITER_TIMEOUT, **ENGINE_OPTIONS
+    )
+    try:
+        async with make_session_maker({"0": engine})() as session:
+            user = (
+                await session.execute(USER_BY_API_KEY, {"api_key": api_key})
+            ).scalar_one()
+            tweet_id = await session.scalar(
+                select(Tweet.id).where(Tweet.user_id == user.id).limit(1)
+            )
+
+            async def read(statement, parameters=None):
+                response = await session.execute(statement, parameters)
+                response.scalars().all()
+                session.expunge_all()
+
+            reads = {
+                "user by api key": (
+                    lambda: read(select(User).where(User.api_key == api_key)),
+                    lambda: read(USER_BY_API_KEY, {"api_key": api_key}),
+                ),
+                "tweet by id": (
+                    lambda: read(
+                        select(Tweet)
+                        .options(selectinload(Tweet.author))
+                        .options(selectinload(Tweet.media))
+                        .where(
+                            Tweet.id == tweet_id, Tweet.deleted_at.is_(None)
+                        )
+                    ),
+                    lambda: read(TWEET_BY_ID, {"tweet_id": tweet_id}),
+                ),
+                "user tweets": (
+                    lambda: read(
+                        select(Tweet)
+                        .options(selectinload(Tweet.author))
+                        .options(selectinload(Tweet.media))
+                        .where(
+                            Tweet.user_id == user.id,
+                            Tweet.deleted_at.is_(None),
+                        )
+                        .order_by(Tweet.likes_count.desc(), Tweet.id.desc())
+                        .limit(20)
+                    ),
+                    lambda: read(
+                        USER_TWEETS["top", True],
+                        {"user_id": user.id, "limit": 20},
+                    ),
+                ),
+            }
+            print(f"{'read':<16} {'rebuilt µs':>11} {'cached µs':>10} hits")
+            for name, (rebuilt, cached) in reads.items():
+                before, _ = await measure(rebuilt, iterations)
+                after, ratio = await measure(cached, iterations)
+                print(f"{name:<16} {before:>11.0f} {after:>10.0f} {ratio:.1%}")
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--url", required=True)
+    parser.add_argument("--api-key", required=True)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    asyncio.run(bench(args.url, args.api_key, args.iterations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+Copy data from one shard layout into another.
+
+    python -m tools.reshard --source URL [URL ...] --target URL [URL ...]
+
+The first URL of each list is the primary shard. Users and follows are copied
+to the target primary, and every other target shard gets a reference copy of
+the users. Tweets, likes and media are copied to the shard of their author in
+the target layout. Rows are read in keyset batches and written with
+ON CONFLICT DO NOTHING, so an interrupted run can simply be started again.
+With --delete-source the copied rows are then removed from the sources.
+Hashtags and mentions are not copied: run tools.backfill_tags on the target
+layout afterwards.
+
+Rows minted before sharding carry no usable bucket in their id. The tool
+prints the SHARD_ID_FLOOR the application needs to keep finding them.
+"""
+import argparse
+import asyncio
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from sqlalchemy import Table, delete, func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from core.sharding import PRIMARY_SHARD, ShardRouter
+from core.snowflake import bucket_of
+from db.models import Like, Media, Tweet, User, followers
+
+
+def shard_ids_for(urls: List[str]) -> List[str]:
+    return [str(number) for number in range(len(urls))]
+
+
+async def copy_rows(target: AsyncEngine, table: Table, rows: List[dict]):
+    if rows:
+        async with target.begin() as conn:
+            await conn.execute(
+                insert(table).values(rows).on_conflict_do_nothing()
+            )
+
+
+async def copy_users(
+    source: AsyncEngine, targets: Dict[str, AsyncEngine], batch_size: int
+) -> int:
+    """
+    Copy users to the target primary and their reference copies to the
+    other targets, then the follows.
+
+    :param source: AsyncEngine: Source primary shard
+    :param targets: Dict[str, AsyncEngine]: Target shards by shard id
+    :param batch_size: int: Rows per statement
+    :return: The number of copied users
+    """
+    users = User.__table__
+    copied, last_id = 0, 0
+    while True:
+        async with source.connect() as conn:
+            result = await conn.execute(
+                select(users)
+                .where(users.c.id > last_id)
+                .order_by(users.c.id)
+                .limit(batch_size)
+            )
+            rows = [dict(row) for row in result.mappings()]
+        if not rows:
+            break
+        for shard_id, target in targets.items():
+            if shard_id == PRIMARY_SHARD:
+                await copy_rows(target, users, rows)
+            else:
+                references = [
+                    {"id": row["id"], "name": row["name"]} for row in rows
+                ]
+                await copy_rows(target, users, references)
+        copied += len(rows)
+        last_id = rows[-1]["id"]
+
+    async with targets[PRIMARY_SHARD].begin() as conn:
+        await conn.execute(
+            select(
+                func.setval(
+                    func.pg_get_serial_sequence("users", "id"),
+                    select(
+                        func.coalesce(func.max(users.c.id), 1)
+                    ).scalar_subquery(),
+                )
+            )
+        )
+
+    last_key = (0, 0)
+    while True:
+        async with source.connect() as conn:
+            result = await conn.execute(
+                select(followers)
+                .where(
+                    tuple_(
+                        followers.c.following_user_id,
+                        followers.c.followed_user_id,
+                    )
+                    > tuple_(*last_key)
+                )
+                .order_by(
+                    followers.c.following_user_id,
+                    followers.c.followed_user_id,
+                )
+                .limit(batch_size)
+            )
+            rows = [dict(row) for row in result.mappings()]
+        if not rows:
+            break
+        await copy_rows(targets[PRIMARY_SHARD], followers, rows)
+        last_key = (
+            rows[-1]["following_user_id"],
+            rows[-1]["followed_user_id"],
+        )
+    return copied
+
+
+def author_query(table: Table):
+    """Rows of a sharded table together with the user placing them."""
+    if table is Tweet.__table__:
+        return select(table, table.c.user_id.label("author_id"))
+    tweets = Tweet.__table__
+    if table is Like.__table__:
+        return select(table, tweets.c.user_id.label("author_id")).join(
+            tweets, tweets.c.id == table.c.tweet_id
+        )
+    return select(
+        table,
+        func.coalesce(tweets.c.user_id, table.c.user_id).label("author_id"),
+    ).outerjoin(tweets, tweets.c.id == table.c.tweet_id)
+
+
+async def move_table(
+    table: Table,
+    source_id: Optional[str],
+    source: AsyncEngine,
+    targets: Dict[str, AsyncEngine],
+    router: ShardRouter,
+    batch_size: int,
+    floor: Dict[str, int],
+) -> Dict[str, int]:
+    """
+    Copy the rows of one table on one source shard to their target shards.
+
+    :param table: Table: tweets, likes or medias
+    :param source_id: Optional[str]: Target shard the source database also
+        is, None if it is not part of the target layout
+    :param source: AsyncEngine: Source shard
+    :param targets: Dict[str, AsyncEngine]: Target shards by shard id
+    :param router: ShardRouter: Router of the target layout
+    :param batch_size: int: Rows per statement
+    :param floor: Dict[str, int]: Collects the largest misplaced id
+    :return: The number of copied rows per target shard
+    """
+    copied: Dict[str, int] = defaultdict(int)
+    last_id = 0
+    while True:
+        async with source.connect() as conn:
+            result = await conn.execute(
+                author_query(table)
+                .where(table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(batch_size)
+            )
+            rows = [dict(row) for row in result.mappings()]
+        if not rows:
+            break
+
+        placed = defaultdict(list)
+        for row in rows:
+            shard_id = router.for_user(row.pop("author_id") or 0)
+            # Lookups by id must not trust the bucket of such rows.
+            if (
+                table is not Like.__table__
+                and router.for_bucket(bucket_of(row["id"])) != shard_id
+            ):
+                floor["id"] = max(floor["id"], row["id"] + 1)
+            placed[shard_id].append(row)
+
+        for shard_id, shard_rows in placed.items():
+            if shard_id != source_id:
+                await copy_rows(targets[shard_id], table, shard_rows)
+                copied[shard_id] += len(shard_rows)
+        last_id = rows[-1]["id"]
+    return copied
+
+
+async def delete_moved(
+    table: Table,
+    source_id: Optional[str],
+    source: AsyncEngine,
+    router: ShardRouter,
+    batch_size: int,
+) -> int:
+    """
+    Delete the rows of ``table`` that belong to another shard than
+    ``source_id``, all of them when the source left the layout.
+    """
+    deleted, last_id = 0, 0
+    while True:
+        async with source.connect() as conn:
+            result = await conn.execute(
+                author_query(table)
+                .where(table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(batch_size)
+            )
+            rows = result.mappings().all()
+        if not rows:
+            break
+        moved = [
+            row["id"]
+            for row in rows
+            if router.for_user(row["author_id"] or 0) != source_id
+        ]
+        if moved:
+            async with source.begin() as conn:
+                await conn.execute(delete(table).where(table.c.id.in_(moved)))
+            deleted += len(moved)
+        last_id = rows[-1]["id"]
+    return deleted
+
+
+async def reshard(
+    source_urls: List[str],
+    target_urls: List[str],
+    batch_size: int = 1000,
+    delete_source: bool = False,
+) -> dict:
+    """
+    Copy everything from the source layout into the target layout. Target
+    databases must already be migrated.
+
+    :param source_urls: List[str]: Source databases, primary first
+    :param target_urls: List[str]: Target databases, primary first
+    :param batch_size: int: Rows per statement
+    :param delete_source: bool: Remove rows that moved to another shard
+    :return: Counters and the SHARD_ID_FLOOR to configure
+    """
+    sources = {
+        shard_id: create_async_engine(url)
+        for shard_id, url in zip(shard_ids_for(source_urls), source_urls)
+    }
+    targets = {
+        shard_id: create_async_engine(url)
+        for shard_id, url in zip(shard_ids_for(target_urls), target_urls)
+    }
+    router = ShardRouter(list(targets))
+    # A source keeps the rows it would receive when it is the same
+    # database at the same position of the target layout.
+    kept = {
+        shard_id
+        for shard_id, url in zip(shard_ids_for(source_urls), source_urls)
+        if shard_id in targets and target_urls[int(shard_id)] == url
+    }
+
+    stats = {"users": 0, "rows": defaultdict(int), "deleted": 0}
+    floor = {"id": 0}
+    try:
+        stats["users"] = await copy_users(
+            sources[PRIMARY_SHARD], targets, batch_size
+        )
+        for table in (Tweet.__table__, Like.__table__, Media.__table__):
+            for source_id, source in sources.items():
+                copied = await move_table(
+                    table,
+                    source_id if source_id in kept else None,
+                    source,
+                    targets,
+                    router,
+                    batch_size,
+                    floor,
+                )
+                stats["rows"][table.name] += sum(copied.values())
+
+        if delete_source:
+            for table in (Like.__table__, Media.__table__, Tweet.__table__):
+                for source_id, source in sources.items():
+                    stats["deleted"] += await delete_moved(
+                        table,
+                        source_id if source_id in kept else None,
+                        source,
+                        router,
+                        batch_size,
+                    )
+    finally:
+        for engine in (*sources.values(), *targets.values()):
+            await engine.dispose()
+
+    stats["rows"] = dict(stats["rows"])
+    stats["id_floor"] = floor["id"]
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--source", nargs="+", required=True)
+    parser.add_argument("--target", nargs="+", required=True)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--delete-source", action="store_true")
+    args = parser.parse_args()
+
+    stats = asyncio.run(
+        reshard(args.source, args.target, args.batch_size, args.delete_source)
+    )
+    print(f"users: {stats['users']}")
+    for table, count in stats["rows"].items():
+        print(f"{table}: {count} rows copied")
+    print(f"deleted from sources: {stats['deleted']}")
+    print(f"SHARD_ID_FLOOR={stats['id_floor']}")
+
+
+if __name__ == "__main__":
+    main()
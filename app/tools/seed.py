@@ -0,0 +1,453 @@
+"""
+Fill databases with a synthetic social graph for capacity tests.
+
+    python -m tools.seed --url URL [URL ...] --users 1000000 --seed 1
+
+The first URL is the primary shard, as for tools.reshard, and the databases
+must already be migrated. The graph has the shapes of real networks:
+
+- follows: out-degrees follow a Pareto law and targets are drawn with a
+  popularity skew, so a few accounts gather most of the followers;
+- tweets: an exponential number per user, spread over the --days before
+  --until;
+- likes: a Pareto number per tweet, arriving in a burst after it;
+- media: rows for a --media-ratio of the tweets, without files.
+
+Users are split in chunks of --chunk-size and every chunk draws from random
+streams seeded with --seed and its number, so the same arguments give the
+same rows whatever the number of --processes. Each process loads its chunks
+with COPY into a temporary table followed by INSERT ... ON CONFLICT DO
+NOTHING: an interrupted run can simply be started again. Ids are unique
+across chunks (see IdMinter), so no generated row is lost to a conflict.
+"""
+import argparse
+import asyncio
+import random
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+import asyncpg
+from sqlalchemy.engine import make_url
+
+from core.config import MEDIA_PATH
+from core.sharding import PRIMARY_SHARD, ShardRouter, bucket_for_user
+from core.snowflake import (
+    MAX_SEQUENCE,
+    MAX_WORKER_ID,
+    SHARD_BUCKETS,
+    bucket_of,
+    make_id,
+)
+from services.ranking_service import rank_score
+
+WORDS = (
+    "hello world coffee code deploy monday weekend cat dog music game news "
+    "python async database cache shard today tomorrow great bad new old"
+).split()
+
+USER_COLUMNS = (
+    "id",
+    "name",
+    "api_key",
+    "password",
+    "followers_count",
+    "following_count",
+    "tweets_count",
+)
+TWEET_COLUMNS = ("id", "user_id", "content", "likes_count", "score")
+LIKE_COLUMNS = ("id", "user_id", "tweet_id")
+MEDIA_COLUMNS = ("id", "name", "key", "size", "user_id", "tweet_id")
+
+
+class GraphShape(NamedTuple):
+    users: int
+    seed: int = 0
+    chunk_size: int = 2000
+    follows_min: int = 5
+    follows_alpha: float = 1.5
+    follows_max: int = 5000
+    popularity_skew: float = 3.0
+    tweets_mean: float = 20.0
+    likes_alpha: float = 1.2
+    likes_max: int = 10000
+    like_burst: float = 3600.0
+    media_ratio: float = 0.2
+    days: float = 365.0
+    until: datetime = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+class Profile(NamedTuple):
+    user_id: int
+    following: int
+    tweets: int
+
+
+def dsn_for(url: str) -> str:
+    """asyncpg DSN of an SQLAlchemy database URL."""
+    return (
+        make_url(url)
+        .set(drivername="postgresql")
+        .render_as_string(hide_password=False)
+    )
+
+
+def chunk_count(shape: GraphShape) -> int:
+    return -(-shape.users // shape.chunk_size)
+
+
+def stream(shape: GraphShape, name: str, chunk: int) -> random.Random:
+    """Random numbers of one kind of rows of one chunk."""
+    return random.Random(f"{shape.seed}:{name}:{chunk}")
+
+
+def draw_profiles(shape: GraphShape, chunk: int) -> List[Profile]:
+    """How many users each user of ``chunk`` follows and tweets."""
+    rng = stream(shape, "profiles", chunk)
+    first = chunk * shape.chunk_size + 1
+    last = min(first + shape.chunk_size, shape.users + 1)
+    # Half of the other users at most, so distinct targets are found fast.
+    follows_cap = min(shape.follows_max, (shape.users - 1) // 2)
+    return [
+        Profile(
+            user_id,
+            min(
+                int(
+                    shape.follows_min * rng.paretovariate(shape.follows_alpha)
+                ),
+                follows_cap,
+            ),
+            int(rng.expovariate(1 / shape.tweets_mean)),
+        )
+        for user_id in range(first, last)
+    ]
+
+
+def generate_users(shape: GraphShape, chunk: int) -> List[tuple]:
+    """Users with their following and tweet counters already set."""
+    return [
+        (
+            profile.user_id,
+            f"user {profile.user_id}",
+            f"seed-{profile.user_id}",
+            None,
+            0,
+            profile.following,
+            profile.tweets,
+        )
+        for profile in draw_profiles(shape, chunk)
+    ]
+
+
+def generate_follows(shape: GraphShape, chunk: int) -> List[tuple]:
+    """Follows of the users of ``chunk``, skewed towards the first users."""
+    rng = stream(shape, "follows", chunk)
+    rows = []
+    for profile in draw_profiles(shape, chunk):
+        followed = set()
+        while len(followed) < profile.following:
+            target = 1 + int(
+                shape.users * rng.random() ** shape.popularity_skew
+            )
+            if target != profile.user_id:
+                followed.add(target)
+        rows.extend((profile.user_id, target) for target in sorted(followed))
+    return rows
+
+
+class IdMinter:
+    """
+    Ids of the rows of one chunk, unique across all chunks: the worker and
+    sequence bits are the chunk number modulo their range, and ids are
+    minted on the milliseconds congruent to the rest of the chunk number,
+    so the ids of two chunks never meet. Within the chunk an id already
+    taken moves to the next free millisecond.
+    """
+
+    def __init__(self, shape: GraphShape, chunk: int):
+        per_millisecond = (MAX_WORKER_ID + 1) * (MAX_SEQUENCE + 1)
+        self.slots = -(-chunk_count(shape) // per_millisecond)
+        self.slot = chunk // per_millisecond
+        self.worker_id, self.sequence = divmod(
+            chunk % per_millisecond, MAX_SEQUENCE + 1
+        )
+        self.taken = set()
+
+    def __call__(self, milliseconds: int, bucket: int) -> int:
+        milliseconds += (self.slot - milliseconds) % self.slots
+        while (milliseconds, bucket % SHARD_BUCKETS) in self.taken:
+            milliseconds += self.slots
+        self.taken.add((milliseconds, bucket % SHARD_BUCKETS))
+        return make_id(milliseconds, bucket, self.worker_id, self.sequence)
+
+
+def generate_tweets(
+    shape: GraphShape, chunk: int
+) -> Tuple[List[tuple], List[tuple], List[tuple]]:
+    """
+    Tweets of the users of ``chunk``, with their likes and media. Tweets
+    carry their likes_count and their score as of --until.
+    """
+    rng = stream(shape, "tweets", chunk)
+    mint = IdMinter(shape, chunk)
+    until = int(shape.until.timestamp() * 1000)
+    since = until - int(shape.days * 86400 * 1000)
+    likes_cap = min(shape.likes_max, shape.users // 2)
+    tweets, likes, medias = [], [], []
+    for profile in draw_profiles(shape, chunk):
+        bucket = bucket_for_user(profile.user_id)
+        for _ in range(profile.tweets):
+            posted = rng.randrange(since, until)
+            tweet_id = mint(posted, bucket)
+            content = " ".join(rng.choices(WORDS, k=rng.randint(3, 30)))
+            like_count = min(
+                int(rng.paretovariate(shape.likes_alpha)) - 1, likes_cap
+            )
+            score = rank_score(
+                like_count,
+                datetime.fromtimestamp(posted / 1000, timezone.utc),
+                shape.until,
+            )
+            tweets.append(
+                (tweet_id, profile.user_id, content, like_count, score)
+            )
+
+            likers = set()
+            while len(likers) < like_count:
+                likers.add(rng.randint(1, shape.users))
+            for liker in sorted(likers):
+                liked = posted + int(
+                    rng.expovariate(1 / shape.like_burst) * 1000
+                )
+                likes.append(
+                    (
+                        mint(min(liked, until), bucket),
+                        liker,
+                        tweet_id,
+                    )
+                )
+
+            if rng.random() < shape.media_ratio:
+                for number in range(rng.randint(1, 4)):
+                    key = f"seed-{tweet_id}-{number}.jpg"
+                    medias.append(
+                        (
+                            mint(posted, bucket),
+                            MEDIA_PATH + key,
+                            key,
+                            rng.randint(20_000, 2_000_000),
+                            profile.user_id,
+                            tweet_id,
+                        )
+                    )
+    return tweets, likes, medias
+
+
+async def copy_rows(
+    conn: asyncpg.Connection,
+    table: str,
+    columns: Sequence[str],
+    rows: List[tuple],
+) -> int:
+    """
+    COPY ``rows`` into a temporary copy of ``table``, then move the ones
+    that are not there yet.
+
+    :return: The number of inserted rows
+    """
+    if not rows:
+        return 0
+    staging = f"seed_{table}"
+    names = ", ".join(columns)
+    async with conn.transaction():
+        await conn.execute(
+            f"CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) "
+            "ON COMMIT DROP"
+        )
+        await conn.copy_records_to_table(
+            staging, records=rows, columns=list(columns)
+        )
+        status = await conn.execute(
+            f"INSERT INTO {table} ({names}) SELECT {names} FROM {staging} "
+            "ON CONFLICT DO NOTHING"
+        )
+    return int(status.split()[-1])
+
+
+def place(router: ShardRouter, rows: List[tuple]) -> Dict[str, List[tuple]]:
+    """Group tweets, likes or media by the shard in the bucket of their id."""
+    placed = defaultdict(list)
+    for row in rows:
+        placed[router.for_bucket(bucket_of(row[0]))].append(row)
+    return placed
+
+
+async def load_users(
+    urls: List[str], shape: GraphShape, chunk: int
+) -> Dict[str, int]:
+    """Users of ``chunk``, and their reference copies on the other shards."""
+    users = generate_users(shape, chunk)
+    stats = {}
+    for number, url in enumerate(urls):
+        conn = await asyncpg.connect(dsn_for(url))
+        try:
+            if str(number) == PRIMARY_SHARD:
+                stats["users"] = await copy_rows(
+                    conn, "users", USER_COLUMNS, users
+                )
+            else:
+                await copy_rows(
+                    conn,
+                    "users",
+                    ("id", "name"),
+                    [(user[0], user[1]) for user in users],
+                )
+        finally:
+            await conn.close()
+    return stats
+
+
+async def load_graph(
+    urls: List[str], shape: GraphShape, chunk: int
+) -> Dict[str, int]:
+    """Follows, tweets, likes and media of the users of ``chunk``."""
+    router = ShardRouter([str(number) for number in range(len(urls))])
+    tweets, likes, medias = generate_tweets(shape, chunk)
+    tables = (
+        ("tweets", TWEET_COLUMNS, place(router, tweets)),
+        ("likes", LIKE_COLUMNS, place(router, likes)),
+        ("medias", MEDIA_COLUMNS, place(router, medias)),
+    )
+    stats = Counter()
+    for number, url in enumerate(urls):
+        shard_id = str(number)
+        conn = await asyncpg.connect(dsn_for(url))
+        try:
+            if shard_id == PRIMARY_SHARD:
+                stats["followers"] += await copy_rows(
+                    conn,
+                    "followers",
+                    ("following_user_id", "followed_user_id"),
+                    generate_follows(shape, chunk),
+                )
+            for table, columns, placed in tables:
+                stats[table] += await copy_rows(
+                    conn, table, columns, placed[shard_id]
+                )
+        finally:
+            await conn.close()
+    return dict(stats)
+
+
+async def count_followers(
+    urls: List[str], shape: GraphShape, chunk: int
+) -> Dict[str, int]:
+    """Set followers_count of the users of ``chunk`` from the follows."""
+    first = chunk * shape.chunk_size + 1
+    conn = await asyncpg.connect(dsn_for(urls[0]))
+    try:
+        await conn.execute(
+            """
+            UPDATE users SET followers_count = counts.total
+            FROM (
+                SELECT followed_user_id, count(*) AS total FROM followers
+                WHERE followed_user_id >= $1 AND followed_user_id < $2
+                GROUP BY followed_user_id
+            ) AS counts
+            WHERE users.id = counts.followed_user_id
+            """,
+            first,
+            first + shape.chunk_size,
+        )
+    finally:
+        await conn.close()
+    return {}
+
+
+PHASES = {
+    "users": load_users,
+    "graph": load_graph,
+    "followers": count_followers,
+}
+
+
+def run_phase(
+    phase: str, urls: List[str], shape: GraphShape, chunk: int
+) -> Dict[str, int]:
+    """Entry point of the worker processes."""
+    return asyncio.run(PHASES[phase](urls, shape, chunk))
+
+
+async def seed(
+    urls: List[str], shape: GraphShape, processes: int = 4
+) -> Dict[str, int]:
+    """
+    Generate the graph described by ``shape`` into the databases. Every
+    phase finishes on all chunks before the next one starts, for the
+    foreign keys.
+
+    :param urls: List[str]: Target databases, primary first
+    :param shape: GraphShape: Size and distributions of the graph
+    :param processes: int: Worker processes loading chunks in parallel
+    :return: The number of inserted rows per table
+    """
+    loop = asyncio.get_running_loop()
+    stats = Counter()
+    with ProcessPoolExecutor(
+        processes, mp_context=get_context("spawn")
+    ) as pool:
+        for phase in PHASES:
+            results = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        pool, run_phase, phase, urls, shape, chunk
+                    )
+                    for chunk in range(chunk_count(shape))
+                )
+            )
+            for result in results:
+                stats.update(result)
+
+    conn = await asyncpg.connect(dsn_for(urls[0]))
+    try:
+        await conn.execute(
+            "SELECT setval(pg_get_serial_sequence('users', 'id'), "
+            "(SELECT coalesce(max(id), 1) FROM users))"
+        )
+    finally:
+        await conn.close()
+    return dict(stats)
+
+
+def main():
+    defaults = GraphShape(users=0)
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--url", nargs="+", required=True)
+    parser.add_argument("--users", type=int, required=True)
+    parser.add_argument("--processes", type=int, default=4)
+    for name, default in defaults._asdict().items():
+        if name in ("users", "until"):
+            continue
+        parser.add_argument(
+            "--" + name.replace("_", "-"), type=type(default), default=default
+        )
+    parser.add_argument(
+        "--until",
+        type=datetime.fromisoformat,
+        default=defaults.until,
+        help="end of the tweets time window, ISO 8601",
+    )
+    args = vars(parser.parse_args())
+    urls, processes = args.pop("url"), args.pop("processes")
+    if args["until"].tzinfo is None:
+        args["until"] = args["until"].replace(tzinfo=timezone.utc)
+
+    stats = asyncio.run(seed(urls, GraphShape(**args), processes))
+    for table, count in stats.items():
+        print(f"{table}: {count} rows inserted")
+
+
+if __name__ == "__main__":
+    main()